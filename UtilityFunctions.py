@@ -6,89 +6,310 @@ Created on Nov 7, 2015
 @author: insyte
 """
 
-from collections import OrderedDict
-from compiler.ast import flatten
+from array import array
+import atexit
+import binascii
+import bisect
+from collections import Counter, OrderedDict, deque
+import contextlib
 import copy
+import hashlib
+import heapq
+import json
+import math
+import mmap
+import multiprocessing
 import os
 import pickle
+import struct
+import sys
+import threading
+import time
+try:
+    import numpy
+except ImportError: # numpy is optional, only needed for the NumPy variants
+    numpy = None
+try:
+    from queue import Queue
+except ImportError: # python 2
+    from Queue import Queue
 
 
 #===============================================================================
 # 
 #===============================================================================
 
-def convertNestedListToNestedTuple(nestedList):
-    '''
+def convertNestedListToNestedTuple(nestedList, internPool = None):
+    '''!@brief converts a list (of lists of ...) into the same structure of tuples, with an
+    explicit stack, so any depth of nesting works
+    @param internPool: optional dict (kept by the caller, and reused across calls) of a type aware
+    key of the tuple -> the tuple. Structurally identical sublists then give the SAME tuple object,
+    so repeated sub plans are stored once, and comparing them short circuits on identity. The key has
+    (type, entry) for each entry, as (1,2) == (True,2.0) but they are not the same plan, and
+    (tuple, id) for a nested tuple (they are pooled already, and hashing them again would make deep
+    nesting quadratic). Tuples with an unhashable entry are not pooled
+    @return the nested tuple
     '''
     ret_tuple = [] # yes the irony is not lost on me
-    
-    for entry in nestedList:
-        if type(entry) == list:
-            ret_tuple.append(convertNestedListToNestedTuple(entry))
+    stack = [(iter(nestedList), ret_tuple)]
+    while stack:
+        (entries, convertedEntries) = stack[-1]
+        for entry in entries:
+            if type(entry) == list:
+                stack.append((iter(entry), []))
+                break # convert the sublist first, then continue with this list
+            convertedEntries.append(entry)
         else:
-            ret_tuple.append(entry)
-    
-    return tuple(ret_tuple)
+            #all the entries are converted
+            stack.pop()
+            convertedTuple = tuple(convertedEntries)
+            if internPool != None:
+                poolKey = tuple([(tuple, id(entry)) if type(entry) == tuple else (type(entry), entry) for entry in convertedTuple])
+                try:
+                    convertedTuple = internPool.setdefault(poolKey, convertedTuple)
+                except TypeError:
+                    pass # unhashable entry, cannot be pooled
+            if len(stack) == 0:
+                return convertedTuple
+            stack[-1][1].append(convertedTuple)
+    #---END WHILE
 
 #============================================================================================
 def getFirstPrefixClassName(descriptorString):
     '''!@brief simply splits the string by "_" to get class prefix
     @param descriptorString to be split
+    @return the class prefix, or None if descriptorString is not a string
     '''
     try:
-        tokens = descriptorString.split("_");
-        return tokens[0];
-    except:
+        return descriptorString.partition("_")[0]
+    except AttributeError:
         return None
 #============================================================================================
 def getSpecificInstanceName(descriptorString):
     '''!@brief simply splits the string by "_" to get instance name (last part)
     @param descriptorString to be split
     '''
-    tokens = descriptorString.split("_");
-    return tokens[len(tokens)-1];
+    return descriptorString.rpartition("_")[2]
+#============================================================================================
+_intern = getattr(sys, "intern", None) or intern # a builtin in python 2
+
+def _internString(string):
+    try:
+        return _intern(string)
+    except TypeError: # not a str (eg: unicode in python 2), kept as it is
+        return string
+
+class DescriptorIndex(object):
+    '''!@brief parses the object descriptors of a domain ("class_..._instance") ONCE and keeps
+    the class prefix and instance name of each, so the lookups in the search loop are dict
+    lookups instead of a split per call. Also indexes the descriptors by class prefix.
+    The descriptors, class prefixes and instance names are interned.
+    '''
+
+    def __init__(self, descriptorStrings = ()):
+        self._parsedDescriptors = {} # descriptor -> (class prefix, instance name)
+        self._descriptorsOfClass = {} # class prefix -> list of descriptors, in the order added
+        self.addDescriptors(descriptorStrings)
+
+    def addDescriptor(self, descriptorString):
+        '''!@return the (class prefix, instance name) of the descriptor, parsing it if it is new
+        '''
+        try:
+            return self._parsedDescriptors[descriptorString]
+        except KeyError:
+            descriptorString = _internString(descriptorString)
+            parsedDescriptor = (_internString(descriptorString.partition("_")[0]),
+                                _internString(descriptorString.rpartition("_")[2]))
+            self._parsedDescriptors[descriptorString] = parsedDescriptor
+            try:
+                self._descriptorsOfClass[parsedDescriptor[0]].append(descriptorString)
+            except KeyError:
+                self._descriptorsOfClass[parsedDescriptor[0]] = [descriptorString]
+            return parsedDescriptor
+
+    def addDescriptors(self, descriptorStrings):
+        '''!@brief batch version of addDescriptor, for a whole list of object names
+        @return the list of (class prefix, instance name), in the same order
+        '''
+        parsedDescriptors = self._parsedDescriptors
+        addDescriptor = self.addDescriptor
+        return [parsedDescriptors[descriptorString] if descriptorString in parsedDescriptors
+                else addDescriptor(descriptorString) for descriptorString in descriptorStrings]
+
+    def getClassName(self, descriptorString):
+        '''!@brief same as getFirstPrefixClassName, from the index
+        '''
+        try:
+            return self._parsedDescriptors[descriptorString][0]
+        except KeyError:
+            return self.addDescriptor(descriptorString)[0]
+
+    def getInstanceName(self, descriptorString):
+        '''!@brief same as getSpecificInstanceName, from the index
+        '''
+        try:
+            return self._parsedDescriptors[descriptorString][1]
+        except KeyError:
+            return self.addDescriptor(descriptorString)[1]
+
+    def getClassNames(self, descriptorStrings):
+        '''!@return the list of class prefixes of the descriptors, in the same order
+        '''
+        return [parsed[0] for parsed in self.addDescriptors(descriptorStrings)]
+
+    def getInstancesOfClass(self, classPrefix):
+        '''!@return the list of descriptors with the class prefix (the index's own list, do not modify it)
+        '''
+        return self._descriptorsOfClass.get(classPrefix, [])
+
+    def getAllClassPrefixes(self):
+        return list(self._descriptorsOfClass.keys())
+
+    def __contains__(self, descriptorString):
+        return descriptorString in self._parsedDescriptors
+
+    def __len__(self):
+        return len(self._parsedDescriptors)
+
 #============================================================================================
-def compactPrintCompoundDataStructure(stateDescriptor,spacer,precursor):
+def compactPrintCompoundDataStructure(stateDescriptor,spacer,precursor, outputStream = None, maxDepth = None, maxItems = None):
     '''!@brief will print with each level in SAME line, and indented by spacer
     @param stateDescriptor: the data struct to be printed
     @param spacer: the indentation string
     @param precursor: What to print at the start of each line
+    @param outputStream: file like object to write to, default is sys.stdout. It is written in
+    large chunks, not one write per line
+    @param maxDepth: dicts nested deeper than this many levels are written as "..."
+    @param maxItems: only the first maxItems keys/elements of each dict/list are written,
+    followed by "... (N more)"
     '''
-    
-    if type(stateDescriptor) == dict:
-        for key in stateDescriptor:
-            newPrecursor = precursor + spacer + key                        
-            compactPrintCompoundDataStructure(stateDescriptor[key], spacer,newPrecursor)
-    elif type(stateDescriptor) == list:
-        for item in stateDescriptor:
-            print(precursor,spacer,item)
-            
-    elif type(stateDescriptor) == tuple:
-        for item in stateDescriptor:
-            print(precursor,spacer,item)
+    writer = _BufferedLineWriter(outputStream)
+    stack = [] # [keys, position, dict, precursor, depth, numOmitted] of the dicts being written
+    try:
+        _writeCompactValue(writer, stack, stateDescriptor, spacer, precursor, 0, maxDepth, maxItems)
+        while stack:
+            entry = stack[-1]
+            (keys, position, currentDict, currentPrecursor, depth, numOmitted) = entry
+            if position == len(keys):
+                stack.pop()
+                if numOmitted > 0:
+                    writer.write(currentPrecursor + " " + spacer + " ... (" + str(numOmitted) + " more)")
+                continue
+            entry[1] = position + 1
+            key = keys[position]
+            _writeCompactValue(writer, stack, currentDict[key], spacer, currentPrecursor + spacer + str(key),
+                               depth + 1, maxDepth, maxItems)
+        #---END WHILE
+    finally:
+        writer.close() # the lines written so far are not lost if a value cannot be printed
+
+def _writeCompactValue(writer, stack, value, spacer, precursor, depth, maxDepth, maxItems):
+    if type(value) == dict:
+        if maxDepth != None and depth >= maxDepth:
+            writer.write(precursor + " " + spacer + " ...")
+            return
+        keys = list(value.keys())
+        numOmitted = 0
+        if maxItems != None and len(keys) > maxItems:
+            numOmitted = len(keys) - maxItems
+            keys = keys[:maxItems]
+        stack.append([keys, 0, value, precursor, depth, numOmitted])
+    elif type(value) == list or type(value) == tuple:
+        _writeItems(writer, precursor + " " + spacer + " ", value, maxItems)
     else:
-        print(precursor,spacer,stateDescriptor);  
-    
+        writer.write(precursor + " " + spacer + " " + str(value))
 
 #============================================================================================
-def printCompoundDataStructure(stateDescriptor, spacer):
+def printCompoundDataStructure(stateDescriptor, spacer, outputStream = None, maxDepth = None, maxItems = None):
     '''!@brief will print with each level in NEW line, and indented by spacer
+    (depth+1 times, so the indentation grows linearly with the depth)
     @param stateDescriptor: the data struct to be printed
     @param spacer: the indentation string
+    @param outputStream: file like object to write to, default is sys.stdout. It is written in
+    large chunks, not one write per line
+    @param maxDepth: dicts nested deeper than this many levels are written as "..."
+    @param maxItems: only the first maxItems keys/elements of each dict/list are written,
+    followed by "... (N more)"
     '''
-    if type(stateDescriptor) == dict or type(stateDescriptor) == OrderedDict:
-        for key in stateDescriptor.keys():
-            print(spacer,key)            
-            printCompoundDataStructure(stateDescriptor[key], (spacer + spacer))
-    elif type(stateDescriptor) == list:
-        for item in stateDescriptor:
-            print(spacer,item)
-            
-    elif type(stateDescriptor) == tuple:
-        for item in stateDescriptor:
-            print(spacer,item)
+    writer = _BufferedLineWriter(outputStream)
+    indents = [spacer] # indents[depth] is the indentation of that depth
+    stack = [] # [keys, position, dict, depth, numOmitted] of the dicts being written
+    try:
+        _writeIndentedValue(writer, stack, stateDescriptor, indents, 0, maxDepth, maxItems)
+        while stack:
+            entry = stack[-1]
+            (keys, position, currentDict, depth, numOmitted) = entry
+            if position == len(keys):
+                stack.pop()
+                if numOmitted > 0:
+                    writer.write(indents[depth] + " ... (" + str(numOmitted) + " more)")
+                continue
+            entry[1] = position + 1
+            key = keys[position]
+            writer.write(indents[depth] + " " + str(key))
+            if len(indents) == depth + 1:
+                indents.append(indents[depth] + spacer)
+            _writeIndentedValue(writer, stack, currentDict[key], indents, depth + 1, maxDepth, maxItems)
+        #---END WHILE
+    finally:
+        writer.close() # the lines written so far are not lost if a value cannot be printed
+
+def _writeIndentedValue(writer, stack, value, indents, depth, maxDepth, maxItems):
+    if type(value) == dict or type(value) == OrderedDict:
+        if maxDepth != None and depth >= maxDepth:
+            writer.write(indents[depth] + " ...")
+            return
+        keys = list(value.keys())
+        numOmitted = 0
+        if maxItems != None and len(keys) > maxItems:
+            numOmitted = len(keys) - maxItems
+            keys = keys[:maxItems]
+        stack.append([keys, 0, value, depth, numOmitted])
+    elif type(value) == list or type(value) == tuple:
+        _writeItems(writer, indents[depth] + " ", value, maxItems)
+    else:
+        writer.write(indents[depth] + " " + str(value))
+
+def _writeItems(writer, linePrefix, items, maxItems):
+    if maxItems != None and len(items) > maxItems:
+        for item in items[:maxItems]:
+            writer.write(linePrefix + str(item))
+        writer.write(linePrefix + "... (" + str(len(items) - maxItems) + " more)")
     else:
-        print(spacer,stateDescriptor);
+        for item in items:
+            writer.write(linePrefix + str(item))
+
+class _BufferedLineWriter(object):
+    '''
+    @summary: collects the lines of the printers and writes them to the stream in chunks of
+    about chunkSize characters
+    '''
+
+    def __init__(self, outputStream = None, chunkSize = 64 * 1024):
+        if outputStream == None:
+            outputStream = sys.stdout # looked up at call time, so redirection of stdout works
+        self.outputStream = outputStream
+        self.chunkSize = chunkSize
+        self._lines = []
+        self._size = 0
+
+    def write(self, line):
+        self._lines.append(line)
+        self._size += len(line) + 1
+        if self._size >= self.chunkSize:
+            self._lines.append("")
+            self.outputStream.write("\n".join(self._lines))
+            self._lines = []
+            self._size = 0
+
+    def close(self):
+        if len(self._lines) > 0:
+            self._lines.append("")
+            try:
+                self.outputStream.write("\n".join(self._lines))
+            finally:
+                self._lines = [] # not written again by a later close
+                self._size = 0
 
 #============================================================================================
 def getLayeredStringFormOfDataStructure(dataStruct,spacer="+"):
@@ -96,36 +317,50 @@ def getLayeredStringFormOfDataStructure(dataStruct,spacer="+"):
     @param dataStruct: the data struct to be parsed
     @param spacer: a string that connects the levels of the compound data struct    
     '''
-    returnList =[]
-    if type(dataStruct) == dict:
-        keyList = dataStruct.keys()
-        for key in sorted(keyList):
-            stringVersion = str(key)
-            returnListEntryStart = stringVersion            
-            remainingPath = \
-                getLayeredStringFormOfDataStructure(dataStruct[key],spacer)
-            for addendum in remainingPath:
-                returnList.append(spacer.join([returnListEntryStart,addendum]))
+    return list(iterLayeredPaths(dataStruct, spacer))
+
+def iterLayeredPaths(dataStruct, spacer = "+"):
+    '''!@brief yields the lines of getLayeredStringFormOfDataStructure one at a time, in the same
+    order, so they can be written to a file or added to a set without building the whole list.
+    The prefix of the keys is built once per dict and shared by all the lines under it
+    @param dataStruct: the data struct to be parsed
+    @param spacer: a string that connects the levels of the compound data struct
+    '''
+    structType = type(dataStruct)
+    if structType != dict and structType != OrderedDict:
+        #for lists or tuples simply return each element
+        if structType == list or structType == tuple:
+            for unit in dataStruct:
+                yield str(unit)
+        #last case is when it is a single value
+        else:
+            yield str(dataStruct)
+        return
+    stack = [(iter(_getLayeredKeys(dataStruct)), dataStruct, "")]
+    while stack:
+        (keys, currentDict, prefix) = stack[-1]
+        for key in keys:
+            value = currentDict[key]
+            valueType = type(value)
+            if valueType == dict or valueType == OrderedDict:
+                stack.append((iter(_getLayeredKeys(value)), value, prefix + str(key) + spacer))
+                break # the nested dict first, then the rest of the keys of this one
+            elif valueType == list or valueType == tuple:
+                path = prefix + str(key) + spacer
+                for unit in value:
+                    yield path + str(unit)
+            else:
+                yield prefix + str(key) + spacer + str(value)
+        else:
+            stack.pop()
+    #---END WHILE
+
+def _getLayeredKeys(dataStruct):
     #need a seperate entry for ordered dict, since I do NOT want to sort alphabetically
     #it is an ordered dict, and the order is in it.
-    elif type(dataStruct) == OrderedDict:
-        keyList = dataStruct.keys()
-        for key in keyList:
-            stringVersion = str(key)
-            returnListEntryStart = stringVersion            
-            remainingPath = \
-                getLayeredStringFormOfDataStructure(dataStruct[key],spacer)
-            for addendum in remainingPath:
-                returnList.append(spacer.join([returnListEntryStart,addendum]))
-    #for lists or tuples simply return as a list
-    elif type(dataStruct) == list or type(dataStruct) == tuple:
-        for unit in dataStruct:
-            returnList.append(str(unit)) 
-    #last case is when it is a single value             
-    else:
-        returnList = [str(dataStruct)]
-    
-    return returnList
+    if type(dataStruct) == OrderedDict:
+        return dataStruct.keys()
+    return sorted(dataStruct.keys())
 
 #============================================================================================        
 def getSingleStringRepresentationOfState(domainState):
@@ -153,13 +388,273 @@ def getSingleStringRepresentationOfState(domainState):
     ret_string = "".join(ret_stringListFormat)
     return ret_string
 
+#============================================================================================
+_atomKeyCache = {} # atom (or its type aware form, see _getAtomKey) -> 128 bit random key, shared by all the fingerprints
+
+def iterStateAtoms(domainState):
+    '''!@brief yields every atom of a (nested) state dict as a tuple of the keys
+    leading to it, followed by the value. Lists, tuples and sets give one atom per element.
+    eg: {"truck1":{"at":"depot"}} gives ("truck1","at","depot")
+    @param domainState: the dict containing the objects and their states
+    '''
+    stack = [((), domainState)]
+    while stack:
+        (path, currentDict) = stack.pop()
+        for key in currentDict:
+            value = currentDict[key]
+            if type(value) == dict or type(value) == OrderedDict:
+                stack.append((path + (key,), value))
+            elif type(value) == list or type(value) == tuple or type(value) == set:
+                for unit in value:
+                    yield path + (key,unit)
+            else:
+                yield path + (key,value)
+
+class _FingerprintMarker(object):
+    '''!@brief a part of the fingerprint atoms that marks the kind of container the value is in (and
+    its position in a list or tuple), or an empty container. There is one instance per kind and
+    position, equal only to itself, and its repr has no quotes, so it is never the repr of a str key
+    '''
+    __slots__ = ("kind", "position")
+
+    def __init__(self, kind, position = None):
+        self.kind = kind
+        self.position = position
+
+    def __repr__(self):
+        if self.position == None:
+            return "<%s>" % self.kind
+        return "<%s %d>" % (self.kind, self.position)
+
+    def __reduce__(self):
+        return (_getFingerprintMarker, (self.kind, self.position))
+
+_fingerprintMarkers = {} # (kind, position) -> _FingerprintMarker
+
+def _getFingerprintMarker(kind, position = None):
+    try:
+        return _fingerprintMarkers[(kind, position)]
+    except KeyError:
+        return _fingerprintMarkers.setdefault((kind, position), _FingerprintMarker(kind, position))
+
+def _getPositionMarkers(kind, length):
+    '''!@return: the markers of the positions 0 to length-1 in a list or tuple
+    '''
+    return [_getFingerprintMarker(kind, position) for position in range(length)]
+
+def iterFingerprintAtoms(domainState):
+    '''!@brief the atoms that getStateFingerprint adds up. Unlike iterStateAtoms, they tell apart
+    the kinds of containers and keep the empty ones, so that two states get different atoms
+    exactly when they are not equal (==), except that:
+    the OrderedDicts are taken as dicts (their key order does not matter) and 1, 1.0 and True are different values.
+    eg: {"o":{"p":"a"}} gives ("o","p","a"), {"o":{"p":{"a"}}} gives ("o","p",<set>,"a"),
+    {"o":{"p":["a","b"]}} gives ("o","p",<list 0>,"a") and ("o","p",<list 1>,"b"),
+    and {"o":{}} gives ("o",<empty dict>)
+    @param domainState: the dict containing the objects and their states
+    '''
+    stack = [((), domainState)]
+    while stack:
+        (path, currentDict) = stack.pop()
+        for key in currentDict:
+            value = currentDict[key]
+            valueType = type(value)
+            if valueType == dict or valueType == OrderedDict:
+                if len(value) == 0:
+                    yield path + (key, _getFingerprintMarker("empty dict"))
+                else:
+                    stack.append((path + (key,), value))
+            elif valueType == list or valueType == tuple or valueType == set or valueType == frozenset:
+                kind = valueType.__name__
+                if len(value) == 0:
+                    yield path + (key, _getFingerprintMarker("empty " + kind))
+                elif valueType == list or valueType == tuple:
+                    for (marker, unit) in zip(_getPositionMarkers(kind, len(value)), value):
+                        yield path + (key, marker, unit)
+                else:
+                    marker = _getFingerprintMarker(kind)
+                    for unit in value:
+                        yield path + (key, marker, unit)
+            else:
+                yield path + (key,value)
+
+def _getAtomKey(atom):
+    '''!@brief the zobrist key of an atom. It is derived from the atom itself (not random.seed),
+    so the fingerprints are the same across runs and processes.
+    1, 1.0 and True are equal (and hash the same) but have different reprs, so different keys.
+    An atom of only str parts (and markers, equal only to themselves) is its own cache key,
+    the others are cached with the types of their parts
+    '''
+    cacheKey = atom
+    if type(atom) == tuple:
+        for part in atom:
+            if type(part) != str and type(part) != _FingerprintMarker:
+                partTypes = tuple(map(type, atom))
+                if tuple in partTypes or frozenset in partTypes: #their own parts could be equal but of other types
+                    cacheKey = repr(atom)
+                else:
+                    cacheKey = (partTypes, atom)
+                break
+    else:
+        cacheKey = (type(atom), atom)
+    try:
+        return _atomKeyCache[cacheKey]
+    except KeyError:
+        key = int(hashlib.md5(repr(atom).encode("utf-8")).hexdigest(), 16)
+        _atomKeyCache[cacheKey] = key
+        return key
+    except TypeError: # unhashable value in the atom (eg: a dict inside a list), cannot cache
+        return int(hashlib.md5(repr(atom).encode("utf-8")).hexdigest(), 16)
+
+def getStateFingerprint(domainState, bits = 64):
+    '''!@brief fixed width, canonical fingerprint of the state dict, to be used as the key of
+    visited/closed sets instead of getSingleStringRepresentationOfState.
+    It is the sum (mod 2^bits) of the keys of all the atoms (see iterFingerprintAtoms), so the order
+    of the keys does not matter, and flipping atoms only needs updateStateFingerprint, not a recompute.
+    Two states that are not equal get the same fingerprint only by a collision of the sums
+    (probability about 2^-bits per pair), except for the cases listed in iterFingerprintAtoms.
+    @param domainState: the dict containing the objects and their states
+    @param bits: 64 or 128 (any value upto 128 works)
+    @return the fingerprint as an int
+    '''
+    fingerprint = 0
+    for atom in iterFingerprintAtoms(domainState):
+        fingerprint += _getAtomKey(atom)
+    return fingerprint & ((1 << bits) - 1)
+
+def updateStateFingerprint(fingerprint, removedAtoms = (), addedAtoms = (), bits = 64):
+    '''!@brief incrementally updates a fingerprint from getStateFingerprint in O(changed atoms)
+    @param removedAtoms: atoms (as given by iterFingerprintAtoms) that are no longer true
+    @param addedAtoms: atoms that are now true
+    @return the new fingerprint
+    '''
+    for atom in removedAtoms:
+        fingerprint -= _getAtomKey(atom)
+    for atom in addedAtoms:
+        fingerprint += _getAtomKey(atom)
+    return fingerprint & ((1 << bits) - 1)
+
+#============================================================================================
+class RenderCache(object):
+    '''
+    @summary: bounded LRU memoization of getSingleStringRepresentationOfState and
+    getLayeredStringFormOfDataStructure, for the states that cannot change: a PersistentDict
+    (looked up by identity), a State (by equality) and a HashedTree (by its root digest, which
+    is kept up to date by setValue/deleteValue, and shared by its copies). Looking one up is O(1)
+    (after the HashedTree's digests are computed once). A hit returns the render of an equal state,
+    which may list the values of a set in another order than this one would.
+    NOTE: ONLY these three types are cached. A plain dict (or OrderedDict, or anything else) is
+    rendered again on every call, never cached, and counted in the uncacheable stat. It can change in
+    place, so it cannot be keyed by identity, and keying it by its content costs more than rendering
+    it (getStateFingerprint of 94k atoms took 0.18s, the renders 0.11s). Convert a state that is
+    rendered many times with PersistentDict.fromDict, State.fromDict or HashedTree first.
+    Entries are evicted, least recently used first, when the renders and the keys exceed maxBytes
+    or there are more than maxEntries. The cached PersistentDicts (so their ids stay valid) and
+    States are kept alive by the cache.
+    NOTE: not thread safe, use one cache per thread.
+    '''
+
+    def __init__(self, maxBytes = 64 * 1024 * 1024, maxEntries = None):
+        self.maxBytes = maxBytes
+        self.maxEntries = maxEntries
+        self._entries = OrderedDict() # key -> (render, size in bytes, the PersistentDict to keep its id valid)
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.uncacheable = 0
+
+    def getSingleStringRepresentationOfState(self, domainState):
+        return self._getRender("single", None, domainState)
+
+    def getLayeredStringFormOfDataStructure(self, dataStruct, spacer = "+"):
+        '''
+        @return: a new list every time, the cached one is not handed out
+        '''
+        return list(self._getRender("layered", spacer, dataStruct))
+
+    def _getRender(self, renderKind, spacer, dataStruct):
+        structType = type(dataStruct)
+        if structType == PersistentDict:
+            key = (renderKind, spacer, "identity", id(dataStruct))
+            keySize = sys.getsizeof(key)
+        elif structType == State:
+            key = (renderKind, spacer, dataStruct)
+            keySize = sys.getsizeof(key) + sys.getsizeof(dataStruct.atomIds)
+        elif structType == HashedTree:
+            key = (renderKind, spacer, "digest", dataStruct.getDigest())
+            keySize = sys.getsizeof(key)
+        else: #a mutable structure, render without caching
+            self.uncacheable += 1
+            return self._render(renderKind, spacer, dataStruct)
+        try:
+            entry = self._entries.pop(key)
+            self._entries[key] = entry # most recently used is last
+            self.hits += 1
+            return entry[0]
+        except KeyError:
+            pass
+        self.misses += 1
+        render = self._render(renderKind, spacer, dataStruct)
+        if renderKind == "single":
+            size = keySize + sys.getsizeof(render)
+        else:
+            size = keySize + sys.getsizeof(render) + sum([sys.getsizeof(line) for line in render])
+        if size > self.maxBytes:
+            return render
+        self._entries[key] = (render, size, dataStruct if structType == PersistentDict else None)
+        self._bytes += size
+        while self._bytes > self.maxBytes or (self.maxEntries != None and len(self._entries) > self.maxEntries):
+            (evictedKey, evictedEntry) = self._entries.popitem(last = False)
+            self._bytes -= evictedEntry[1]
+            self.evictions += 1
+        return render
+
+    def _render(self, renderKind, spacer, dataStruct):
+        if type(dataStruct) == PersistentDict or type(dataStruct) == State:
+            dataStruct = dataStruct.toDict()
+        elif type(dataStruct) == HashedTree:
+            dataStruct = dataStruct.data
+        if renderKind == "single":
+            return getSingleStringRepresentationOfState(dataStruct)
+        return getLayeredStringFormOfDataStructure(dataStruct, spacer)
+
+    def clear(self):
+        self._entries.clear()
+        self._bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def getStats(self):
+        '''
+        @return: dict with hits, misses, evictions, uncacheable (renders of mutable dicts),
+        entries and bytes (of the cached renders and their keys)
+        '''
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "uncacheable": self.uncacheable, "entries": len(self._entries), "bytes": self._bytes}
+
+#============================================================================================
 def flattenList(compoundList):
     '''!@brief:takes arbitrarily compound list to flatten
     can be a list of lists, or a list of lists of lists.
     @return: a flat list with all the entries from the container lists
     '''
-    #change the implementation in python 3.0 as the compiler.ast is not supported(I think)
-    return flatten(compoundList)
+    return list(iterFlatten(compoundList))
+
+def iterFlatten(compoundList):
+    '''!@brief: generator form of flattenList, yields the entries one at a time.
+    Lists and tuples inside are flattened (same as the old compiler.ast.flatten), and an explicit
+    stack is used, so any depth of nesting works without hitting the recursion limit
+    '''
+    stack = [iter(compoundList)]
+    while stack:
+        for entry in stack[-1]:
+            if type(entry) == list or type(entry) == tuple:
+                stack.append(iter(entry))
+                break #continue with the inner list, this one is resumed after it
+            yield entry
+        else: #this list is done
+            stack.pop()
 
 
 def returnIntersectionOfFlatStructures(listA,listB):
@@ -195,7 +690,10 @@ def differenceInCompoundStructure(structureBefore,structureAfter):
     At each matching level, they must be of the same types. 
     If at a matching level (eg: two dicts), there are different values, 
     then that value and all subsequent values are returned as a diff
+    If both are HashedTrees, the unchanged branches are skipped
     '''    
+    if type(structureBefore) == HashedTree and type(structureAfter) == HashedTree:
+        return _getDifferenceOfHashedTrees(structureBefore, structureAfter, structureBefore.data, structureAfter.data)
     diffStructure = None;    
     try:
         if type(structureBefore) == dict:
@@ -207,7 +705,7 @@ def differenceInCompoundStructure(structureBefore,structureAfter):
                     #go recursively in, at each level return only the diffs, or 0 len struct
                     smallerDiff =differenceInCompoundStructure(
                                     structureBefore[keyA],structureAfter[keyA])
-                    if smallerDiff != None:
+                    if smallerDiff is not None: # not != None, that is elementwise for an array
                         if hasattr(smallerDiff,"__len__"): 
                             if len(smallerDiff) >0:
                                 diffStructure[keyA] = smallerDiff
@@ -222,7 +720,7 @@ def differenceInCompoundStructure(structureBefore,structureAfter):
                     #go recursively in, at each level return only the diffs, or 0 len struct
                     smallerDiff =differenceInCompoundStructure(
                                 structureBefore[keyA],structureAfter[keyA])
-                    if smallerDiff != None:
+                    if smallerDiff is not None: # not != None, that is elementwise for an array
                         if hasattr(smallerDiff,"__len__") and len(smallerDiff) >0:
                             diffStructure[keyA] = smallerDiff
                         else:
@@ -235,6 +733,9 @@ def differenceInCompoundStructure(structureBefore,structureAfter):
                     diffStructure.append(element)
             if type(structureAfter) == tuple:
                 diffStructure = tuple(diffStructure)
+        elif _isNumpyArray(structureBefore) or _isNumpyArray(structureAfter):
+            if not numpy.array_equal(structureBefore, structureAfter): # != is elementwise, it has no truth value
+                diffStructure = structureAfter
         else: #it is a primitive type (int or string)
             if structureBefore != structureAfter:
                 diffStructure = structureAfter
@@ -243,6 +744,103 @@ def differenceInCompoundStructure(structureBefore,structureAfter):
         pass    
     
     return diffStructure            
+
+#=====================================================================================
+_MISSING = object() # marks a key that is not in the dict, in a StatePatch
+
+class StatePatch(object):
+    '''!@brief: a reversible change between two states, made by getStatePatch(before, after).
+    apply() changes the "before" state into the "after" state IN PLACE, and undo() changes it back,
+    both in O(size of the patch). So a backtracking search can keep ONE working state and move
+    between nodes, instead of storing or deep copying a whole state per node.
+    Unlike differenceInCompoundStructure, removed keys and removed set elements are recorded.
+    NOTE: a key that is deleted and then put back by undo goes to the end of an OrderedDict
+    '''
+
+    def __init__(self, operations = None):
+        '''
+        @param operations: list of (kind, path, key, old, new). path is the tuple of keys to the
+            dict holding key. kind "setKey": old/new are the values (_MISSING if not there).
+            kind "setElements": the value is a set, old/new are the elements removed/added
+        '''
+        if operations == None:
+            operations = []
+        self.operations = operations
+
+    def __len__(self):
+        return len(self.operations)
+
+    def isEmpty(self):
+        return len(self.operations) == 0
+
+    def apply(self, state):
+        '''!@brief: changes state (equal to the "before" state) into the "after" state, in place
+        @return: the same state object
+        '''
+        for (kind, path, key, oldValue, newValue) in self.operations:
+            _applyPatchOperation(state, kind, path, key, oldValue, newValue)
+        return state
+
+    def undo(self, state):
+        '''!@brief: changes state (equal to the "after" state) back into the "before" state, in place
+        @return: the same state object
+        '''
+        for (kind, path, key, oldValue, newValue) in reversed(self.operations):
+            _applyPatchOperation(state, kind, path, key, newValue, oldValue)
+        return state
+
+    def inverted(self):
+        '''!@return: the patch that goes from "after" to "before"
+        '''
+        return StatePatch([(kind, path, key, newValue, oldValue)
+                           for (kind, path, key, oldValue, newValue) in reversed(self.operations)])
+
+def _applyPatchOperation(state, kind, path, key, oldValue, newValue):
+    container = state
+    for pathKey in path:
+        container = container[pathKey]
+    if kind == "setElements":
+        elements = container[key]
+        elements.difference_update(oldValue)
+        elements.update(newValue)
+    elif newValue is _MISSING:
+        del container[key]
+    else:
+        #a copy, so that later changes to the state never reach the values kept in the patch
+        container[key] = _deepcopy(newValue)
+
+def getStatePatch(stateBefore, stateAfter):
+    '''!@brief: the reversible StatePatch that changes stateBefore into stateAfter.
+    Both are (nested) dicts. Nested dicts are compared key by key, sets element by element,
+    and any other value that changed (lists, tuples, primitives, type changes) is replaced
+    @return: the StatePatch
+    '''
+    operations = []
+    _collectPatchOperations((), stateBefore, stateAfter, operations)
+    return StatePatch(operations)
+
+def _collectPatchOperations(path, dictBefore, dictAfter, operations):
+    for key in dictBefore:
+        if key not in dictAfter:
+            operations.append(("setKey", path, key, _deepcopy(dictBefore[key]), _MISSING))
+    for key in dictAfter:
+        valueAfter = dictAfter[key]
+        if key not in dictBefore:
+            operations.append(("setKey", path, key, _MISSING, _deepcopy(valueAfter)))
+            continue
+        valueBefore = dictBefore[key]
+        if type(valueBefore) != type(valueAfter):
+            operations.append(("setKey", path, key, _deepcopy(valueBefore), _deepcopy(valueAfter)))
+        elif type(valueBefore) == dict or type(valueBefore) == OrderedDict:
+            _collectPatchOperations(path + (key,), valueBefore, valueAfter, operations)
+        elif type(valueBefore) == set:
+            removedElements = valueBefore.difference(valueAfter)
+            addedElements = valueAfter.difference(valueBefore)
+            if len(removedElements) > 0 or len(addedElements) > 0:
+                operations.append(("setElements", path, key, removedElements, addedElements))
+        elif not valueBefore == valueAfter:
+            operations.append(("setKey", path, key, _deepcopy(valueBefore), _deepcopy(valueAfter)))
+
 #===============================================================================
 # 
 #===============================================================================
@@ -251,31 +849,7 @@ def convertFlattenedAtomListToDict(visitedAtoms, partSeparator = "+"):
     @param visitedCompleteStates: A list of states. Each state is a list of atoms
     @return : A dict mapping obj -> properties -> SET of values
     '''
-    
-    returnDict = {}
-    for atom in visitedAtoms:
-        #split the atom into the object, prop, and value
-        [obj,prop,value] = atom.split(partSeparator)
-        try:
-            if type(value) == list or type(value) ==  tuple:
-                for unit in value:
-                    returnDict[obj][prop].add(unit)
-            else: #it is a single primitive value,
-                returnDict[obj][prop].add(value)                    
-        except:
-            if not obj in returnDict.keys():
-                returnDict[obj] = {}
-                returnDict[obj][prop] = set()
-            elif not prop in returnDict[obj].keys():
-                returnDict[obj][prop] = set()
-            #now we added the key entries, add the value
-            if type(value) == list or type(value) == tuple:
-                for unit in value:
-                    returnDict[obj][prop].add(unit)
-            else: # it is a single primitive value
-                returnDict[obj][prop].add(value)
-    #---END FOR loop through the atoms in the complete state
-    return returnDict
+    return convertFlattenedAtomListToDictBulk(visitedAtoms, partSeparator, "set")
 
 
 #===============================================================================
@@ -284,37 +858,9 @@ def convertFlattenedAtomListToDict(visitedAtoms, partSeparator = "+"):
 def convertFlattenedAtomListToDict_ver2(visitedAtoms, partSeparator = "+"):
     '''
     @param visitedCompleteStates: A list of states. Each state is a list of atoms
-    @return : A dict mapping obj -> properties -> SET of values
+    @return : A dict mapping obj -> properties -> LIST of unique values
     '''
-    
-    returnDict = {}
-    for atom in visitedAtoms:
-        #split the atom into the object, prop, and value
-        [obj,prop,value] = atom.split(partSeparator)
-        try:
-            if type(value) == list or type(value) ==  tuple:
-                for unit in value:                    
-                    returnDict[obj][prop].append(unit)
-                    returnDict[obj][prop] = list(set(returnDict[obj][prop]))
-            else: #it is a single primitive value,
-                returnDict[obj][prop].append(value)
-                returnDict[obj][prop] = list(set(returnDict[obj][prop]))                    
-        except:
-            if not obj in returnDict.keys():
-                returnDict[obj] = {}
-                returnDict[obj][prop] = []
-            elif not prop in returnDict[obj].keys():
-                returnDict[obj][prop] = []
-            #now we added the key entries, add the value
-            if type(value) == list or type(value) == tuple:
-                for unit in value:
-                    returnDict[obj][prop].append(unit)
-                    returnDict[obj][prop] = list(set(returnDict[obj][prop]))
-            else: # it is a single primitive value
-                returnDict[obj][prop].append(value)
-                returnDict[obj][prop] = list(set(returnDict[obj][prop]))                
-    #---END FOR loop through the atoms in the complete state
-    return returnDict
+    return convertFlattenedAtomListToDictBulk(visitedAtoms, partSeparator, "uniqueList")
 
 #===============================================================================
 # 
@@ -322,21 +868,9 @@ def convertFlattenedAtomListToDict_ver2(visitedAtoms, partSeparator = "+"):
 def convertFlattenedAtomListToDict_ver3(visitedAtoms, partSeparator = "+"):
     '''
     @param visitedCompleteStates: A list of states. Each state is a list of atoms
-    @return : A dict mapping obj -> properties -> SET of values
+    @return : A dict mapping obj -> properties -> single value (the last one in the list)
     '''
-    
-    returnDict = {}
-    for atom in visitedAtoms:
-        #split the atom into the object, prop, and value
-        [obj,prop,value] = atom.split(partSeparator)
-        try:
-            returnDict[obj][prop] = value                                
-        except:
-            if not obj in returnDict.keys():
-                returnDict[obj] = {}                
-            returnDict[obj][prop] = value                     
-    #---END FOR loop through the atoms in the complete state
-    return returnDict
+    return convertFlattenedAtomListToDictBulk(visitedAtoms, partSeparator, "single")
 
 #===============================================================================
 # 
@@ -345,55 +879,1303 @@ def convertFlattenedAtomListToDict_ver3(visitedAtoms, partSeparator = "+"):
 def convertFlattenedAtomStringListToDictWithListValues(visitedAtoms, partSeparator = "+"):
     '''
     @param visitedCompleteStates: A list of states. Each state is a list of atoms
-    @return : A dict mapping obj -> properties -> SET of values
+    @return : A dict mapping obj -> properties -> LIST of values, in order and with duplicates
     '''
-    
+    return convertFlattenedAtomListToDictBulk(visitedAtoms, partSeparator, "list")
+
+#===============================================================================
+# 
+#===============================================================================
+
+def convertFlattenedAtomListToDictBulk(visitedAtoms, partSeparator = "+", valueMode = "set"):
+    '''
+    @summary: converts a whole list of "obj+prop+value" atoms in one linear pass. Except for the
+    "list" mode, only the distinct atom strings are split, so long traces with repeated atoms mostly
+    cost a hash lookup per atom. The objs and props are in the order they are first seen, as with the
+    older converters. A NumPy string array is also accepted (it is converted with one tolist() call, grouping
+    by hashing the python strings was faster than numpy.unique's sort of the string array).
+    @param visitedAtoms: list (or any iterable, or NumPy array) of atom strings, or a State
+    @param valueMode: the shape of the values, the same as the older converters
+        "set" -> SET of values (convertFlattenedAtomListToDict)
+        "uniqueList" -> LIST of unique values (convertFlattenedAtomListToDict_ver2)
+        "single" -> the last value seen for the prop (convertFlattenedAtomListToDict_ver3)
+        "list" -> LIST of all values in order, with duplicates (convertFlattenedAtomStringListToDictWithListValues)
+    @return : A dict mapping obj -> properties -> values
+    '''
+    if numpy != None and isinstance(visitedAtoms, numpy.ndarray):
+        visitedAtoms = visitedAtoms.ravel().tolist()
+    elif type(visitedAtoms) == State:
+        visitedAtoms = visitedAtoms.toAtomList(partSeparator)
     returnDict = {}
-    for atom in visitedAtoms:
-        #split the atom into the object, prop, and value
-        [obj,prop,value] = atom.split(partSeparator)
-        try:
-            if type(value) == list or type(value) ==  tuple:
-                for unit in value:
-                    returnDict[obj][prop].append(unit)
-            else: #it is a single primitive value,
-                returnDict[obj][prop].append(value)                    
-        except:
-            if not obj in returnDict.keys():
-                returnDict[obj] = {}
-                returnDict[obj][prop] = list()
-            elif not prop in returnDict[obj].keys():
-                returnDict[obj][prop] = list()
-            #now we added the key entries, add the value
-            if type(value) == list or type(value) == tuple:
-                for unit in value:
-                    returnDict[obj][prop].append(unit)
-            else: # it is a single primitive value
+    if valueMode == "set" or valueMode == "uniqueList":
+        #only the distinct atoms need to be split (in the order they are first seen)
+        for atom in OrderedDict.fromkeys(visitedAtoms):
+            [obj,prop,value] = atom.split(partSeparator)
+            try:
+                propDict = returnDict[obj]
+            except KeyError:
+                propDict = returnDict[obj] = {}
+            try:
+                propDict[prop].add(value)
+            except KeyError:
+                propDict[prop] = set([value])
+        if valueMode == "uniqueList":
+            for propDict in returnDict.values():
+                for prop in propDict:
+                    propDict[prop] = list(propDict[prop])
+    elif valueMode == "single":
+        #forward pass, the last value overwrites. Splitting a short string is cheaper than caching it
+        for atom in visitedAtoms:
+            [obj,prop,value] = atom.split(partSeparator)
+            try:
+                returnDict[obj][prop] = value
+            except KeyError:
+                returnDict[obj] = {prop: value}
+    elif valueMode == "list":
+        #every occurrence is needed, in order. Splitting a short string is cheaper than caching it
+        for atom in visitedAtoms:
+            [obj,prop,value] = atom.split(partSeparator)
+            try:
                 returnDict[obj][prop].append(value)
-    #---END FOR loop through the atoms in the complete state
+            except KeyError:
+                returnDict.setdefault(obj, {})[prop] = [value]
+    else:
+        raise ValueError("unknown valueMode " + str(valueMode))
     return returnDict
 
+#===============================================================================
+# 
+#===============================================================================
+
+class AtomTable(object):
+    '''!@brief interns each (obj,prop,value) atom to a dense integer id ONCE, so that a
+    state can be kept as a sorted array of its atom ids, or as a bitset (a python int where
+    bit i is set if atom i is true), instead of a dict of sets.
+    The sorted id array is the form for sparse states (a few atoms of a large table): its size
+    and the cost of containsAtom (a binary search) do not grow with the table.
+    The bitset costs table size / 8 bytes whatever the state, but union, intersection and equality
+    of two states are then plain int operations (&, |, ==).
+    The decode methods and containsAtom accept either form.
+    The same table must be used for all the states that are compared with each other.
+    '''
+
+    def __init__(self, partSeparator = "+"):
+        '''
+        @param partSeparator: the separator used in the "obj+prop+value" atom strings
+        '''
+        self.partSeparator = partSeparator
+        self._atomToId = {} # (obj,prop,value) -> id
+        self._atomStringToId = {} # "obj+prop+value" -> id, so each string is split only once
+        self._idToAtom = [] # id -> (obj,prop,value)
+
+    def __len__(self):
+        return len(self._idToAtom)
+
+    def internAtom(self, obj, prop, value):
+        '''!@brief returns the id of the atom, adding it to the table if it is new
+        '''
+        atom = (obj,prop,value)
+        try:
+            return self._atomToId[atom]
+        except KeyError:
+            atomId = len(self._idToAtom)
+            self._atomToId[atom] = atomId
+            self._idToAtom.append(atom)
+            return atomId
+
+    def internAtomString(self, atomString):
+        '''!@brief same as internAtom, but for an "obj+prop+value" string
+        '''
+        try:
+            return self._atomStringToId[atomString]
+        except KeyError:
+            [obj,prop,value] = atomString.split(self.partSeparator)
+            atomId = self.internAtom(obj, prop, value)
+            self._atomStringToId[atomString] = atomId
+            return atomId
+
+    def getAtomId(self, obj, prop, value):
+        '''!@return the id of the atom, or None if it was never interned. Does NOT add it
+        '''
+        return self._atomToId.get((obj,prop,value))
+
+    def getAtom(self, atomId):
+        '''!@return the (obj,prop,value) tuple for the id
+        '''
+        return self._idToAtom[atomId]
+
+    def encodeAtomList(self, visitedAtoms):
+        '''!@brief converts a list of "obj+prop+value" strings into a bitset state
+        '''
+        return self.idArrayToBitset(set([self.internAtomString(atomString) for atomString in visitedAtoms]))
+
+    def encodeAtomListToIdArray(self, visitedAtoms):
+        '''!@brief converts a list of "obj+prop+value" strings into a sorted id array state
+        '''
+        return array('l', sorted(set([self.internAtomString(atomString) for atomString in visitedAtoms])))
+
+    def encodeDict(self, stateDict):
+        '''!@brief converts a dict of obj -> prop -> value (or list,tuple,set of values)
+        into a bitset state, i.e. the shapes returned by the convertFlattenedAtomListToDict family
+        '''
+        return self.idArrayToBitset(set(self._iterDictAtomIds(stateDict)))
+
+    def encodeDictToIdArray(self, stateDict):
+        '''!@brief same as encodeDict, but returns a sorted id array state
+        '''
+        return array('l', sorted(set(self._iterDictAtomIds(stateDict))))
+
+    def _iterDictAtomIds(self, stateDict):
+        for obj in stateDict:
+            for prop in stateDict[obj]:
+                value = stateDict[obj][prop]
+                if type(value) == list or type(value) == tuple or type(value) == set:
+                    for unit in value:
+                        yield self.internAtom(obj, prop, unit)
+                else: #it is a single primitive value
+                    yield self.internAtom(obj, prop, value)
+
+    def containsAtom(self, atomSet, obj, prop, value):
+        '''!@return True if the atom is in the state
+        @param atomSet: a sorted id array (binary search), or a bitset (shifting it costs
+            O(table size), so prefer the id array for repeated lookups in sparse states)
+        '''
+        atomId = self._atomToId.get((obj,prop,value))
+        if atomId == None:
+            return False
+        if isinstance(atomSet, (int, type(1 << 64))): # type(1 << 64) is long in python 2
+            return (atomSet >> atomId) & 1 == 1
+        position = bisect.bisect_left(atomSet, atomId)
+        return position < len(atomSet) and atomSet[position] == atomId
+
+    def iterAtomIds(self, bitset):
+        '''!@brief yields the ids of the atoms set in the bitset, in increasing order
+        '''
+        #one C level conversion to a (reversed) bit string, so the index of a char is the atom id
+        bitString = bin(bitset)[:1:-1]
+        atomId = bitString.find("1")
+        while atomId != -1:
+            yield atomId
+            atomId = bitString.find("1", atomId + 1)
+
+    def bitsetToIdArray(self, bitset):
+        '''!@return the sorted atom ids of the bitset as a compact array of ints
+        '''
+        return array('l', self.iterAtomIds(bitset))
+
+    def idArrayToBitset(self, idArray):
+        '''!@return the bitset for an iterable of atom ids. The bits are set in a bytearray
+        and converted to an int in one step (or-ing 1 << id into an int copies it every time)
+        '''
+        if type(idArray) != list and type(idArray) != set and type(idArray) != array:
+            idArray = list(idArray)
+        if len(idArray) == 0:
+            return 0
+        bitBytes = bytearray((max(idArray) >> 3) + 1)
+        for atomId in idArray:
+            bitBytes[atomId >> 3] |= 1 << (atomId & 7)
+        if hasattr(int, "from_bytes"):
+            return int.from_bytes(bytes(bitBytes), "little")
+        bitBytes.reverse() # python 2, through a big endian hex string
+        return int(binascii.hexlify(bitBytes), 16)
+
+    def _iterIdsOf(self, atomSet):
+        if isinstance(atomSet, (int, type(1 << 64))): # type(1 << 64) is long in python 2
+            return self.iterAtomIds(atomSet)
+        return atomSet # a sorted id array
+
+    def decodeToAtomList(self, atomSet):
+        '''!@return the list of "obj+prop+value" strings of the state (a bitset or a sorted id array)
+        '''
+        separator = self.partSeparator
+        return [separator.join(self._idToAtom[atomId]) for atomId in self._iterIdsOf(atomSet)]
+
+    def decodeToDict(self, atomSet, valueContainer = set):
+        '''!@brief converts the state (a bitset or a sorted id array) back to the dict shapes of the converters
+        @param valueContainer: set -> same as convertFlattenedAtomListToDict
+            list -> same as convertFlattenedAtomListToDict_ver2
+            None -> same as convertFlattenedAtomListToDict_ver3 (single value, if there are
+            many values for a prop, the one interned last is kept)
+        @return : A dict mapping obj -> properties -> values
+        '''
+        returnDict = {}
+        for atomId in self._iterIdsOf(atomSet):
+            (obj,prop,value) = self._idToAtom[atomId]
+            try:
+                propDict = returnDict[obj]
+            except KeyError:
+                propDict = returnDict[obj] = {}
+            if valueContainer == None:
+                propDict[prop] = value
+            elif valueContainer == set:
+                propDict.setdefault(prop, set()).add(value)
+            else:
+                propDict.setdefault(prop, []).append(value) # ids are unique, so no duplicates
+        return returnDict
+
 
 #===============================================================================
 # 
 #===============================================================================
 
-def pickleListOfObjects(pickleFolder, pickleFileName, listOfObjects):
+_defaultAtomTable = AtomTable() # shared by every State that is not given its own table
+
+class State(object):
+    '''
+    @summary: compact, immutable and hashable planning state of obj -> prop -> set of values.
+    Every (obj,prop,value) fluent is interned ONCE in an AtomTable and the state only keeps the
+    sorted array of its atom ids (a machine int per fluent), instead of nested dicts of sets of
+    strings. Equality and hashing compare the id arrays, so States can be keys of visited sets.
+    getIntersectionOfDicts, getDifferenceOfDicts, filterDict and the convertFlattenedAtomListToDict
+    family accept a State directly.
+    NOTE: a State has no empty entries, an obj/prop with no values is simply not in it, so where
+    the dict functions return a prop mapped to an empty set, the State version drops the prop
+    (and with allowMissing, an empty prop of the compared State counts as missing).
+    States made with different tables are never equal.
+    '''
+    __slots__ = ("_table", "_atomIds", "_hash")
+
+    def __init__(self, atomIds = (), table = None):
+        '''
+        @param atomIds: ids of the atoms in the table (any order, duplicates are dropped)
+        @param table: the AtomTable of the ids, default is the shared module table
+        '''
+        if table == None:
+            table = _defaultAtomTable
+        object.__setattr__(self, "_table", table)
+        object.__setattr__(self, "_atomIds", array('l', sorted(set(atomIds))))
+        object.__setattr__(self, "_hash", None)
+
+    @classmethod
+    def _fromSortedIds(cls, atomIds, table):
+        newState = cls.__new__(cls)
+        object.__setattr__(newState, "_table", table)
+        object.__setattr__(newState, "_atomIds", atomIds)
+        object.__setattr__(newState, "_hash", None)
+        return newState
+
+    @classmethod
+    def fromDict(cls, stateDict, table = None):
+        '''
+        @param stateDict: dict of obj -> prop -> value (or list,tuple,set of values), eg: from convertFlattenedAtomListToDict
+        '''
+        if table == None:
+            table = _defaultAtomTable
+        atomIds = set()
+        for obj in stateDict:
+            for prop in stateDict[obj]:
+                value = stateDict[obj][prop]
+                if type(value) == list or type(value) == tuple or type(value) == set:
+                    for unit in value:
+                        atomIds.add(table.internAtom(obj, prop, unit))
+                else: #it is a single primitive value
+                    atomIds.add(table.internAtom(obj, prop, value))
+        return cls._fromSortedIds(array('l', sorted(atomIds)), table)
+
+    @classmethod
+    def fromAtomList(cls, visitedAtoms, table = None):
+        '''
+        @param visitedAtoms: list of "obj+prop+value" strings (split with the table's partSeparator)
+        '''
+        if table == None:
+            table = _defaultAtomTable
+        return cls._fromSortedIds(array('l', sorted(set([table.internAtomString(atom) for atom in visitedAtoms]))), table)
+
+    def toDict(self, valueContainer = set):
+        '''
+        @param valueContainer: set, list, or None for single values (see AtomTable.decodeToDict)
+        @return: a new dict of obj -> prop -> values
+        '''
+        returnDict = {}
+        idToAtom = self._table._idToAtom
+        for atomId in self._atomIds:
+            (obj,prop,value) = idToAtom[atomId]
+            try:
+                propDict = returnDict[obj]
+            except KeyError:
+                propDict = returnDict[obj] = {}
+            if valueContainer == None:
+                propDict[prop] = value
+            elif valueContainer == set:
+                propDict.setdefault(prop, set()).add(value)
+            else:
+                propDict.setdefault(prop, []).append(value)
+        return returnDict
+
+    def toAtomList(self, partSeparator = None):
+        '''
+        @return: the list of "obj+prop+value" strings, in atom id order
+        '''
+        if partSeparator == None:
+            partSeparator = self._table.partSeparator
+        idToAtom = self._table._idToAtom
+        return [partSeparator.join([str(part) for part in idToAtom[atomId]]) for atomId in self._atomIds]
+
+    @property
+    def table(self):
+        return self._table
+
+    @property
+    def atomIds(self):
+        '''
+        @return: the sorted array of atom ids. It is the state's own array, do not modify it
+        '''
+        return self._atomIds
+
+    def getObjects(self):
+        '''
+        @return: the set of objs that have at least one fluent
+        '''
+        idToAtom = self._table._idToAtom
+        return set([idToAtom[atomId][0] for atomId in self._atomIds])
+
+    def getObjectProperties(self):
+        '''
+        @return: the set of (obj,prop) pairs that have at least one value
+        '''
+        idToAtom = self._table._idToAtom
+        return set([idToAtom[atomId][:2] for atomId in self._atomIds])
+
+    def __len__(self):
+        return len(self._atomIds)
+
+    def __iter__(self):
+        '''
+        @summary: yields the (obj,prop,value) atoms
+        '''
+        idToAtom = self._table._idToAtom
+        for atomId in self._atomIds:
+            yield idToAtom[atomId]
+
+    def __contains__(self, atom):
+        atomId = self._table._atomToId.get(tuple(atom))
+        if atomId == None:
+            return False
+        position = bisect.bisect_left(self._atomIds, atomId)
+        return position < len(self._atomIds) and self._atomIds[position] == atomId
+
+    def __eq__(self, other):
+        if type(other) != State:
+            return NotImplemented
+        return self._table is other._table and self._atomIds == other._atomIds
+
+    def __ne__(self, other):
+        isEqual = self.__eq__(other)
+        if isEqual is NotImplemented:
+            return isEqual
+        return not isEqual
+
+    def __hash__(self):
+        if self._hash == None:
+            object.__setattr__(self, "_hash", hash(tuple(self._atomIds)))
+        return self._hash
+
+    def __setattr__(self, name, value):
+        raise AttributeError("State is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("State is immutable")
+
+    def __reduce__(self):
+        #the ids are only valid in this process, so the atoms are pickled, and re-interned in the default table on load
+        return (_stateFromAtoms, (list(self),))
+
+    def __repr__(self):
+        return "State(" + repr(self.toDict()) + ")"
+
+    def intersection(self, other):
+        return self._withIds(set(self._atomIds).intersection(other._atomIds), other)
+
+    def union(self, other):
+        return self._withIds(set(self._atomIds).union(other._atomIds), other)
+
+    def difference(self, other):
+        return self._withIds(set(self._atomIds).difference(other._atomIds), other)
+
+    def _withIds(self, atomIds, other):
+        if other._table is not self._table:
+            raise ValueError("the States use different AtomTables")
+        return State._fromSortedIds(array('l', sorted(atomIds)), self._table)
+
+    def _filterAtoms(self, keepAtom):
+        idToAtom = self._table._idToAtom
+        return State._fromSortedIds(array('l', [atomId for atomId in self._atomIds if keepAtom(idToAtom[atomId])]), self._table)
+
+def _stateFromAtoms(atoms):
+    table = _defaultAtomTable
+    return State([table.internAtom(obj, prop, value) for (obj,prop,value) in atoms], table)
+
+def _getIntersectionOfStates(sourceState, compareState, allowMissing, listOfKeysAllowed):
+    '''
+    @summary: getIntersectionOfDicts of two States with the same table
+    '''
+    if allowMissing == False and listOfKeysAllowed == []:
+        return sourceState.intersection(compareState)
+    compareObjects = compareState.getObjects()
+    compareObjectProperties = compareState.getObjectProperties()
+    compareIds = set(compareState.atomIds)
+    def keepAtom(atom):
+        if listOfKeysAllowed != [] and atom[0] not in listOfKeysAllowed:
+            return False
+        if atom[0] not in compareObjects or atom[:2] not in compareObjectProperties:
+            return allowMissing
+        return sourceState.table._atomToId[atom] in compareIds
+    return sourceState._filterAtoms(keepAtom)
+
+def _getDifferenceOfStates(stateA, stateB, allowMissing, allowedKeys):
+    '''
+    @summary: getDifferenceOfDicts of two States with the same table
+    '''
+    if allowMissing == True and allowedKeys == []:
+        return stateA.difference(stateB)
+    objectsOfB = stateB.getObjects()
+    idsOfB = set(stateB.atomIds)
+    def keepAtom(atom):
+        if allowedKeys != [] and atom[0] not in allowedKeys:
+            return False
+        if atom[0] not in objectsOfB:
+            return allowMissing
+        #a missing prop is always kept, the nested dicts are compared with allowMissing = True
+        return stateA.table._atomToId[atom] not in idsOfB
+    return stateA._filterAtoms(keepAtom)
+
+def _isSameTableStates(stateA, stateB):
+    return type(stateA) == State and type(stateB) == State and stateA.table is stateB.table
+
+def _stateToDict(value):
+    if type(value) == State:
+        return value.toDict()
+    return value
+
+#===============================================================================
+# 
+#===============================================================================
+
+def pickleListOfObjects(pickleFolder, pickleFileName, listOfObjects, append = False):
     '''
     @summary: Self explanatory. NOTE: if the folder is a relative path, note that it should be relative to this file
-    @todo: Improve this to allow file appends and such
+    Use iterPickledObjects to read the objects back, or PickleArchiveWriter/Reader for large streams
+    @param append: if True, the objects are added at the end of the existing file instead of replacing it
     '''
 
     if not os.path.exists(pickleFolder):
         os.makedirs(pickleFolder)
-    
-    if os.path.exists(pickleFileName):
-        os.remove(pickleFileName)
-    
-    with open(pickleFolder+pickleFileName,'wb') as pickleFile:
+
+    if not append and os.path.exists(pickleFolder+pickleFileName):
+        os.remove(pickleFolder+pickleFileName)
+
+    with open(pickleFolder+pickleFileName,'ab') as pickleFile:
         for singleObject in listOfObjects:
             pickle.dump(singleObject,pickleFile)
-            
+
+#===================================================================
+# 
+#===================================================================
+
+def iterPickledObjects(pickleFolder, pickleFileName):
+    '''
+    @summary: generator that lazily yields the objects of a file written by pickleListOfObjects
+    (or PickleArchiveWriter), one at a time, without loading the whole list
+    '''
+    with open(pickleFolder+pickleFileName,'rb') as pickleFile:
+        while True:
+            try:
+                yield pickle.load(pickleFile)
+            except EOFError:
+                break
+
+#===================================================================
+# 
+#===================================================================
+_OFFSET_FORMAT = "<Q" # each offset in the ".idx" file is an 8 byte little endian unsigned int
+_OFFSET_SIZE = struct.calcsize(_OFFSET_FORMAT)
+
+def buildPickleArchiveIndex(pickleFilePath):
+    '''
+    @summary: scans a file of consecutive pickles, and (re)writes its "<pickleFilePath>.idx" file
+    with the byte offset of every object. Used when the index is missing or stale (eg: after a crash)
+    A partially written last object (torn by a crash) is not indexed
+    @return: the list of offsets
+    '''
+    (offsets, dataEnd) = _scanPickleArchive(pickleFilePath)
+    with open(pickleFilePath + ".idx",'wb') as indexFile:
+        indexFile.write(struct.pack("<%dQ" % len(offsets), *offsets))
+    return offsets
+
+def _scanPickleArchive(pickleFilePath):
+    '''
+    @return: (the offsets of the complete objects, the byte offset where the last complete object ends)
+    '''
+    offsets = []
+    dataEnd = 0
+    with open(pickleFilePath,'rb') as pickleFile:
+        while True:
+            currentOffset = pickleFile.tell()
+            try:
+                pickle.load(pickleFile)
+            except EOFError:
+                break
+            except pickle.UnpicklingError: #truncated object at the end
+                break
+            offsets.append(currentOffset)
+            dataEnd = pickleFile.tell()
+    return (offsets, dataEnd)
+
+class PickleArchiveWriter(object):
+    '''
+    @summary: appends objects to a pickle file in batches, and records the byte offset of every
+    object in "<pickleFilePath>.idx", so that PickleArchiveReader can seek to the Nth object.
+    Objects are pickled when they are appended (so later changes to them are not recorded).
+    With backgroundThread = True the disk writes are done by a separate thread, so the caller
+    (eg: the search loop) does not block on disk I/O. Use it as a context manager or call close()
+    '''
+
+    def __init__(self, pickleFilePath, append = True, batchSize = 1000, backgroundThread = False,
+                 maxQueuedBatches = 8, protocol = pickle.HIGHEST_PROTOCOL):
+        '''
+        @param pickleFilePath: the archive file. Its folder is created if needed
+        @param append: if False, any existing archive at that path is replaced
+        @param batchSize: number of objects buffered in memory before they are written
+        @param maxQueuedBatches: bound on the batches waiting for the background thread.
+            If reached, append() blocks, so the memory used stays bounded
+        '''
+        self.pickleFilePath = pickleFilePath
+        self.batchSize = batchSize
+        self.protocol = protocol
+        pickleFolder = os.path.dirname(pickleFilePath)
+        if pickleFolder != "" and not os.path.exists(pickleFolder):
+            os.makedirs(pickleFolder)
+        if append and os.path.exists(pickleFilePath):
+            indexPath = pickleFilePath + ".idx"
+            if not os.path.exists(indexPath) or not _isPickleArchiveIndexValid(pickleFilePath):
+                dataEnd = _scanPickleArchive(pickleFilePath)[1]
+                if dataEnd < os.path.getsize(pickleFilePath): #drop the torn tail so new objects follow the last complete one
+                    with open(pickleFilePath,'r+b') as pickleFile:
+                        pickleFile.truncate(dataEnd)
+                buildPickleArchiveIndex(pickleFilePath)
+            self._nextOffset = os.path.getsize(pickleFilePath)
+            self._dataFile = open(pickleFilePath,'ab')
+            self._indexFile = open(indexPath,'ab')
+        else:
+            self._nextOffset = 0
+            self._dataFile = open(pickleFilePath,'wb')
+            self._indexFile = open(pickleFilePath + ".idx",'wb')
+        self._pickledBatch = []
+        self._offsetBatch = []
+        self._writerError = None
+        self._writerThread = None
+        if backgroundThread:
+            self._batchQueue = Queue(maxQueuedBatches)
+            self._writerThread = threading.Thread(target = self._writeQueuedBatches)
+            self._writerThread.daemon = True
+            self._writerThread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    def append(self, singleObject):
+        pickledObject = pickle.dumps(singleObject, self.protocol)
+        self._offsetBatch.append(self._nextOffset)
+        self._pickledBatch.append(pickledObject)
+        self._nextOffset += len(pickledObject)
+        if len(self._pickledBatch) >= self.batchSize:
+            self.flush()
+
+    def extend(self, listOfObjects):
+        for singleObject in listOfObjects:
+            self.append(singleObject)
+
+    def flush(self):
+        '''
+        @summary: hands the buffered objects to the file (or to the background thread)
+        '''
+        if self._writerError != None:
+            raise self._writerError
+        if len(self._pickledBatch) == 0:
+            return
+        dataBytes = b"".join(self._pickledBatch)
+        indexBytes = struct.pack("<%dQ" % len(self._offsetBatch), *self._offsetBatch)
+        self._pickledBatch = []
+        self._offsetBatch = []
+        if self._writerThread != None:
+            self._batchQueue.put((dataBytes, indexBytes))
+        else:
+            self._writeBatch(dataBytes, indexBytes)
+
+    def close(self):
+        if self._dataFile.closed:
+            return
+        try:
+            self.flush()
+        finally:
+            if self._writerThread != None:
+                self._batchQueue.put(None) # tells the thread to stop
+                self._writerThread.join()
+            self._dataFile.close()
+            self._indexFile.close()
+        if self._writerError != None:
+            raise self._writerError
+
+    def _writeBatch(self, dataBytes, indexBytes):
+        #data first, so an index entry never points past the end of the data file
+        self._dataFile.write(dataBytes)
+        self._dataFile.flush()
+        self._indexFile.write(indexBytes)
+        self._indexFile.flush()
+
+    def _writeQueuedBatches(self):
+        while True:
+            batch = self._batchQueue.get()
+            if batch == None:
+                break
+            if self._writerError != None:
+                continue # keep draining, so that a blocked append() can return
+            try:
+                self._writeBatch(batch[0], batch[1])
+            except Exception as e:
+                self._writerError = e
+
+def _isPickleArchiveIndexValid(pickleFilePath):
+    '''
+    @summary: checks that the index matches the data file, ie: the last indexed object ends exactly
+    at the end of the data. An index that is behind the data (a crash between the data write
+    and the index write) or past it is not valid. Costs one seek and loading one object
+    '''
+    indexSize = os.path.getsize(pickleFilePath + ".idx")
+    dataSize = os.path.getsize(pickleFilePath)
+    if indexSize % _OFFSET_SIZE != 0:
+        return False
+    if indexSize == 0:
+        return dataSize == 0
+    with open(pickleFilePath + ".idx",'rb') as indexFile:
+        indexFile.seek(indexSize - _OFFSET_SIZE)
+        lastOffset = struct.unpack(_OFFSET_FORMAT, indexFile.read(_OFFSET_SIZE))[0]
+    if lastOffset >= dataSize:
+        return False
+    with open(pickleFilePath,'rb') as pickleFile:
+        pickleFile.seek(lastOffset)
+        try:
+            pickle.load(pickleFile)
+        except Exception:
+            return False
+        return pickleFile.tell() == dataSize
+
+class PickleArchiveReader(object):
+    '''
+    @summary: reads an archive written by PickleArchiveWriter. Objects are yielded lazily,
+    and the Nth object is loaded with one seek using the ".idx" offsets
+    (rebuilt by scanning the file if it is missing or stale)
+    '''
+
+    def __init__(self, pickleFilePath):
+        self.pickleFilePath = pickleFilePath
+        if not os.path.exists(pickleFilePath + ".idx") or not _isPickleArchiveIndexValid(pickleFilePath):
+            self._offsets = buildPickleArchiveIndex(pickleFilePath)
+        else:
+            with open(pickleFilePath + ".idx",'rb') as indexFile:
+                indexBytes = indexFile.read()
+            self._offsets = struct.unpack("<%dQ" % (len(indexBytes)//_OFFSET_SIZE), indexBytes)
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __iter__(self):
+        return self.iterObjects()
+
+    def iterObjects(self, startIndex = 0):
+        '''
+        @summary: generator over the objects, starting at the object number startIndex
+        '''
+        if startIndex >= len(self._offsets):
+            return
+        with open(self.pickleFilePath,'rb') as pickleFile:
+            pickleFile.seek(self._offsets[startIndex])
+            for _ in range(len(self._offsets) - startIndex):
+                yield pickle.load(pickleFile)
+
+    def getNthObject(self, n):
+        with open(self.pickleFilePath,'rb') as pickleFile:
+            pickleFile.seek(self._offsets[n])
+            return pickle.load(pickleFile)
+
+#===================================================================
+# 
+#===================================================================
+_CLOSED_LIST_KEY_SIZE = 16 # bytes of a 128 bit state fingerprint
+
+class DiskBackedClosedList(object):
+    '''
+    @summary: visited (closed) set of states that does not have to fit in memory. Each state is
+    keyed by its 128 bit getStateFingerprint (the role getSingleStringRepresentationOfState
+    plays for an in memory set). New keys are kept in memory until flushThreshold of them are
+    collected, then written as a sorted, append only segment file of 16 byte keys in the folder.
+    Lookups check the in memory keys, then a Bloom filter (so most new states never touch the
+    disk), then binary search each memory mapped segment. When there are more than maxSegments
+    segments, they are merged into one (compaction), so a lookup needs few binary searches.
+    Memory is about 1.2 bytes per expected state at a 1% false positive rate, plus the unflushed keys.
+    Past expectedItems states the Bloom filter lets through more lookups (it is not resized),
+    so set it to the size of the search when that is large.
+    Reopening the same folder continues from the segments there (the Bloom filter is rebuilt).
+    NOTE: a state is taken as visited when a state with the same key was added, so a key
+    collision prunes a state that was never expanded. Among n states that are not equal, some
+    two share a key with a probability of about n^2/2^129, as a random 128 bit sum. But the
+    key does not see the order of dict keys, and OrderedDicts are keyed like dicts (see
+    iterFingerprintAtoms). A State and its toDict() have the same key.
+    '''
+
+    def __init__(self, folder, expectedItems = 1000000, falsePositiveRate = 0.01,
+                 flushThreshold = 1000000, maxSegments = 8):
+        '''
+        @param folder: where the segment files are kept, created if missing
+        @param expectedItems: the number of states the Bloom filter is sized for
+        @param falsePositiveRate: of the Bloom filter at expectedItems states
+        @param flushThreshold: number of new keys kept in memory before writing a segment
+        @param maxSegments: compact when there are more segments than this
+        '''
+        self.folder = folder
+        self.flushThreshold = flushThreshold
+        self.maxSegments = maxSegments
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        expectedItems = max(1, expectedItems)
+        self._numBloomBits = max(64, int(-expectedItems * math.log(falsePositiveRate) / (math.log(2) ** 2)))
+        self._numBloomHashes = max(1, int(round(float(self._numBloomBits) / expectedItems * math.log(2))))
+        self._bloom = bytearray((self._numBloomBits + 7) // 8)
+        self._memtable = set() # keys not yet written to a segment
+        self._segments = [] # (path, file, mmap), oldest first
+        self._count = 0
+        self._nextSegmentNumber = 0
+        segmentNames = sorted([fileName for fileName in os.listdir(folder)
+                               if fileName.startswith("segment_") and fileName.endswith(".keys")])
+        for segmentName in segmentNames:
+            self._nextSegmentNumber = int(segmentName[len("segment_"):-len(".keys")]) + 1
+            self._openSegment(os.path.join(folder, segmentName))
+            for key in self._iterSegmentKeys(self._segments[-1][2]):
+                self._addToBloom(key)
+                self._count += 1
+
+    def getKey(self, domainState):
+        '''
+        @param domainState: a state dict, PersistentDict or State, or a fingerprint (int) from getStateFingerprint(state, 128)
+        @return: the 16 byte key of the state
+        '''
+        if isinstance(domainState, (int, type(1 << 64))): # type(1 << 64) is long in python 2
+            fingerprint = domainState
+        elif type(domainState) == State:
+            fingerprint = 0
+            setMarker = _getFingerprintMarker("set")
+            for atom in domainState: # the values are in sets, as in domainState.toDict()
+                fingerprint += _getAtomKey(atom[:-1] + (setMarker, atom[-1]))
+        elif type(domainState) == PersistentDict:
+            fingerprint = getStateFingerprint(domainState.toDict(), 128)
+        else:
+            fingerprint = getStateFingerprint(domainState, 128)
+        return struct.pack(">QQ", (fingerprint >> 64) & 0xFFFFFFFFFFFFFFFF, fingerprint & 0xFFFFFFFFFFFFFFFF)
+
+    def add(self, domainState):
+        '''
+        @return: True if the state is new (and it is added), False if it was already visited
+        '''
+        key = self.getKey(domainState)
+        if self._containsKey(key):
+            return False
+        self._memtable.add(key)
+        self._addToBloom(key)
+        self._count += 1
+        if len(self._memtable) >= self.flushThreshold:
+            self.flush()
+        return True
+
+    def __contains__(self, domainState):
+        return self._containsKey(self.getKey(domainState))
+
+    def __len__(self):
+        return self._count
+
+    def _getBloomPositions(self, key):
+        (hashA, hashB) = struct.unpack(">QQ", key)
+        hashB |= 1
+        numBits = self._numBloomBits
+        return [(hashA + index * hashB) % numBits for index in range(self._numBloomHashes)]
+
+    def _addToBloom(self, key):
+        bloom = self._bloom
+        for position in self._getBloomPositions(key):
+            bloom[position >> 3] |= 1 << (position & 7)
+
+    def _containsKey(self, key):
+        if key in self._memtable:
+            return True
+        bloom = self._bloom
+        for position in self._getBloomPositions(key):
+            if not bloom[position >> 3] & (1 << (position & 7)):
+                return False
+        #---END FOR, the Bloom filter says it may be on disk
+        for (_, _, segmentMap) in reversed(self._segments):
+            if _isKeyInSegment(segmentMap, key):
+                return True
+        return False
+
+    def flush(self):
+        '''
+        @summary: writes the keys kept in memory as a new segment (and compacts if needed)
+        '''
+        if len(self._memtable) == 0:
+            return
+        segmentPath = self._writeSegment(sorted(self._memtable))
+        self._openSegment(segmentPath)
+        self._memtable = set()
+        if len(self._segments) > self.maxSegments:
+            self.compact()
+
+    def compact(self):
+        '''
+        @summary: merges all the segments into one sorted segment, streaming (heapq.merge), so the
+        memory used does not depend on the size of the segments
+        '''
+        if len(self._segments) <= 1:
+            return
+        oldSegments = self._segments
+        mergedKeys = heapq.merge(*[self._iterSegmentKeys(segmentMap) for (_, _, segmentMap) in oldSegments])
+        segmentPath = self._writeSegment(mergedKeys)
+        self._segments = []
+        for (oldPath, oldFile, oldMap) in oldSegments:
+            oldMap.close()
+            oldFile.close()
+            os.remove(oldPath)
+        self._openSegment(segmentPath)
+
+    def _writeSegment(self, sortedKeys):
+        segmentPath = os.path.join(self.folder, "segment_%08d.keys" % self._nextSegmentNumber)
+        self._nextSegmentNumber += 1
+        previousKey = None
+        with open(segmentPath + ".tmp", "wb") as segmentFile:
+            chunk = []
+            for key in sortedKeys:
+                if key != previousKey: # the segments never overlap, but stay safe when merging
+                    chunk.append(key)
+                    previousKey = key
+                    if len(chunk) >= 65536:
+                        segmentFile.write(b"".join(chunk))
+                        chunk = []
+            segmentFile.write(b"".join(chunk))
+            segmentFile.flush()
+            os.fsync(segmentFile.fileno())
+        #only a complete segment gets the name that is loaded on reopen
+        os.rename(segmentPath + ".tmp", segmentPath)
+        return segmentPath
+
+    def _openSegment(self, segmentPath):
+        segmentFile = open(segmentPath, "rb")
+        segmentMap = mmap.mmap(segmentFile.fileno(), 0, access = mmap.ACCESS_READ)
+        self._segments.append((segmentPath, segmentFile, segmentMap))
+
+    def _iterSegmentKeys(self, segmentMap):
+        keySize = _CLOSED_LIST_KEY_SIZE
+        blockSize = keySize * 65536
+        for blockStart in range(0, len(segmentMap), blockSize):
+            block = segmentMap[blockStart:blockStart + blockSize]
+            for keyStart in range(0, len(block), keySize):
+                yield block[keyStart:keyStart + keySize]
+
+    def getStats(self):
+        return {"states": self._count, "segments": len(self._segments), "unflushed": len(self._memtable),
+                "bloomBytes": len(self._bloom), "bloomHashes": self._numBloomHashes}
+
+    def close(self):
+        '''
+        @summary: flushes the keys kept in memory and closes the segment files
+        '''
+        self.flush()
+        for (_, segmentFile, segmentMap) in self._segments:
+            segmentMap.close()
+            segmentFile.close()
+        self._segments = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+        return False
+
+def _isKeyInSegment(segmentMap, key):
+    '''
+    @summary: binary search of the key in the sorted keys of a segment
+    '''
+    keySize = _CLOSED_LIST_KEY_SIZE
+    low = 0
+    high = len(segmentMap) // keySize
+    while low < high:
+        middle = (low + high) // 2
+        middleKey = segmentMap[middle * keySize:(middle + 1) * keySize]
+        if middleKey < key:
+            low = middle + 1
+        elif middleKey > key:
+            high = middle
+        else:
+            return True
+    return False
+
+#===================================================================
+# 
+#===================================================================
+_HAMT_BITS = 5 # bits of the hash used per level of the trie
+_HAMT_MASK = (1 << _HAMT_BITS) - 1
+_HAMT_HASH_BITS = 64
+
+def _popcount(bitmap):
+    return bin(bitmap).count("1")
+
+class _HamtNode(object):
+    '''
+    @summary: one level of the trie. bitmap has a bit set for each occupied slot and entries has
+    one entry per set bit, either a leaf (keyHash,key,value) tuple or a deeper node
+    '''
+    __slots__ = ("bitmap","entries")
+
+    def __init__(self, bitmap, entries):
+        self.bitmap = bitmap
+        self.entries = entries
+
+class _HamtCollisionNode(object):
+    '''
+    @summary: leaves whose keys have the exact same hash (all the hash bits are used up)
+    '''
+    __slots__ = ("entries",)
+
+    def __init__(self, entries):
+        self.entries = entries
+
+def _hamtFind(node, keyHash, key):
+    '''
+    @return: the (keyHash,key,value) leaf of the key, or None
+    '''
+    shift = 0
+    while True:
+        if type(node) == _HamtCollisionNode:
+            for entry in node.entries:
+                if entry[1] == key:
+                    return entry
+            return None
+        bit = 1 << ((keyHash >> shift) & _HAMT_MASK)
+        if not node.bitmap & bit:
+            return None
+        entry = node.entries[_popcount(node.bitmap & (bit - 1))]
+        if type(entry) == tuple:
+            if entry[0] == keyHash and entry[1] == key:
+                return entry
+            return None
+        node = entry
+        shift += _HAMT_BITS
+
+def _hamtMergeLeaves(shift, leafA, leafB):
+    '''
+    @return: the smallest subtree holding the two leaves, starting at the level "shift"
+    '''
+    if shift >= _HAMT_HASH_BITS:
+        return _HamtCollisionNode([leafA, leafB])
+    slotA = (leafA[0] >> shift) & _HAMT_MASK
+    slotB = (leafB[0] >> shift) & _HAMT_MASK
+    if slotA == slotB:
+        return _HamtNode(1 << slotA, [_hamtMergeLeaves(shift + _HAMT_BITS, leafA, leafB)])
+    if slotA < slotB:
+        return _HamtNode((1 << slotA) | (1 << slotB), [leafA, leafB])
+    return _HamtNode((1 << slotA) | (1 << slotB), [leafB, leafA])
+
+def _hamtAssoc(node, shift, keyHash, key, value):
+    '''
+    @summary: path copying insert. The node passed in is never modified, only the nodes on the
+    path to the key are copied, everything else is shared
+    @return: (newNode, True if the key was not there before). newNode is node if nothing changed
+    '''
+    if type(node) == _HamtCollisionNode:
+        entries = list(node.entries)
+        for index in range(len(entries)):
+            if entries[index][1] == key:
+                if entries[index][2] is value:
+                    return (node, False)
+                entries[index] = (keyHash, key, value)
+                return (_HamtCollisionNode(entries), False)
+        entries.append((keyHash, key, value))
+        return (_HamtCollisionNode(entries), True)
+    bit = 1 << ((keyHash >> shift) & _HAMT_MASK)
+    index = _popcount(node.bitmap & (bit - 1))
+    if not node.bitmap & bit:
+        entries = list(node.entries)
+        entries.insert(index, (keyHash, key, value))
+        return (_HamtNode(node.bitmap | bit, entries), True)
+    entry = node.entries[index]
+    if type(entry) == tuple:
+        if entry[0] == keyHash and entry[1] == key:
+            if entry[2] is value:
+                return (node, False)
+            (newEntry, added) = ((keyHash, key, value), False)
+        else:
+            (newEntry, added) = (_hamtMergeLeaves(shift + _HAMT_BITS, entry, (keyHash, key, value)), True)
+    else:
+        (newEntry, added) = _hamtAssoc(entry, shift + _HAMT_BITS, keyHash, key, value)
+        if newEntry is entry:
+            return (node, False)
+    entries = list(node.entries)
+    entries[index] = newEntry
+    return (_HamtNode(node.bitmap, entries), added)
+
+def _hamtWithout(node, shift, keyHash, key):
+    '''
+    @summary: path copying delete
+    @return: node if the key is not there, None if the node became empty, a leaf tuple if only
+    one leaf is left (so that the parent can pull it up), else the new node
+    '''
+    if type(node) == _HamtCollisionNode:
+        entries = [entry for entry in node.entries if not entry[1] == key]
+        if len(entries) == len(node.entries):
+            return node
+        if len(entries) == 1:
+            return entries[0]
+        return _HamtCollisionNode(entries)
+    bit = 1 << ((keyHash >> shift) & _HAMT_MASK)
+    if not node.bitmap & bit:
+        return node
+    index = _popcount(node.bitmap & (bit - 1))
+    entry = node.entries[index]
+    if type(entry) == tuple:
+        if not (entry[0] == keyHash and entry[1] == key):
+            return node
+        newEntry = None
+    else:
+        newEntry = _hamtWithout(entry, shift + _HAMT_BITS, keyHash, key)
+        if newEntry is entry:
+            return node
+    entries = list(node.entries)
+    if newEntry == None:
+        del entries[index]
+        bitmap = node.bitmap ^ bit
+    else:
+        entries[index] = newEntry
+        bitmap = node.bitmap
+    if len(entries) == 0:
+        return None
+    if len(entries) == 1 and type(entries[0]) == tuple:
+        return entries[0]
+    return _HamtNode(bitmap, entries)
+
+class PersistentDict(object):
+    '''
+    @summary: immutable (persistent) hash array mapped trie with a read only dict interface.
+    set/delete/update return a NEW PersistentDict that shares every unchanged part with the old
+    one, so a change costs O(log n) instead of a deepcopy of the whole dict.
+    Use PersistentDict.fromDict to convert a nested state dict (every level becomes a
+    PersistentDict), and toDict to convert back. updateAndReturnDict and getIntersectionOfDicts
+    accept and return it. NOTE: the values (lists, sets) are shared between versions, so they
+    must be treated as read only. The iteration order is the hash order, not the insertion order.
+    '''
+
+    def __init__(self, mapping = None):
+        self._root = _HamtNode(0, [])
+        self._size = 0
+        if mapping != None:
+            for key in mapping.keys():
+                self._addInPlace(key, mapping[key])
+
+    @classmethod
+    def _fromRoot(cls, root, size):
+        newDict = cls.__new__(cls)
+        newDict._root = root
+        newDict._size = size
+        return newDict
+
+    @classmethod
+    def fromDict(cls, nestedDict):
+        '''
+        @summary: converts a nested dict, every nested dict (or OrderedDict) also becomes a PersistentDict
+        '''
+        newDict = cls()
+        for key in nestedDict.keys():
+            value = nestedDict[key]
+            if type(value) == dict or type(value) == OrderedDict:
+                value = cls.fromDict(value)
+            newDict._addInPlace(key, value)
+        return newDict
+
+    def _addInPlace(self, key, value):
+        #only used while constructing, before anyone else can see this object
+        (self._root, added) = _hamtAssoc(self._root, 0, hash(key) & 0xFFFFFFFFFFFFFFFF, key, value)
+        if added:
+            self._size += 1
+
+    def toDict(self):
+        '''
+        @return: a nested dict (new dicts, the leaf values are shared)
+        '''
+        returnDict = {}
+        for (key, value) in self.items():
+            if type(value) == PersistentDict:
+                value = value.toDict()
+            returnDict[key] = value
+        return returnDict
+
+    def set(self, key, value):
+        (newRoot, added) = _hamtAssoc(self._root, 0, hash(key) & 0xFFFFFFFFFFFFFFFF, key, value)
+        if newRoot is self._root:
+            return self
+        return PersistentDict._fromRoot(newRoot, self._size + (1 if added else 0))
+
+    def delete(self, key):
+        keyHash = hash(key) & 0xFFFFFFFFFFFFFFFF
+        newRoot = _hamtWithout(self._root, 0, keyHash, key)
+        if newRoot is self._root:
+            raise KeyError(key)
+        if newRoot == None:
+            newRoot = _HamtNode(0, [])
+        elif type(newRoot) == tuple: # a single leaf is left
+            newRoot = _HamtNode(1 << (newRoot[0] & _HAMT_MASK), [newRoot])
+        return PersistentDict._fromRoot(newRoot, self._size - 1)
+
+    def update(self, mapping):
+        '''
+        @return: a new PersistentDict with all the entries of mapping set (shallow, like dict.update)
+        '''
+        newDict = self
+        for key in mapping.keys():
+            newDict = newDict.set(key, mapping[key])
+        return newDict
+
+    def get(self, key, default = None):
+        entry = _hamtFind(self._root, hash(key) & 0xFFFFFFFFFFFFFFFF, key)
+        if entry == None:
+            return default
+        return entry[2]
+
+    def __getitem__(self, key):
+        entry = _hamtFind(self._root, hash(key) & 0xFFFFFFFFFFFFFFFF, key)
+        if entry == None:
+            raise KeyError(key)
+        return entry[2]
+
+    def __contains__(self, key):
+        return _hamtFind(self._root, hash(key) & 0xFFFFFFFFFFFFFFFF, key) != None
+
+    def __len__(self):
+        return self._size
+
+    def _iterEntries(self):
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            for entry in node.entries:
+                if type(entry) == tuple:
+                    yield entry
+                else:
+                    stack.append(entry)
+
+    def __iter__(self):
+        for entry in self._iterEntries():
+            yield entry[1]
+
+    def keys(self):
+        '''
+        @return: a lazy view (like the python 3 dict views), "in" on it is a trie lookup, not a scan
+        '''
+        return _PersistentDictView(self, 1)
+
+    def values(self):
+        return _PersistentDictView(self, 2)
+
+    def items(self):
+        return _PersistentDictView(self, 0)
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if not isinstance(other, PersistentDict) and type(other) != dict:
+            return False
+        if len(self) != len(other):
+            return False
+        for (key, value) in self.items():
+            if key not in other or not other[key] == value:
+                return False
+        return True
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None # the values (sets, lists) are not hashable in general
+
+    def __repr__(self):
+        return "PersistentDict(" + repr(dict(self.items())) + ")"
+
+class _PersistentDictView(object):
+    '''
+    @summary: the keys (part 1), values (part 2) or items (part 0) of a PersistentDict, iterated
+    lazily from the trie. It stays valid, as the dict it views cannot change
+    '''
+
+    def __init__(self, persistentDict, part):
+        self._persistentDict = persistentDict
+        self._part = part
+
+    def __len__(self):
+        return len(self._persistentDict)
+
+    def __iter__(self):
+        part = self._part
+        for entry in self._persistentDict._iterEntries():
+            if part == 0:
+                yield (entry[1], entry[2])
+            else:
+                yield entry[part]
+
+    def __contains__(self, value):
+        if self._part == 1:
+            return value in self._persistentDict
+        elif self._part == 0:
+            (key, itemValue) = value
+            entry = _hamtFind(self._persistentDict._root, hash(key) & 0xFFFFFFFFFFFFFFFF, key)
+            return entry != None and entry[2] == itemValue
+        for entry in self._persistentDict._iterEntries():
+            if entry[2] == value:
+                return True
+        return False
+
+    def __repr__(self):
+        return repr(list(self))
+
+def _isDictLike(value):
+    return type(value) == dict or type(value) == PersistentDict
+
+def _isNumpyArray(value):
+    return numpy != None and type(value) == numpy.ndarray
+
+def _isNumpyArrayPair(valueA, valueB):
+    '''
+    @return: True if at least one is a NumPy array and the other is an array, list, tuple or set,
+    so they can be compared with the NumPy set functions
+    '''
+    if not (_isNumpyArray(valueA) or _isNumpyArray(valueB)):
+        return False
+    for value in (valueA, valueB):
+        if not (_isNumpyArray(value) or type(value) == list or type(value) == tuple or type(value) == set):
+            return False
+    return True
+
+def _asNumpyArray(value):
+    '''
+    @return: the value as a 1-D NumPy array (of its values, as a set would hold them)
+    @raise ValueError: for any other shape. The NumPy set functions would flatten a 2-D array
+    (or a list of lists) into its elements, which is not what the dict functions mean by a value
+    '''
+    if not _isNumpyArray(value):
+        if type(value) == set:
+            value = list(value)
+        value = numpy.asarray(value)
+    if value.ndim != 1:
+        raise ValueError("only 1-D NumPy arrays are compared as collections of values, got the shape " + str(value.shape))
+    return value
+
 #===================================================================
 # 
 #===================================================================
@@ -408,8 +2190,19 @@ def getIntersectionOfDicts(sourceDict,compareDict,allowMissing = False, listOfKe
         @param compareDict: the dict with the entries for the source to compare with
         @param allowMissing: If the compare dict does NOT have a key, it is assumed that it just didn't have the entry, but is the same
         @return: a dict containing those entries from the sourceDict that are in the compareDict   
+        If sourceDict is a PersistentDict, a PersistentDict is returned (and nothing is deep copied)
+        If both are States (with the same AtomTable), a State is returned. A State compared with a dict
+        is converted with State.toDict first. If both are HashedTrees, the unchanged branches are not compared
+        NumPy array values are intersected with numpy.intersect1d (also with a list, tuple or set), giving an array.
+        Only 1-D arrays are supported, any other shape raises a ValueError
     '''
-    
+    if _isSameTableStates(sourceDict, compareDict):
+        return _getIntersectionOfStates(sourceDict, compareDict, allowMissing, listOfKeysAllowed)
+    if type(sourceDict) == HashedTree and type(compareDict) == HashedTree:
+        return _deepcopy(_getIntersectionOfHashedTrees(sourceDict, compareDict, sourceDict.data, compareDict.data,
+                                                       allowMissing, listOfKeysAllowed))
+    sourceDict = _stateToDict(sourceDict)
+    compareDict = _stateToDict(compareDict)
     returnDict = {}
         
     for sourceKey in sourceDict:
@@ -417,7 +2210,7 @@ def getIntersectionOfDicts(sourceDict,compareDict,allowMissing = False, listOfKe
             if sourceKey not in listOfKeysAllowed:
                 continue #onto the next iteration of the for loop
         #---END IF  the list of keys allowed is not empty i.e. allow all
-        if sourceKey not in compareDict.keys():
+        if sourceKey not in compareDict: # not .keys(), that is a list in python 2
             if allowMissing == True:
                 #then we assume that it is unchanged
                 returnDict[sourceKey] = sourceDict[sourceKey]
@@ -433,21 +2226,29 @@ def getIntersectionOfDicts(sourceDict,compareDict,allowMissing = False, listOfKe
                 typeMismatch = True
                 #there is one type of mismatch which can be resolved.
                 # if they are both lists, or tuples or sets, then they can all be made sets
-                if valueType == tuple or valueType == list or valueType == set:
+                if _isNumpyArrayPair(sourceValue, compareValue):
+                    typeMismatch = False # a NumPy array with a list, tuple or set, the result is an array
+                elif valueType == tuple or valueType == list or valueType == set:
                     if compareType == tuple or compareType == list or compareType == set:  
                         sourceValue = set(sourceValue)
                         compareValue = set(compareValue)
                         typeMismatch = False # we can handle this. We dont allow duplicates in lists,tuples,sets 
+                elif _isDictLike(sourceValue) and _isDictLike(compareValue):
+                    typeMismatch = False # a PersistentDict compared with a dict
             if typeMismatch:
                 # do nothing, unresolvable mismatch
+                _recordMismatchEvent()
                 print ("unexpected type mismatch in the source and compare dict")
                 print (sourceValue,compareValue)
                 print (sourceDict,compareDict)
             else:                
-                if valueType == dict:
+                if valueType == dict or valueType == PersistentDict:
                     #!@todo: the allowed keys is only for 1 level. Improve code to get a dict of allowed keys for deeper level matching                    
                     intersectionDict = getIntersectionOfDicts(sourceValue,compareValue,allowMissing)                    
                     returnDict[sourceKey] = intersectionDict                     
+                elif _isNumpyArray(sourceValue) or _isNumpyArray(compareValue):
+                    #the sorted unique values in both, vectorized
+                    returnDict[sourceKey] = numpy.intersect1d(_asNumpyArray(sourceValue), _asNumpyArray(compareValue))
                 elif (valueType == list or valueType == tuple or valueType == set):
                     #then only return the values that are unchanged
                     returnValue  = (set(sourceValue).intersection(set(compareValue)))
@@ -462,7 +2263,9 @@ def getIntersectionOfDicts(sourceDict,compareDict,allowMissing = False, listOfKe
                     returnDict[sourceKey] = sourceValue
         #END ELSE the key is also in the compare dict
     #END FOR loop through the keys in the source dict
-    return copy.deepcopy(returnDict)
+    if type(sourceDict) == PersistentDict:
+        return PersistentDict(returnDict) # the values are shared, not copied
+    return _deepcopy(returnDict)
 
 #===============================================================================
 # 
@@ -470,53 +2273,37 @@ def getIntersectionOfDicts(sourceDict,compareDict,allowMissing = False, listOfKe
 def updateAndReturnDict(mainDict,newValuesDict, updateConflicts = True, listsAdd = True, listReplace = False):
     '''
     @summary:  Update the main dict with entries from the source
+    mainDict itself is not modified. If it is a PersistentDict, the returned PersistentDict shares
+    every unchanged entry with it, so the cost is that of the update, not of the whole dict.
+    '''
+    if type(mainDict) == PersistentDict:
+        return _updateAndReturnPersistentDict(mainDict, newValuesDict, updateConflicts, listsAdd, listReplace)
+    #one deep copy is modified and returned. The original is only read, to roll back on conflicts
+    return _updateCopyOfDict(_deepcopy(mainDict), mainDict, newValuesDict, updateConflicts, listsAdd, listReplace)
+
+def _updateCopyOfDict(mainDict, originalMainDict, newValuesDict, updateConflicts = True, listsAdd = True, listReplace = False):
+    '''
+    @summary: the body of updateAndReturnDict. mainDict is a deep copy of originalMainDict that is
+    updated in place, nested dicts are updated in place as well (they are already copies)
     '''
     hasConflicts = False
-    originalMainDict = copy.deepcopy(mainDict)
-    mainDict = copy.deepcopy(mainDict) # this is the copy that is actually modified and returned
     for sourceKey in newValuesDict.keys():
-        if sourceKey not in mainDict.keys():
-            mainDict[sourceKey] = copy.deepcopy(newValuesDict[sourceKey])
+        if sourceKey not in mainDict:
+            mainDict[sourceKey] = _deepcopy(newValuesDict[sourceKey])
         else:
             mainValue = mainDict[sourceKey]
             sourceValue = newValuesDict[sourceKey]
-            if not type(mainValue) == type (sourceValue):
-                mainDict = originalMainDict
+            if not type(mainValue) == type (sourceValue) and not _isNumpyArrayPair(mainValue, sourceValue):
+                mainDict = _deepcopy(originalMainDict)
                 hasConflicts = True
+                _recordMismatchEvent()
                 print("ERROR! the data types do not match, cannot update mismatched dicts")
                 break#out of the for loop through  the keys
-            elif type(mainValue) == list:
-                if listsAdd:
-                    try:
-                        mainDict[sourceKey] = list(set(mainDict[sourceKey]).union(newValuesDict[sourceKey]))
-                    except: #this would happen if the list contained dicts which were not hashable
-                        mainDict[sourceKey] = mainDict[sourceKey] + newValuesDict[sourceKey]
-                else:
-                    if listReplace:
-                        mainDict[sourceKey] = newValuesDict[sourceKey]
-                    else:
-                        mainDict[sourceKey] = list(set(mainDict[sourceKey]).intersection(set(newValuesDict[sourceKey])))                    
-            elif type(mainValue) == tuple:
-                if listsAdd:
-                    mainDict[sourceKey] = tuple(set(mainDict[sourceKey]).union(newValuesDict[sourceKey]))
-                else:
-                    if listReplace:
-                        mainDict[sourceKey] = newValuesDict[sourceKey]
-                    else:
-                        mainDict[sourceKey] = tuple(set(mainDict[sourceKey]).intersection(set(newValuesDict[sourceKey])))
-            #end elif type is a tuple
-            elif type(mainValue) == set:
-                if listsAdd:
-                    mainDict[sourceKey] = mainDict[sourceKey].union(newValuesDict[sourceKey])
-                else:
-                    if listReplace:
-                        mainDict[sourceKey] = newValuesDict[sourceKey]
-                    else:
-                        mainDict[sourceKey] = mainDict[sourceKey].intersection((newValuesDict[sourceKey]))
-            #---END elif the type is a set
+            elif type(mainValue) == list or type(mainValue) == tuple or type(mainValue) == set or _isNumpyArray(mainValue):
+                mainDict[sourceKey] = _mergeUpdatedCollection(mainValue, sourceValue, listsAdd, listReplace)
             elif type(mainValue) == dict:
                 #in addition to recursively calling for nested dicts, also update the "has conflicts" variable
-                (mainDict[sourceKey],deeperConflicts) = updateAndReturnDict(mainDict[sourceKey] , newValuesDict[sourceKey],updateConflicts,listsAdd )
+                (mainDict[sourceKey],deeperConflicts) = _updateCopyOfDict(mainValue, originalMainDict[sourceKey], sourceValue,updateConflicts,listsAdd )
                 hasConflicts = hasConflicts or deeperConflicts
             else: # it is a single primitive type
                 if updateConflicts:
@@ -528,12 +2315,551 @@ def updateAndReturnDict(mainDict,newValuesDict, updateConflicts = True, listsAdd
         #---END ELSE the key is there in both dicts        
     #---END FOR loop through the keys of the main dict 
     return (mainDict,hasConflicts)
+
+def _updateAndReturnPersistentDict(mainDict, newValuesDict, updateConflicts = True, listsAdd = True, listReplace = False):
+    '''
+    @summary: updateAndReturnDict for a PersistentDict. Nothing is copied except the new values,
+    and rolling back on a conflict is just returning the original (it is immutable)
+    newValuesDict can be a dict or a PersistentDict
+    '''
+    hasConflicts = False
+    originalMainDict = mainDict
+    for sourceKey in newValuesDict.keys():
+        sourceValue = newValuesDict[sourceKey]
+        if sourceKey not in mainDict:
+            if type(sourceValue) == dict:
+                mainDict = mainDict.set(sourceKey, PersistentDict.fromDict(_deepcopy(sourceValue)))
+            elif type(sourceValue) == PersistentDict:
+                mainDict = mainDict.set(sourceKey, sourceValue)
+            else:
+                mainDict = mainDict.set(sourceKey, _deepcopy(sourceValue))
+            continue
+        mainValue = mainDict[sourceKey]
+        if _isDictLike(mainValue) and _isDictLike(sourceValue):
+            if type(mainValue) == dict:
+                mainValue = PersistentDict.fromDict(mainValue)
+            (newValue,deeperConflicts) = _updateAndReturnPersistentDict(mainValue, sourceValue, updateConflicts, listsAdd)
+            mainDict = mainDict.set(sourceKey, newValue)
+            hasConflicts = hasConflicts or deeperConflicts
+        elif not type(mainValue) == type (sourceValue) and not _isNumpyArrayPair(mainValue, sourceValue):
+            mainDict = originalMainDict
+            hasConflicts = True
+            _recordMismatchEvent()
+            print("ERROR! the data types do not match, cannot update mismatched dicts")
+            break#out of the for loop through  the keys
+        elif type(mainValue) == list or type(mainValue) == tuple or type(mainValue) == set or _isNumpyArray(mainValue):
+            newValue = _mergeUpdatedCollection(mainValue, sourceValue, listsAdd, listReplace)
+            if newValue is sourceValue:
+                newValue = _deepcopy(sourceValue) # the caller still owns sourceValue
+            mainDict = mainDict.set(sourceKey, newValue)
+        else: # it is a single primitive type
+            if updateConflicts:
+                mainDict = mainDict.set(sourceKey, sourceValue)
+            elif mainValue != sourceValue:
+                hasConflicts = True
+    #---END FOR loop through the keys of the new values dict
+    return (mainDict,hasConflicts)
+
+def _mergeUpdatedCollection(mainValue, sourceValue, listsAdd, listReplace):
+    '''
+    @summary: the list, tuple, set and NumPy array cases of updateAndReturnDict. Both values are of the
+    same type, or one is a NumPy array and the other a list, tuple or set (as in getIntersectionOfDicts).
+    The arrays must be 1-D (see _asNumpyArray)
+    '''
+    if _isNumpyArray(mainValue) or _isNumpyArray(sourceValue):
+        #vectorized, the result is the sorted unique values (like a set)
+        if listsAdd:
+            return numpy.union1d(_asNumpyArray(mainValue), _asNumpyArray(sourceValue))
+        elif listReplace:
+            return numpy.array(_asNumpyArray(sourceValue)) # a copy, the caller still owns sourceValue
+        else:
+            return numpy.intersect1d(_asNumpyArray(mainValue), _asNumpyArray(sourceValue))
+    elif type(mainValue) == list:
+        if listsAdd:
+            try:
+                return list(set(mainValue).union(sourceValue))
+            except: #this would happen if the list contained dicts which were not hashable
+                return mainValue + sourceValue
+        elif listReplace:
+            return sourceValue
+        else:
+            return list(set(mainValue).intersection(set(sourceValue)))
+    elif type(mainValue) == tuple:
+        if listsAdd:
+            return tuple(set(mainValue).union(sourceValue))
+        elif listReplace:
+            return sourceValue
+        else:
+            return tuple(set(mainValue).intersection(set(sourceValue)))
+    else: # it is a set
+        if listsAdd:
+            return mainValue.union(sourceValue)
+        elif listReplace:
+            return sourceValue
+        else:
+            return mainValue.intersection((sourceValue))
     
 
 #===============================================================================
 # 
 #===============================================================================
 
+def reduceStates(states, op, workers = None, chunkSize = None):
+    '''
+    @summary: folds op over the states, ie op(op(op(s1,s2),s3),...), as a parallel tree reduction
+    over a process pool. Each worker folds a chunk of consecutive states (a chunk is pickled once,
+    not state by state), then the partial results are combined pairwise, in order, until one is left.
+    op must be associative for the result to be the same as the serial fold.
+    @param op: "intersection" -> getIntersectionOfDicts (the invariant fluents)
+        "union" -> updateAndReturnDict (the union of the reachable values)
+        or a function of two states that can be pickled (ie defined at the top level of a module)
+    @param workers: number of processes, default is the number of cores. 1 folds serially here
+    @param chunkSize: states per task, default is enough for about 4 tasks per worker
+    @return: the reduced state
+    '''
+    states = list(states)
+    if len(states) == 0:
+        raise ValueError("reduceStates needs at least one state")
+    if workers == None:
+        workers = multiprocessing.cpu_count()
+    if workers <= 1 or len(states) <= 2:
+        return _foldStates((op, states))
+    if chunkSize == None:
+        chunkSize = max(2, -(-len(states) // (workers * 4)))
+    chunks = [(op, states[index:index+chunkSize]) for index in range(0, len(states), chunkSize)]
+    pool = multiprocessing.Pool(workers)
+    try:
+        partialResults = pool.map(_foldStates, chunks)
+        while len(partialResults) > 1:
+            #adjacent pairs, so the order of the states is kept (op need not be commutative)
+            pairs = [(op, partialResults[index:index+2]) for index in range(0, len(partialResults), 2)]
+            partialResults = pool.map(_foldStates, pairs)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return partialResults[0]
+
+def _foldStates(arguments):
+    '''
+    @summary: the serial fold, run in the worker processes. arguments is (op, listOfStates)
+    '''
+    (op, states) = arguments
+    reduceFunction = _getStateReduceFunction(op)
+    reducedState = states[0]
+    for singleState in states[1:]:
+        reducedState = reduceFunction(reducedState, singleState)
+    return reducedState
+
+def _getStateReduceFunction(op):
+    if op == "intersection":
+        return getIntersectionOfDicts
+    elif op == "union":
+        return _getUnionOfStates
+    elif callable(op):
+        return op
+    raise ValueError("unknown reduce op " + str(op))
+
+def _getUnionOfStates(stateA, stateB):
+    return updateAndReturnDict(stateA, stateB)[0]
+
+def convertAtomListsInParallel(atomLists, valueMode = "set", partSeparator = "+", workers = None,
+                               chunkSize = 256, maxInFlightChunks = None, internPool = None):
+    '''
+    @summary: generator that converts many states' atom lists (eg: a whole search frontier) with
+    convertFlattenedAtomListToDictBulk over a process pool, and yields the dicts in the same
+    order as atomLists. The states are sent in chunks, and at most maxInFlightChunks chunks are
+    queued or converted at a time, so atomLists can be a long (or endless) generator.
+    A worker sends back a chunk as its table of distinct obj/prop/value strings and the states
+    encoded as one int array of indices into it (so every distinct string is pickled once per
+    chunk, and no dict is pickled). Each dict is then built once here, from the strings of
+    internPool, so the results share one copy of each string.
+    @param valueMode: as convertFlattenedAtomListToDictBulk, eg: "single" for the _ver3 shape,
+        "list" for convertFlattenedAtomStringListToDictWithListValues
+    @param workers: number of processes, default is the number of cores. 1 converts here, serially,
+        and yields the dicts of convertFlattenedAtomListToDictBulk as they are (internPool is not used)
+    @param maxInFlightChunks: default is 2 per worker
+    @param internPool: optional dict of string -> the shared copy, reuse it across calls to share strings between batches
+    '''
+    if workers == None:
+        workers = multiprocessing.cpu_count()
+    if maxInFlightChunks == None:
+        maxInFlightChunks = 2 * workers
+    if internPool == None:
+        internPool = {}
+    if workers <= 1:
+        for atomList in atomLists:
+            yield convertFlattenedAtomListToDictBulk(atomList, partSeparator, valueMode)
+        return
+    pool = multiprocessing.Pool(workers)
+    pendingChunks = deque() # the async results, in the order of the chunks
+    try:
+        for chunk in _iterChunks(atomLists, chunkSize):
+            pendingChunks.append(pool.apply_async(_encodeAtomListChunk, ((chunk, valueMode, partSeparator),)))
+            while len(pendingChunks) >= maxInFlightChunks:
+                for stateDict in _decodeAtomListChunk(pendingChunks.popleft().get(), valueMode, internPool):
+                    yield stateDict
+        while pendingChunks:
+            for stateDict in _decodeAtomListChunk(pendingChunks.popleft().get(), valueMode, internPool):
+                yield stateDict
+        pool.close()
+    except: # including the generator being closed early
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+def _iterChunks(iterable, chunkSize):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == chunkSize:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+def _encodeAtomListChunk(arguments):
+    '''
+    @summary: run in the worker processes. arguments is (list of atom lists, valueMode, partSeparator)
+    @return: (stringTable, numStates, stream), stream is an int array of, for every state:
+    numObjs, then for every obj: objIndex, numProps, then for every prop: propIndex, then the valueIndex
+    ("single" mode) or numValues and the valueIndices. The indices are into stringTable, and the
+    objs, props and values are in the order of the dicts. An int array pickles as one bytes string
+    '''
+    (atomLists, valueMode, partSeparator) = arguments
+    stringIndices = {}
+    stream = array('l')
+    for atomList in atomLists:
+        stateDict = convertFlattenedAtomListToDictBulk(atomList, partSeparator, valueMode)
+        stream.append(len(stateDict))
+        for obj in stateDict:
+            propDict = stateDict[obj]
+            stream.extend((stringIndices.setdefault(obj, len(stringIndices)), len(propDict)))
+            for prop in propDict:
+                value = propDict[prop]
+                stream.append(stringIndices.setdefault(prop, len(stringIndices)))
+                if valueMode == "single":
+                    stream.append(stringIndices.setdefault(value, len(stringIndices)))
+                else:
+                    stream.append(len(value))
+                    stream.extend([stringIndices.setdefault(unit, len(stringIndices)) for unit in value])
+    stringTable = [None] * len(stringIndices)
+    for (string, index) in stringIndices.items():
+        stringTable[index] = string
+    return (stringTable, len(atomLists), stream)
+
+def _decodeAtomListChunk(encodedChunk, valueMode, internPool):
+    '''
+    @summary: generator of the dicts of a chunk from _encodeAtomListChunk, each built once with
+    the strings from internPool (new strings are added to it)
+    '''
+    (stringTable, numStates, stream) = encodedChunk
+    strings = [internPool.setdefault(string, string) for string in stringTable]
+    getString = strings.__getitem__
+    stream = stream.tolist() # indexing a list is faster than an array
+    if valueMode == "list" or valueMode == "uniqueList":
+        valueContainer = list
+    else:
+        valueContainer = set
+    position = 0
+    for _ in range(numStates):
+        stateDict = {}
+        numObjs = stream[position]
+        position += 1
+        for _ in range(numObjs):
+            propDict = stateDict[strings[stream[position]]] = {}
+            numProps = stream[position + 1]
+            position += 2
+            for _ in range(numProps):
+                if valueMode == "single":
+                    propDict[strings[stream[position]]] = strings[stream[position + 1]]
+                    position += 2
+                elif stream[position + 1] == 1: # the common case, without the slice
+                    propDict[strings[stream[position]]] = valueContainer((strings[stream[position + 2]],))
+                    position += 3
+                else:
+                    end = position + 2 + stream[position + 1]
+                    propDict[strings[stream[position]]] = valueContainer(map(getString, stream[position + 2:end]))
+                    position = end
+        yield stateDict
+
+#===============================================================================
+# 
+#===============================================================================
+
+class StateInvariantAccumulator(object):
+    '''
+    @summary: online invariants over a stream of states (eg: a trajectory or a search log).
+    Keeps the running intersection (the atoms true in EVERY state so far), the running union and
+    the number of states each atom was true in. Each ingest costs O(size of the state), nothing is
+    deep copied, and the snapshots can be taken at any point.
+    The atoms are those of iterStateAtoms, ie the path of keys followed by the value, so a list,
+    tuple or set value gives one atom per element, and the snapshots have a SET of values for
+    every leaf (a single value becomes a set of one value).
+    '''
+
+    def __init__(self, partSeparator = "+"):
+        '''
+        @param partSeparator: the separator of the "obj+prop+value" strings for ingestAtomList
+        '''
+        self.partSeparator = partSeparator
+        self.numStates = 0
+        self._intersection = None # set of atoms, None before the first state
+        self._union = set()
+        self._occurrenceCounts = Counter()
+
+    def ingest(self, domainState):
+        '''
+        @param domainState: a state dict (any depth), a PersistentDict or a State
+        '''
+        if type(domainState) == State:
+            atoms = set(domainState)
+        elif type(domainState) == PersistentDict:
+            atoms = set(iterStateAtoms(domainState.toDict()))
+        else:
+            atoms = set(iterStateAtoms(domainState))
+        self._ingestAtoms(atoms)
+
+    def ingestAtomList(self, visitedAtoms):
+        '''
+        @param visitedAtoms: list of "obj+prop+value" strings of ONE state
+        '''
+        partSeparator = self.partSeparator
+        self._ingestAtoms(set([tuple(atom.split(partSeparator)) for atom in set(visitedAtoms)]))
+
+    def ingestAll(self, states):
+        '''
+        @param states: any iterable of states (eg: a generator reading a log), consumed one at a time
+        @return: self, so the snapshots can be chained
+        '''
+        for singleState in states:
+            self.ingest(singleState)
+        return self
+
+    def _ingestAtoms(self, atoms):
+        self.numStates += 1
+        if self._intersection == None:
+            self._intersection = set(atoms)
+        else:
+            self._intersection.intersection_update(atoms)
+        self._union.update(atoms)
+        self._occurrenceCounts.update(atoms)
+
+    def getIntersectionAtoms(self):
+        '''
+        @return: a new set of the atoms true in every state so far (empty before the first state)
+        '''
+        if self._intersection == None:
+            return set()
+        return set(self._intersection)
+
+    def getUnionAtoms(self):
+        return set(self._union)
+
+    def getOccurrenceCounts(self):
+        '''
+        @return: a new dict of atom -> number of states it was true in
+        '''
+        return dict(self._occurrenceCounts)
+
+    def getFrequentAtoms(self, minFraction):
+        '''
+        @return: a set of the atoms true in at least minFraction (0 to 1) of the states so far
+        '''
+        minCount = minFraction * self.numStates
+        return set([atom for (atom, count) in self._occurrenceCounts.items() if count >= minCount])
+
+    def getIntersection(self):
+        '''
+        @return: the running intersection as a new nested dict (with sets of values)
+        '''
+        return _atomsToNestedDict(self.getIntersectionAtoms())
+
+    def getUnion(self):
+        return _atomsToNestedDict(self._union)
+
+    def getFrequentStateDict(self, minFraction):
+        return _atomsToNestedDict(self.getFrequentAtoms(minFraction))
+
+def _atomsToNestedDict(atoms):
+    '''
+    @summary: the inverse of iterStateAtoms, with a set of values at every leaf
+    '''
+    returnDict = {}
+    for atom in atoms:
+        currentDict = returnDict
+        for key in atom[:-2]:
+            currentDict = currentDict.setdefault(key, {})
+        currentDict.setdefault(atom[-2], set()).add(atom[-1])
+    return returnDict
+
+#===============================================================================
+# 
+#===============================================================================
+
+class StateMatrix(object):
+    '''
+    @summary: a set of states as a (states x atoms) NumPy matrix of 0/1 (bool or uint8), with a
+    column vocabulary of atoms (the tuples of iterStateAtoms, eg: (obj,prop,value)), so the
+    intersection, union, frequency and difference over thousands of states are single vectorized
+    reductions over the columns. Optionally backed by a memory mapped .npy file. Needs numpy.
+    '''
+
+    def __init__(self, matrix, vocabulary):
+        '''
+        @param matrix: 2D numpy array, one row per state, one column per atom of the vocabulary
+        @param vocabulary: list of the atoms of the columns
+        '''
+        self.matrix = matrix
+        self.vocabulary = vocabulary
+        self._columnOfAtom = dict([(vocabulary[column], column) for column in range(len(vocabulary))])
+
+    @classmethod
+    def fromStates(cls, states, vocabulary = None, dtype = "bool", memmapPath = None, partSeparator = "+"):
+        '''
+        @param states: iterable of state dicts (any depth), States, or lists of "obj+prop+value"
+            strings (as consumed by convertFlattenedAtomListToDict), can be mixed
+        @param vocabulary: the atoms of the first columns, to share the columns with another
+            StateMatrix (eg: otherMatrix.vocabulary). New atoms are added after them
+        @param dtype: "bool" or "uint8"
+        @param memmapPath: if given, the matrix is a memory mapped .npy file at this path
+            (and the vocabulary is pickled next to it, see load)
+        '''
+        if numpy == None:
+            raise ImportError("StateMatrix needs numpy")
+        vocabulary = list(vocabulary) if vocabulary != None else []
+        columnOfAtom = dict([(vocabulary[column], column) for column in range(len(vocabulary))])
+        #machine int buffers (not lists of python ints): the columns of the set cells, and the number of them in each row
+        columnIndices = array('l')
+        rowLengths = array('l')
+        for singleState in states:
+            numColumnsBefore = len(columnIndices)
+            for atom in _iterAtomsOfAnyState(singleState, partSeparator):
+                try:
+                    column = columnOfAtom[atom]
+                except KeyError:
+                    column = columnOfAtom[atom] = len(vocabulary)
+                    vocabulary.append(atom)
+                columnIndices.append(column)
+            rowLengths.append(len(columnIndices) - numColumnsBefore)
+        #---END FOR the states, only the indices of the set cells were kept so far
+        numStates = len(rowLengths)
+        shape = (numStates, len(vocabulary))
+        if memmapPath != None:
+            matrix = numpy.lib.format.open_memmap(memmapPath, mode = "w+", dtype = dtype, shape = shape)
+            matrix[:] = 0
+            with open(memmapPath + ".vocabulary", "wb") as vocabularyFile:
+                pickle.dump(vocabulary, vocabularyFile, pickle.HIGHEST_PROTOCOL)
+        else:
+            matrix = numpy.zeros(shape, dtype = dtype)
+        if len(columnIndices) > 0:
+            rowIndices = numpy.repeat(numpy.arange(numStates, dtype = numpy.intp), numpy.frombuffer(rowLengths, dtype = "l"))
+            matrix[rowIndices, numpy.frombuffer(columnIndices, dtype = "l")] = 1
+        if memmapPath != None:
+            matrix.flush()
+        return cls(matrix, vocabulary)
+
+    @classmethod
+    def load(cls, memmapPath, mode = "r"):
+        '''
+        @summary: opens a matrix written by fromStates(..., memmapPath = ...) without reading it into memory
+        @param mode: the numpy mmap_mode, "r" (read only) or "r+"
+        '''
+        if numpy == None:
+            raise ImportError("StateMatrix needs numpy")
+        with open(memmapPath + ".vocabulary", "rb") as vocabularyFile:
+            vocabulary = pickle.load(vocabularyFile)
+        return cls(numpy.load(memmapPath, mmap_mode = mode), vocabulary)
+
+    @property
+    def numStates(self):
+        return self.matrix.shape[0]
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    def getColumn(self, atom):
+        '''
+        @return: the column of the atom, or None if it is not in the vocabulary
+        '''
+        return self._columnOfAtom.get(atom)
+
+    def _getAtomsOfMask(self, columnMask):
+        vocabulary = self.vocabulary
+        return set([vocabulary[column] for column in numpy.flatnonzero(columnMask)])
+
+    def getIntersectionAtoms(self, rows = None):
+        '''
+        @param rows: optional index/slice/mask of the states to use, default all
+        @return: the set of atoms true in every state
+        '''
+        matrix = self.matrix if rows is None else self.matrix[rows]
+        if matrix.shape[0] == 0:
+            return set()
+        return self._getAtomsOfMask(matrix.all(axis = 0))
+
+    def getUnionAtoms(self, rows = None):
+        matrix = self.matrix if rows is None else self.matrix[rows]
+        return self._getAtomsOfMask(matrix.any(axis = 0))
+
+    def getAtomCounts(self, rows = None):
+        '''
+        @return: numpy array of the number of states each column's atom is true in
+        '''
+        matrix = self.matrix if rows is None else self.matrix[rows]
+        return matrix.sum(axis = 0, dtype = numpy.int64)
+
+    def getFrequentAtoms(self, minFraction, rows = None):
+        '''
+        @return: the set of atoms true in at least minFraction (0 to 1) of the states
+        '''
+        counts = self.getAtomCounts(rows)
+        numStates = self.matrix.shape[0] if rows is None else self.matrix[rows].shape[0]
+        return self._getAtomsOfMask(counts >= minFraction * numStates)
+
+    def getDifferenceAtoms(self, rowA, rowB):
+        '''
+        @return: the set of atoms true in state rowA but not in state rowB
+        '''
+        return self._getAtomsOfMask(numpy.logical_and(self.matrix[rowA], numpy.logical_not(self.matrix[rowB])))
+
+    def getDifferenceMatrix(self, row):
+        '''
+        @return: a bool matrix, of the atoms true in each state but not in state row (each state - that state)
+        '''
+        return numpy.logical_and(self.matrix, numpy.logical_not(self.matrix[row]))
+
+    def getStateAtoms(self, row):
+        return self._getAtomsOfMask(self.matrix[row])
+
+    def getStateDict(self, row):
+        '''
+        @return: the state of the row as a nested dict with sets of values
+        '''
+        return _atomsToNestedDict(self.getStateAtoms(row))
+
+    def getIntersection(self, rows = None):
+        return _atomsToNestedDict(self.getIntersectionAtoms(rows))
+
+    def getUnion(self, rows = None):
+        return _atomsToNestedDict(self.getUnionAtoms(rows))
+
+def _iterAtomsOfAnyState(singleState, partSeparator):
+    if type(singleState) == dict or type(singleState) == OrderedDict:
+        return iterStateAtoms(singleState)
+    elif type(singleState) == State:
+        return iter(singleState)
+    elif type(singleState) == PersistentDict:
+        return iterStateAtoms(singleState.toDict())
+    return (tuple(atom.split(partSeparator)) for atom in singleState)
+
+#===============================================================================
+# 
+#===============================================================================
+
 def getDifferenceOfDicts(dictA,dictB,allowMissing = True,allowedKeys = []):
     '''
         A-B, such that lists,sets and tuples have common elements dropped, and only uncommon elements from A
@@ -542,6 +2868,83 @@ def getDifferenceOfDicts(dictA,dictB,allowMissing = True,allowedKeys = []):
         Missing keys are preserved from dict A
         
         if allowedKeys = [<empty list>], it means all
+        Lists and tuples are multisets: each element of B removes one occurrence from A
+        NumPy array values use numpy.setdiff1d (also with a list, tuple or set), giving an array of the unique values.
+        Only 1-D arrays are supported, any other shape raises a ValueError
+        If both are States (with the same AtomTable), a State is returned. A State compared with a dict
+        is converted with State.toDict first
+    '''
+    if _isSameTableStates(dictA, dictB):
+        return _getDifferenceOfStates(dictA, dictB, allowMissing, allowedKeys)
+    return _getDifferenceOfDicts(_stateToDict(dictA), _stateToDict(dictB), allowMissing, allowedKeys, None, None)
+
+def getDifferenceOfDictsBatch(baseDict, listOfDicts, subtractBase = True, allowMissing = True, allowedKeys = []):
+    '''
+        getDifferenceOfDicts of one base dict against many dicts. The element counts of the
+        base's lists and tuples are computed ONCE and reused for every dict in listOfDicts
+        @param subtractBase: True -> returns [dict - baseDict for each dict] (eg: what is new in
+            each successor). False -> returns [baseDict - dict for each dict]
+        @return: the list of difference dicts, in the order of listOfDicts
+    '''
+    preparedBase = _countListElementsOfDict(baseDict)
+    if subtractBase:
+        return [_getDifferenceOfDicts(singleDict, baseDict, allowMissing, allowedKeys, None, preparedBase)
+                for singleDict in listOfDicts]
+    return [_getDifferenceOfDicts(baseDict, singleDict, allowMissing, allowedKeys, preparedBase, None)
+            for singleDict in listOfDicts]
+
+def _countListElementsOfDict(sourceDict):
+    '''
+        @return: a dict with the same keys, where list and tuple values are replaced by a Counter
+        of their elements (None if they are not hashable), and dicts by the same kind of dict
+    '''
+    countsDict = {}
+    for key in sourceDict:
+        value = sourceDict[key]
+        if type(value) == list or type(value) == tuple:
+            try:
+                countsDict[key] = Counter(value)
+            except TypeError:
+                countsDict[key] = None
+        elif type(value) == dict:
+            countsDict[key] = _countListElementsOfDict(value)
+    return countsDict
+
+def _subtractListElements(listA, listB, countsA = None, countsB = None):
+    '''
+        @return: a new list with listA's elements in order, with one occurrence removed for each
+        element of listB (what the old remove() loop did), in O(len(A) + len(B)) using counts
+    '''
+    try:
+        if countsB == None:
+            countsB = Counter(listB)
+        if countsA != None: #nothing in common is the common case, and then no scan of A is needed
+            for bValue in countsB:
+                if bValue in countsA:
+                    break
+            else:
+                return list(listA)
+        removedCounts = {}
+        differenceList = []
+        for aValue in listA:
+            toRemove = countsB.get(aValue, 0)
+            if toRemove > 0:
+                alreadyRemoved = removedCounts.get(aValue, 0)
+                if alreadyRemoved < toRemove:
+                    removedCounts[aValue] = alreadyRemoved + 1
+                    continue
+            differenceList.append(aValue)
+        return differenceList
+    except TypeError: # unhashable elements (eg: dicts), so fall back to removing one by one
+        differenceList = list(listA)
+        for bValue in listB:
+            if bValue in differenceList:
+                differenceList.remove(bValue)
+        return differenceList
+
+def _getDifferenceOfDicts(dictA, dictB, allowMissing, allowedKeys, countsOfA, countsOfB):
+    '''
+        the body of getDifferenceOfDicts. countsOfA/countsOfB are from _countListElementsOfDict, or None
     '''
     differenceDict = {}   
     allAllowed = (len(allowedKeys) == 0) 
@@ -559,7 +2962,9 @@ def getDifferenceOfDicts(dictA,dictB,allowMissing = True,allowedKeys = []):
                 typeMismatch = True
                 #there is one type of mismatch that we can handle
                 # if they are both lists, or tuples or sets, then they can all be made sets
-                if dictAValueType == tuple or dictAValueType == list or dictAValueType == set:
+                if _isNumpyArrayPair(dictAValue, dictBValue):
+                    typeMismatch = False # a NumPy array with a list, tuple or set, the result is an array
+                elif dictAValueType == tuple or dictAValueType == list or dictAValueType == set:
                     if dictBValueType == tuple or dictBValueType == list or dictBValueType == set:  
                         dictAValue = set(dictAValue)
                         dictBValue = set(dictBValue)
@@ -567,31 +2972,36 @@ def getDifferenceOfDicts(dictA,dictB,allowMissing = True,allowedKeys = []):
                 
             if typeMismatch:
                 #could not handle type mismatch
+                _recordMismatchEvent()
                 print("Mismatched Values when taking the difference between dicts")
                 print(dictAKey,dictAValue,dictBValue)
             else:
-                if type(dictAValue) == list:
-                    dictAValue = list(dictAValue)#creates a new object and allows removal
-                    for bValue in dictBValue:
-                        if bValue in dictAValue:
-                            dictAValue.remove(bValue)
-                elif type(dictAValue) == tuple:
-                    dictAValue = list(dictAValue)#creates a new object and allows removal
-                    for bValue in dictBValue:
-                        if bValue in dictAValue:
-                            dictAValue.remove(bValue)
-                    dictAValue = tuple(dictAValue)
+                if _isNumpyArray(dictAValue) or _isNumpyArray(dictBValue):
+                    #the sorted unique values of A that are not in B, vectorized
+                    dictAValue = numpy.setdiff1d(_asNumpyArray(dictAValue), _asNumpyArray(dictBValue))
+                elif type(dictAValue) == list or type(dictAValue) == tuple:
+                    #creates a new object, the input is not modified
+                    isTuple = type(dictAValue) == tuple
+                    dictAValue = _subtractListElements(dictAValue, dictBValue,
+                            countsOfA.get(dictAKey) if countsOfA != None else None,
+                            countsOfB.get(dictAKey) if countsOfB != None else None)
+                    if isTuple:
+                        dictAValue = tuple(dictAValue)
                 elif type(dictAValue) == set:
                     dictAValue = dictAValue.difference(dictBValue)
                 elif type(dictAValue) == dict:
-                    dictAValue = getDifferenceOfDicts(dictAValue, dictBValue)                    
+                    dictAValue = _getDifferenceOfDicts(dictAValue, dictBValue, True, [],
+                            countsOfA.get(dictAKey) if countsOfA != None else None,
+                            countsOfB.get(dictAKey) if countsOfB != None else None)
                 else:#primitive (single) values
                     if dictAValue == dictBValue:
                         dictAValue = None
                     #else dictAValue is taken as it is    
-                if dictAValue != None:                                        
+                if dictAValue is not None: # "is", a NumPy array compares element-wise                                        
                     differenceDict[dictAKey] = dictAValue
             #---END else the type of A and B values match        
+        except ValueError:
+            raise # a NumPy array that is not 1-D (see _asNumpyArray)
         except:
             # the entry is not in dictB so it is taken as is for the difference A-B
             if allowMissing:
@@ -608,15 +3018,26 @@ def getDroppedEntriesInDict(fromDict,resultDict,checkSingleValues = False):
         Go through each key in the main dict, and check if the value in the comparison
         dict is a list, tuple or set. if so, return in a dict, those entries that were dropped 
         (i.e. not in the main , but in the comparison)
+        If both are HashedTrees, the unchanged branches are not compared
+        A 1-D NumPy array gives the numpy.setdiff1d of the two arrays. Paired with a list, tuple or set
+        it is not a mismatch, but nothing is dropped (as in compareDicts)
     '''
+    if type(fromDict) == HashedTree and type(resultDict) == HashedTree:
+        return _getDroppedEntriesOfHashedTrees(fromDict, resultDict, fromDict.data, resultDict.data, checkSingleValues)
     droppedDict = {}
     for mainKey in fromDict.keys():
         try:
             mainValue = fromDict[mainKey]
             compareValue = resultDict[mainKey]
             if type(mainValue) != type(compareValue):
-                print("Error Value types do not match for the key in the two dicts")
-                print(mainKey,fromDict,resultDict)
+                if _isNumpyArrayPair(mainValue, compareValue):
+                    #nothing is dropped, but the shapes are checked as in the other dict functions
+                    _asNumpyArray(mainValue)
+                    _asNumpyArray(compareValue)
+                else:
+                    _recordMismatchEvent()
+                    print("Error Value types do not match for the key in the two dicts")
+                    print(mainKey,fromDict,resultDict)
             else:
                 if type(mainValue) == list:
                     droppedDict[mainKey] = list(set(mainValue).difference(set(compareValue)))
@@ -624,15 +3045,484 @@ def getDroppedEntriesInDict(fromDict,resultDict,checkSingleValues = False):
                     droppedDict[mainKey] = tuple(set(mainValue).difference(set(compareValue)))
                 elif type(mainValue) == set:
                     droppedDict[mainKey] = mainValue.difference(compareValue)                                        
+                elif _isNumpyArray(mainValue):
+                    droppedDict[mainKey] = numpy.setdiff1d(_asNumpyArray(mainValue), _asNumpyArray(compareValue))
                 elif type(mainValue) == dict:
                     droppedDict[mainKey] = getDroppedEntriesInDict(mainValue,compareValue,checkSingleValues)
                 else:
                     if checkSingleValues and mainValue != compareValue:
                         droppedDict[mainKey] = mainValue # it was dropped                        
+        except ValueError:
+            raise # a NumPy array that is not 1-D (see _asNumpyArray)
         except:
             pass # do nothing if the key is not in the comparison dict
     return droppedDict
 
+#===========================================================================
+# 
+#===========================================================================
+
+def compareDicts(dictA, dictB, allowMissing = False, allowedKeys = [], differenceAllowMissing = True, checkSingleValues = False):
+    '''
+        @summary: one traversal of the two dicts that gives, together, what
+        getIntersectionOfDicts(dictA, dictB, allowMissing, allowedKeys),
+        getDifferenceOfDicts(dictA, dictB, differenceAllowMissing, allowedKeys) and
+        getDroppedEntriesInDict(dictA, dictB, checkSingleValues) return, so each list is converted
+        to a set once, and each type mismatch is printed once.
+        NOTE: like getDroppedEntriesInDict, the dropped entries ignore allowedKeys, and nothing is
+        dropped where the two values are different kinds of collections (eg: a list and a set).
+        Only plain dicts are compared (use the individual functions for PersistentDicts and States).
+        The intersection does not share any container with dictA, but unlike getIntersectionOfDicts
+        the (hashable) elements of its sets, lists and tuples are not copied
+        @return: a dict with "intersection", "difference", "dropped" and "changes", where changes maps
+        each key of dictA to "unchanged", "changed", "missing" (not in dictB) or "typeMismatch",
+        or for dict values to the nested changes dict, and each key only in dictB to "added"
+    '''
+    (intersectionDict, differenceDict, droppedDict, changes) = \
+        _compareDicts(dictA, dictB, allowMissing, allowedKeys, differenceAllowMissing, checkSingleValues)
+    return {"intersection": intersectionDict, "difference": differenceDict,
+            "dropped": droppedDict, "changes": changes}
+
+def _compareDicts(dictA, dictB, allowMissing, allowedKeys, differenceAllowMissing, checkSingleValues):
+    '''
+        the body of compareDicts. Only the values the intersection takes as they are from dictA are
+        deep copied (as getIntersectionOfDicts returns a deep copy), the rest is built new
+    '''
+    intersectionDict = {}
+    differenceDict = {}
+    droppedDict = {}
+    changes = {}
+    allAllowed = (len(allowedKeys) == 0)
+    for key in dictA:
+        #the allowed keys only filter the intersection and the difference
+        isAllowed = allAllowed or key in allowedKeys
+        aValue = dictA[key]
+        if key not in dictB:
+            changes[key] = "missing"
+            if isAllowed:
+                if allowMissing:
+                    intersectionDict[key] = _deepcopy(aValue)
+                if differenceAllowMissing:
+                    differenceDict[key] = aValue
+            continue
+        bValue = dictB[key]
+        aType = type(aValue)
+        bType = type(bValue)
+        if _isNumpyArray(aValue) or _isNumpyArray(bValue):
+            if aType != bType and not _isNumpyArrayPair(aValue, bValue):
+                changes[key] = "typeMismatch"
+                _recordMismatchEvent()
+                print("Mismatched Values when comparing dicts")
+                print(key,aValue,bValue)
+                continue
+            aArray = _asNumpyArray(aValue)
+            bArray = _asNumpyArray(bValue)
+            onlyInA = numpy.setdiff1d(aArray, bArray)
+            if aType == bType: # the same as getDroppedEntriesInDict, only for two arrays
+                droppedDict[key] = onlyInA
+                changes[key] = "unchanged" if numpy.array_equal(aArray, bArray) else "changed"
+            else:
+                changes[key] = "unchanged" if numpy.array_equal(numpy.unique(aArray), numpy.unique(bArray)) else "changed"
+            if isAllowed:
+                intersectionDict[key] = numpy.intersect1d(aArray, bArray)
+                differenceDict[key] = onlyInA.copy() if aType == bType else onlyInA
+        elif aType != bType:
+            if (aType == list or aType == tuple or aType == set) and (bType == list or bType == tuple or bType == set):
+                #can be handled as sets (we dont allow duplicates in lists,tuples,sets), no dropped entries
+                aSet = set(aValue)
+                bSet = set(bValue)
+                changes[key] = "unchanged" if aSet == bSet else "changed"
+                if isAllowed:
+                    intersectionDict[key] = aSet.intersection(bSet)
+                    differenceDict[key] = aSet.difference(bSet)
+            else:
+                changes[key] = "typeMismatch"
+                _recordMismatchEvent()
+                print("Mismatched Values when comparing dicts")
+                print(key,aValue,bValue)
+        elif aType == dict:
+            (nestedIntersection, nestedDifference, nestedDropped, nestedChanges) = \
+                _compareDicts(aValue, bValue, allowMissing, [], True, checkSingleValues)
+            if isAllowed:
+                intersectionDict[key] = nestedIntersection
+                differenceDict[key] = nestedDifference
+            droppedDict[key] = nestedDropped
+            changes[key] = nestedChanges
+        elif aType == list or aType == tuple or aType == set:
+            aSet = set(aValue)
+            bSet = set(bValue)
+            changes[key] = "unchanged" if aValue == bValue else "changed"
+            if aType == set:
+                onlyInA = aValue.difference(bValue)
+                droppedDict[key] = onlyInA
+                if isAllowed:
+                    intersectionDict[key] = aSet.intersection(bSet)
+                    differenceDict[key] = set(onlyInA) # not shared with the dropped dict
+            else:
+                droppedDict[key] = aType(aSet.difference(bSet))
+                if isAllowed:
+                    intersectionDict[key] = aType(aSet.intersection(bSet))
+                    differenceDict[key] = aType(_subtractListElements(aValue, bValue))
+        else: #primitive (single) values
+            if aValue == bValue:
+                changes[key] = "unchanged"
+                if isAllowed:
+                    intersectionDict[key] = _deepcopy(aValue)
+            else:
+                changes[key] = "changed"
+                if isAllowed and aValue != None:
+                    differenceDict[key] = aValue
+                if checkSingleValues:
+                    droppedDict[key] = aValue # it was dropped
+    #---END for loop through the keys of dictA
+    for key in dictB:
+        if key not in dictA:
+            changes[key] = "added"
+    return (intersectionDict, differenceDict, droppedDict, changes)
+
+#===========================================================================
+# 
+#===========================================================================
+
+class HashedTree(object):
+    '''
+    @summary: wraps a nested state dict and caches a Merkle digest (128 bits) per subtree, so two
+    trees can be compared branch by branch, and identical branches are skipped without looking
+    inside. differenceInCompoundStructure, getIntersectionOfDicts and getDroppedEntriesInDict
+    take the fast path when BOTH arguments are HashedTrees (and return the same as for the dicts).
+    copy() is O(1): the copies share every container, and setValue/deleteValue copy only the
+    dicts on the path they change (copy on write), so a successor made with copy() + a few
+    setValue calls shares its unchanged branches, and their digests, with its parent.
+    The digest of a dict is a sum over its entries, so after a change only the changed entries
+    of the dicts on the path are hashed again, not all the children of those dicts.
+    Each tree has its own digest map (a PersistentDict, so copy() shares it, and a change only
+    copies a path of it), without the containers the tree no longer refers to. A discarded tree
+    does not keep anything alive.
+    NOTE: after wrapping, change the data only through setValue/deleteValue, or call invalidate
+    with the path of what was changed in place (and never in place after copy()). Leaf values
+    are compared by their type and repr (so eg: two objects with the same repr are taken as equal).
+    '''
+
+    def __init__(self, data, _digests = None):
+        self.data = data
+        #id(container) -> (container, digest, contains an OrderedDict, sum of the entry hashes (dicts only),
+        #the entry hashes before the change of the changed keys (dicts only, None if unchanged)).
+        #Immutable, the copies start with the same one
+        self._digests = _digests if _digests != None else PersistentDict()
+        self._ownsAllNodes = _digests == None # no copy has been made, everything can be changed in place
+        self._ownedNodes = {} # id -> container that only this tree refers to (made by a copy on write)
+        self._rootContainsOrderedDict = None # cached for the comparisons, None if not known
+
+    def copy(self):
+        '''
+        @return: a HashedTree sharing all the data (and the digests) with this one
+        '''
+        self._ownsAllNodes = False
+        self._ownedNodes = {}
+        return HashedTree(self.data, self._digests)
+
+    def getValue(self, path):
+        node = self.data
+        for key in path:
+            node = node[key]
+        return node
+
+    def setValue(self, path, value):
+        '''
+        @param path: tuple of the keys to the entry, eg: ("truck1","at")
+        '''
+        node = self._getWritablePath(path[:-1])
+        self._markChangedEntry(node, path[-1])
+        if path[-1] in node:
+            self._forgetDigests(node[path[-1]])
+        node[path[-1]] = value
+
+    def deleteValue(self, path):
+        node = self._getWritablePath(path[:-1])
+        self._markChangedEntry(node, path[-1])
+        self._forgetDigests(node[path[-1]])
+        del node[path[-1]]
+
+    def _getWritablePath(self, path):
+        '''
+        @return: the dict at the path, after copying every shared dict on the way to it. The dicts on
+        the way record which of their entries is about to change
+        '''
+        self._rootContainsOrderedDict = None
+        if not self._isOwned(self.data):
+            self.data = self._ownCopyOf(self.data)
+        node = self.data
+        for key in path:
+            self._markChangedEntry(node, key)
+            child = node[key]
+            if not self._isOwned(child):
+                child = node[key] = self._ownCopyOf(child)
+            node = child
+        return node
+
+    def _isOwned(self, node):
+        return self._ownsAllNodes or id(node) in self._ownedNodes
+
+    def _ownCopyOf(self, node):
+        '''
+        @return: a copy of the shared container, that only this tree refers to. Its digest entry is
+        moved to the copy (the shared original stays in the other trees' maps only)
+        '''
+        nodeCopy = type(node)(node)
+        self._ownedNodes[id(nodeCopy)] = nodeCopy # keeps it alive, so its id is not reused
+        cacheEntry = self._digests.get(id(node))
+        if cacheEntry != None and cacheEntry[0] is node:
+            self._digests = self._digests.delete(id(node)).set(id(nodeCopy), (nodeCopy,) + cacheEntry[1:])
+        return nodeCopy
+
+    def _markChangedEntry(self, node, key):
+        '''
+        @summary: called before the entry at key of the dict node changes. Keeps the hash of the entry
+        as it is now, so the digest of the dict can be updated without hashing the other entries
+        '''
+        cacheEntry = self._digests.get(id(node))
+        if cacheEntry == None or cacheEntry[0] is not node:
+            return # no digest yet, it is computed from all the entries when needed
+        if type(node) != dict:
+            self._forgetDigest(node) # an OrderedDict digest depends on the order, computed again
+            return
+        changedEntries = cacheEntry[4]
+        if changedEntries != None and key in changedEntries:
+            return # the hash from before the first change is kept
+        changedEntries = dict(changedEntries) if changedEntries != None else {}
+        if key in node:
+            changedEntries[key] = _getMd5Int(repr((key, self._getNodeInfo(node[key])[0])))
+        else:
+            changedEntries[key] = None
+        self._digests = self._digests.set(id(node), cacheEntry[:4] + (changedEntries,))
+
+    def _forgetDigest(self, node):
+        if id(node) in self._digests:
+            self._digests = self._digests.delete(id(node))
+
+    def _forgetDigests(self, node):
+        '''
+        @summary: drops the digests of a container the tree no longer refers to, and of the containers inside it
+        '''
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            cacheEntry = self._digests.get(id(node))
+            if cacheEntry == None or cacheEntry[0] is not node:
+                continue # not digested (so nothing inside it was kept either), or another container with a reused id
+            self._digests = self._digests.delete(id(node))
+            if type(node) == dict or type(node) == OrderedDict:
+                stack.extend(node.values())
+
+    def invalidate(self, path = ()):
+        '''
+        @summary: drops the digests of the containers from the root to the one at the path,
+        for when that container was changed in place
+        '''
+        self._rootContainsOrderedDict = None
+        node = self.data
+        self._forgetDigest(node)
+        for key in path:
+            node = node[key]
+            self._forgetDigest(node)
+
+    def clearDigestCache(self):
+        '''
+        @summary: drops all the digests of this tree (the copies keep theirs)
+        '''
+        self._digests = PersistentDict()
+        self._rootContainsOrderedDict = None
+
+    def getDigest(self, path = ()):
+        return self._getNodeInfo(self.getValue(path))[0]
+
+    def _containsOrderedDict(self):
+        '''
+        @return: True if there is an OrderedDict anywhere in the tree (it may stay True after it is removed)
+        '''
+        if self._rootContainsOrderedDict == None:
+            self._rootContainsOrderedDict = self._getNodeInfo(self.data)[1]
+        return self._rootContainsOrderedDict
+
+    def _getNodeInfo(self, node):
+        '''
+        @return: (digest, contains an OrderedDict) of the node
+        '''
+        nodeType = type(node)
+        if _isNumpyArray(node): # the repr of a long array is abbreviated, so hash the data
+            return (int(hashlib.md5(repr((node.dtype.str, node.shape)).encode("utf-8") + node.tobytes()).hexdigest(), 16), False)
+        if nodeType != dict and nodeType != OrderedDict and nodeType != list and nodeType != tuple \
+                and nodeType != set and nodeType != frozenset:
+            return (_getMd5Int(repr((nodeType.__name__, node))), False)
+        cacheEntry = self._digests.get(id(node))
+        if cacheEntry != None and cacheEntry[0] is node:
+            if cacheEntry[4] == None:
+                return cacheEntry[1:3]
+            #a dict with changed entries, only those are hashed again
+            (containsOrderedDict, total) = cacheEntry[2:4]
+            for (key, previousEntryHash) in cacheEntry[4].items():
+                if previousEntryHash != None:
+                    total -= previousEntryHash
+                if key in node:
+                    (childDigest, childContainsOrderedDict) = self._getNodeInfo(node[key])
+                    total += _getMd5Int(repr((key, childDigest)))
+                    containsOrderedDict = containsOrderedDict or childContainsOrderedDict
+            total = total & 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF
+            digest = _getMd5Int(repr(("dict", total)))
+            self._digests = self._digests.set(id(node), (node, digest, containsOrderedDict, total, None))
+            return (digest, containsOrderedDict)
+        containsOrderedDict = False
+        total = None
+        if nodeType == dict:
+            total = 0
+            for key in node:
+                (childDigest, childContainsOrderedDict) = self._getNodeInfo(node[key])
+                total += _getMd5Int(repr((key, childDigest)))
+                containsOrderedDict = containsOrderedDict or childContainsOrderedDict
+            #the sum does not depend on the order of the keys
+            total = total & 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF
+            digest = _getMd5Int(repr(("dict", total)))
+        elif nodeType == OrderedDict:
+            containsOrderedDict = True
+            digest = _getMd5Int(repr(("OrderedDict", [(key, self._getNodeInfo(node[key])[0]) for key in node])))
+        elif nodeType == set or nodeType == frozenset:
+            try:
+                digest = _getMd5Int(repr((nodeType.__name__, sorted(node))))
+            except TypeError: # not orderable, add up the digests of the elements
+                total = sum([_getMd5Int(repr(element)) for element in node])
+                digest = _getMd5Int(repr((nodeType.__name__, total & 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF)))
+                total = None
+        else: #lists and tuples
+            digest = _getMd5Int(repr((nodeType.__name__, node)))
+        self._digests = self._digests.set(id(node), (node, digest, containsOrderedDict, total, None))
+        return (digest, containsOrderedDict)
+
+def _getMd5Int(string):
+    return int(hashlib.md5(string.encode("utf-8")).hexdigest(), 16)
+
+def _isUnchangedHashedBranch(treeA, treeB, valueA, valueB):
+    '''
+    @return: True if both are the same dict, list, tuple or set (by digest), with no OrderedDict
+    inside (differenceInCompoundStructure does not drop the empty diffs under an OrderedDict)
+    '''
+    valueType = type(valueA)
+    if valueType != type(valueB) or not (valueType == dict or valueType == list or valueType == tuple \
+                                         or valueType == set or valueType == frozenset):
+        return False
+    if valueA is valueB and not treeA._containsOrderedDict():
+        return True # a branch shared by the copies, no digest needs to be looked up
+    (digestA, containsOrderedDictA) = treeA._getNodeInfo(valueA)
+    if containsOrderedDictA:
+        return False
+    return digestA == treeB._getNodeInfo(valueB)[0]
+
+def _getDifferenceOfHashedTrees(treeBefore, treeAfter, structureBefore, structureAfter):
+    '''
+    @summary: differenceInCompoundStructure, skipping the unchanged branches of the dicts
+    (their diff is always empty, and dropped)
+    '''
+    if type(structureBefore) != dict:
+        return differenceInCompoundStructure(structureBefore, structureAfter)
+    if structureBefore is treeBefore.data and _isUnchangedHashedBranch(treeBefore, treeAfter, structureBefore, structureAfter):
+        return {} # the same trees, no need to look at the children
+    diffStructure = {}
+    try:
+        for keyA in structureAfter:
+            if keyA not in structureBefore:
+                diffStructure[keyA] = structureAfter[keyA]
+            elif not _isUnchangedHashedBranch(treeBefore, treeAfter, structureBefore[keyA], structureAfter[keyA]):
+                smallerDiff = _getDifferenceOfHashedTrees(treeBefore, treeAfter,
+                                                          structureBefore[keyA], structureAfter[keyA])
+                if smallerDiff is not None:
+                    if hasattr(smallerDiff,"__len__"):
+                        if len(smallerDiff) >0:
+                            diffStructure[keyA] = smallerDiff
+                    else:
+                        diffStructure[keyA] = smallerDiff
+    except Exception as e:
+        print(e)
+    return diffStructure
+
+def _getIntersectionOfHashedTrees(treeA, treeB, sourceDict, compareDict, allowMissing, listOfKeysAllowed):
+    '''
+    @summary: getIntersectionOfDicts without the deep copy, where an unchanged dict is intersected
+    with itself without looking at the other tree. The other entries use getIntersectionOfDicts
+    '''
+    returnDict = {}
+    for sourceKey in sourceDict:
+        if listOfKeysAllowed != [] and sourceKey not in listOfKeysAllowed:
+            continue
+        sourceValue = sourceDict[sourceKey]
+        if sourceKey not in compareDict:
+            if allowMissing == True:
+                returnDict[sourceKey] = sourceValue
+        elif type(sourceValue) == dict and type(compareDict[sourceKey]) == dict:
+            if _isUnchangedHashedBranch(treeA, treeB, sourceValue, compareDict[sourceKey]):
+                returnDict[sourceKey] = _getIntersectionWithItself(sourceValue)
+            else:
+                returnDict[sourceKey] = _getIntersectionOfHashedTrees(treeA, treeB, sourceValue,
+                                                                      compareDict[sourceKey], allowMissing, [])
+        else:
+            returnDict.update(getIntersectionOfDicts({sourceKey: sourceValue}, {sourceKey: compareDict[sourceKey]}, allowMissing))
+    return returnDict
+
+def _getIntersectionWithItself(sourceDict):
+    '''
+    @return: getIntersectionOfDicts(sourceDict, sourceDict), without the deep copy
+    '''
+    returnDict = {}
+    for sourceKey in sourceDict:
+        sourceValue = sourceDict[sourceKey]
+        valueType = type(sourceValue)
+        if valueType == dict:
+            returnDict[sourceKey] = _getIntersectionWithItself(sourceValue)
+        elif valueType == list or valueType == tuple or valueType == set:
+            #the same expression as getIntersectionOfDicts, so the order of the elements is the same too
+            returnValue = set(sourceValue).intersection(set(sourceValue))
+            returnDict[sourceKey] = returnValue if valueType == set else valueType(returnValue)
+        elif valueType == PersistentDict:
+            returnDict[sourceKey] = getIntersectionOfDicts(sourceValue, sourceValue)
+        elif _isNumpyArray(sourceValue):
+            returnDict[sourceKey] = numpy.intersect1d(_asNumpyArray(sourceValue), _asNumpyArray(sourceValue))
+        elif sourceValue == sourceValue:
+            returnDict[sourceKey] = sourceValue
+    return returnDict
+
+def _getDroppedEntriesOfHashedTrees(treeA, treeB, fromDict, resultDict, checkSingleValues):
+    '''
+    @summary: getDroppedEntriesInDict, where an unchanged branch only gives its empty containers
+    '''
+    droppedDict = {}
+    for mainKey in fromDict.keys():
+        if mainKey not in resultDict:
+            continue
+        mainValue = fromDict[mainKey]
+        compareValue = resultDict[mainKey]
+        if type(mainValue) in (dict, list, tuple, set) and _isUnchangedHashedBranch(treeA, treeB, mainValue, compareValue):
+            droppedDict[mainKey] = _getEmptyDroppedEntries(mainValue)
+        elif type(mainValue) == dict and type(compareValue) == dict:
+            droppedDict[mainKey] = _getDroppedEntriesOfHashedTrees(treeA, treeB, mainValue, compareValue, checkSingleValues)
+        else:
+            droppedDict.update(getDroppedEntriesInDict({mainKey: mainValue}, {mainKey: compareValue}, checkSingleValues))
+    return droppedDict
+
+def _getEmptyDroppedEntries(value):
+    '''
+    @return: getDroppedEntriesInDict of the value with itself, ie the same containers, empty
+    '''
+    valueType = type(value)
+    if valueType == dict:
+        droppedDict = {}
+        for key in value:
+            if type(value[key]) in (dict, list, tuple, set) or _isNumpyArray(value[key]):
+                droppedDict[key] = _getEmptyDroppedEntries(value[key])
+        return droppedDict
+    elif valueType == set:
+        return set()
+    elif _isNumpyArray(value):
+        return numpy.setdiff1d(_asNumpyArray(value), value) # empty, with the dtype of the array
+    return valueType()
+
 #===========================================================================
 # 
 #===========================================================================
@@ -647,11 +3537,11 @@ def getNthLevelLeavesOfDict(sourceDict,depthLevelOfKeys):
     else:        
         for singleKey in sourceDict.keys():
             if type(sourceDict[singleKey]) == dict:
-                returnKeys = returnKeys +  getNthLevelLeavesOfDict(sourceDict[singleKey],depthLevelOfKeys-1)
+                returnKeys.extend(getNthLevelLeavesOfDict(sourceDict[singleKey],depthLevelOfKeys-1))
             elif depthLevelOfKeys == 2:
                 if type(sourceDict[singleKey]) == list  or  type(sourceDict[singleKey]) == tuple or\
                             type(sourceDict[singleKey]) == set :
-                    returnKeys = returnKeys + list(sourceDict[singleKey])
+                    returnKeys.extend(sourceDict[singleKey])
                 else:#it is a primitive/single value
                     returnKeys.append(sourceDict[singleKey])    
     return returnKeys 
@@ -670,7 +3560,7 @@ def getNthLevelValuesOfDict(sourceDict,depthLevelOfKeys):
     else:        
         for singleKey in sourceDict.keys():
             if type(sourceDict[singleKey]) == dict:
-                returnValues = returnValues +  getNthLevelValuesOfDict(sourceDict[singleKey],depthLevelOfKeys-1)
+                returnValues.extend(getNthLevelValuesOfDict(sourceDict[singleKey],depthLevelOfKeys-1))
             elif depthLevelOfKeys == 2:
                 returnValues.append(sourceDict[singleKey])    
     return returnValues 
@@ -678,10 +3568,150 @@ def getNthLevelValuesOfDict(sourceDict,depthLevelOfKeys):
 # 
 #===================================================================
 
+class LevelIndex(object):
+    '''
+        The results of getNthLevelLeavesOfDict and getNthLevelValuesOfDict for EVERY depth,
+        from one walk of the dict, so that a query is O(result) instead of a walk of the whole dict.
+        The index is kept per top level key (object), so applyUpdate only re-walks the keys it touched.
+        If the dict is changed in any other way, call reindexKeys with the top level keys changed.
+    '''
+
+    def __init__(self, sourceDict):
+        self.sourceDict = sourceDict
+        self._leavesOfKey = {} # top level key -> [leaves at depth 2, leaves at depth 3, ...]
+        self._valuesOfKey = {} # top level key -> [values at depth 2, values at depth 3, ...]
+        self._leavesCache = {} # depth -> the list for all the keys, until the next change
+        self._valuesCache = {}
+        for singleKey in sourceDict.keys():
+            self._indexKey(singleKey)
+
+    def _indexKey(self, singleKey):
+        singleValue = self.sourceDict[singleKey]
+        if type(singleValue) == dict:
+            self._leavesOfKey[singleKey] = _getLeavesPerDepth(singleValue)
+            self._valuesOfKey[singleKey] = [[singleValue]] + _getValuesPerDepth(singleValue)[1:]
+        else:
+            if type(singleValue) == list or type(singleValue) == tuple or type(singleValue) == set:
+                self._leavesOfKey[singleKey] = [list(singleValue)]
+            else:#it is a primitive/single value
+                self._leavesOfKey[singleKey] = [[singleValue]]
+            self._valuesOfKey[singleKey] = [[singleValue]]
+
+    def reindexKeys(self, changedKeys):
+        '''
+            re-walks only these top level keys of the dict (added, changed or deleted ones)
+        '''
+        for singleKey in changedKeys:
+            if singleKey in self.sourceDict:
+                self._indexKey(singleKey)
+            else:
+                self._leavesOfKey.pop(singleKey, None)
+                self._valuesOfKey.pop(singleKey, None)
+        self._leavesCache = {}
+        self._valuesCache = {}
+
+    def applyUpdate(self, newValuesDict, updateConflicts = True, listsAdd = True, listReplace = False):
+        '''
+            same as updateAndReturnDict(self.sourceDict, newValuesDict, ...), but the dict is changed
+            IN PLACE, only the top level keys in newValuesDict are copied, and only they are re-indexed
+            @return: hasConflicts
+        '''
+        for sourceKey in newValuesDict.keys():
+            if sourceKey in self.sourceDict and \
+                    type(self.sourceDict[sourceKey]) != type(newValuesDict[sourceKey]) and \
+                    not _isNumpyArrayPair(self.sourceDict[sourceKey], newValuesDict[sourceKey]):
+                #same as updateAndReturnDict, nothing is updated
+                _recordMismatchEvent()
+                print("ERROR! the data types do not match, cannot update mismatched dicts")
+                return True
+        hasConflicts = False
+        for sourceKey in newValuesDict.keys():
+            if sourceKey in self.sourceDict:
+                (updatedDict, keyConflicts) = updateAndReturnDict({sourceKey: self.sourceDict[sourceKey]},
+                        {sourceKey: newValuesDict[sourceKey]}, updateConflicts, listsAdd, listReplace)
+                self.sourceDict[sourceKey] = updatedDict[sourceKey]
+                hasConflicts = hasConflicts or keyConflicts
+            else:
+                self.sourceDict[sourceKey] = _deepcopy(newValuesDict[sourceKey])
+        self.reindexKeys(newValuesDict.keys())
+        return hasConflicts
+
+    def getLeaves(self, depthLevelOfKeys):
+        '''
+            same as getNthLevelLeavesOfDict(self.sourceDict, depthLevelOfKeys)
+        '''
+        if depthLevelOfKeys == 1:
+            return list(self.sourceDict.keys())
+        return list(self._getLevel(depthLevelOfKeys, self._leavesOfKey, self._leavesCache))
+
+    def getValues(self, depthLevelOfKeys):
+        '''
+            same as getNthLevelValuesOfDict(self.sourceDict, depthLevelOfKeys)
+        '''
+        if depthLevelOfKeys == 1:
+            return [self.sourceDict]
+        return list(self._getLevel(depthLevelOfKeys, self._valuesOfKey, self._valuesCache))
+
+    def _getLevel(self, depthLevelOfKeys, indexOfKey, levelCache):
+        try:
+            return levelCache[depthLevelOfKeys]
+        except KeyError:
+            pass
+        levelList = []
+        if depthLevelOfKeys >= 2:
+            for singleKey in self.sourceDict.keys(): # the order of the keys is the order of the results
+                levelsOfKey = indexOfKey[singleKey]
+                if depthLevelOfKeys - 2 < len(levelsOfKey):
+                    levelList.extend(levelsOfKey[depthLevelOfKeys - 2])
+        levelCache[depthLevelOfKeys] = levelList
+        return levelList
+
+def _getLeavesPerDepth(sourceDict):
+    '''
+        @return: a list, where entry i is getNthLevelLeavesOfDict(sourceDict, i+1). Empty levels at the end are dropped
+    '''
+    levels = [list(sourceDict.keys())]
+    for singleKey in sourceDict.keys():
+        singleValue = sourceDict[singleKey]
+        if type(singleValue) == dict:
+            deeperLevels = _getLeavesPerDepth(singleValue)
+        elif type(singleValue) == list or type(singleValue) == tuple or type(singleValue) == set:
+            deeperLevels = [list(singleValue)]
+        else:#it is a primitive/single value
+            deeperLevels = [[singleValue]]
+        for levelIndex in range(len(deeperLevels)):
+            if levelIndex + 1 == len(levels):
+                levels.append([])
+            levels[levelIndex + 1].extend(deeperLevels[levelIndex])
+    return levels
+
+def _getValuesPerDepth(sourceDict):
+    '''
+        @return: a list, where entry i is getNthLevelValuesOfDict(sourceDict, i+1)
+    '''
+    levels = [[sourceDict], list(sourceDict.values())]
+    for singleValue in sourceDict.values():
+        if type(singleValue) == dict:
+            deeperLevels = _getValuesPerDepth(singleValue)[1:]
+            for levelIndex in range(len(deeperLevels)):
+                if levelIndex + 2 == len(levels):
+                    levels.append([])
+                levels[levelIndex + 2].extend(deeperLevels[levelIndex])
+    return levels
+
+#===================================================================
+# 
+#===================================================================
+
 def filterDict(sourceDict, allowedKeys = []):
     '''
         @summary: Go to the leaf nodes of a possibly recursive dict, and if empty, remove the preceeding key
+        A State has no empty entries, so only the allowedKeys (objs) are filtered, and a State is returned
     '''
+    if type(sourceDict) == State:
+        if allowedKeys == []:
+            return sourceDict
+        return sourceDict._filterAtoms(lambda atom: atom[0] in allowedKeys)
     nonEmptyDict = {}
     if allowedKeys == []:
         allowedKeys = sourceDict.keys()    
@@ -695,6 +3725,9 @@ def filterDict(sourceDict, allowedKeys = []):
             elif type(singleValue) == list or type(singleValue) == tuple or type(singleValue) == set:  
                 if len(singleValue) != 0: 
                     nonEmptyDict[singleKey] = singleValue
+            elif _isNumpyArray(singleValue):
+                if singleValue.size != 0:
+                    nonEmptyDict[singleKey] = singleValue
             elif singleValue != None or singleValue != "": # if single value is a primitive type
                 nonEmptyDict[singleKey] = singleValue        
         except:
@@ -705,4 +3738,161 @@ def filterDict(sourceDict, allowedKeys = []):
     #---END FOR loop through the keys
     return nonEmptyDict        
                 
-        
\ No newline at end of file
+        
+
+#===================================================================
+# 
+#===================================================================
+#Opt-in instrumentation of the dict algebra functions. When it is enabled, the module level
+#names of the functions below are replaced by wrappers that record the calls, so when it is
+#disabled the functions are the plain ones, with no overhead at all.
+#Enable it with the environment variable UTILITY_FUNCTIONS_INSTRUMENTATION=1 (and optionally
+#UTILITY_FUNCTIONS_INSTRUMENTATION_OUTPUT=<json file> to write the snapshot at exit), or with
+#"with instrumentDictAlgebra(): ..." and then getInstrumentationSnapshot()
+#NOTE: only calls made through this module's names are seen, not through names imported before
+#the instrumentation was enabled (from UtilityFunctions import getIntersectionOfDicts)
+
+_INSTRUMENTED_FUNCTION_NAMES = ["getIntersectionOfDicts", "getDifferenceOfDicts", "_getDifferenceOfDicts",
+                                "updateAndReturnDict", "_updateCopyOfDict", "_updateAndReturnPersistentDict",
+                                "getDroppedEntriesInDict", "differenceInCompoundStructure", "filterDict",
+                                "compareDicts", "_compareDicts"]
+_deepcopy = copy.deepcopy # replaced by a counting version while instrumented
+_originalFunctions = {} # name -> the plain function, while instrumented
+_instrumentationDepth = 0 # nested instrumentDictAlgebra blocks
+_functionStats = {}
+_activeCalls = threading.local() # the stack of instrumented functions running in this thread
+
+try:
+    _timer = time.perf_counter
+except AttributeError: # python 2
+    _timer = time.time
+
+def _getFunctionStats(name):
+    try:
+        return _functionStats[name]
+    except KeyError:
+        stats = _functionStats[name] = {"calls": 0, "topLevelCalls": 0, "totalSeconds": 0.0,
+                                        "minSeconds": None, "maxSeconds": 0.0, "maxRecursionDepth": 0,
+                                        "deepcopyCalls": 0, "deepcopyObjects": 0, "mismatchEvents": 0}
+        return stats
+
+def _getActiveCallStack():
+    try:
+        return _activeCalls.stack
+    except AttributeError:
+        _activeCalls.stack = []
+        return _activeCalls.stack
+
+def _makeInstrumentedFunction(name, function):
+    def instrumentedFunction(*args, **kwargs):
+        stats = _getFunctionStats(name)
+        callStack = _getActiveCallStack()
+        depth = callStack.count(name) + 1
+        stats["calls"] += 1
+        if depth > stats["maxRecursionDepth"]:
+            stats["maxRecursionDepth"] = depth
+        callStack.append(name)
+        startTime = _timer()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            callStack.pop()
+            if depth == 1: #the time of recursive calls is already inside the outer call
+                elapsedSeconds = _timer() - startTime
+                stats["topLevelCalls"] += 1
+                stats["totalSeconds"] += elapsedSeconds
+                stats["maxSeconds"] = max(stats["maxSeconds"], elapsedSeconds)
+                if stats["minSeconds"] == None or elapsedSeconds < stats["minSeconds"]:
+                    stats["minSeconds"] = elapsedSeconds
+    instrumentedFunction.__name__ = function.__name__
+    instrumentedFunction.__doc__ = function.__doc__
+    return instrumentedFunction
+
+def _countingDeepcopy(value):
+    memo = {}
+    copiedValue = copy.deepcopy(value, memo)
+    callStack = _getActiveCallStack()
+    stats = _getFunctionStats(callStack[-1] if len(callStack) > 0 else "<outside>")
+    stats["deepcopyCalls"] += 1
+    stats["deepcopyObjects"] += len(memo) # every container copied (and a few kept alive) is in the memo
+    return copiedValue
+
+def _recordMismatchEvent():
+    '''!@brief called where the functions print a type mismatch
+    '''
+    if _instrumentationDepth > 0:
+        callStack = _getActiveCallStack()
+        _getFunctionStats(callStack[-1] if len(callStack) > 0 else "<outside>")["mismatchEvents"] += 1
+
+def enableInstrumentation(reset = True):
+    '''!@brief starts recording the calls of the dict algebra functions
+    @param reset: clear what was recorded before. Only done when instrumentation was off, so a nested
+    block (or one run with the UTILITY_FUNCTIONS_INSTRUMENTATION environment variable set) adds to the
+    stats of the outer one
+    '''
+    global _instrumentationDepth, _deepcopy
+    _instrumentationDepth += 1
+    if _instrumentationDepth > 1:
+        return
+    if reset:
+        resetInstrumentation()
+    moduleNames = globals()
+    for name in _INSTRUMENTED_FUNCTION_NAMES:
+        _originalFunctions[name] = moduleNames[name]
+        moduleNames[name] = _makeInstrumentedFunction(name, moduleNames[name])
+    _deepcopy = _countingDeepcopy
+
+def disableInstrumentation():
+    '''!@brief puts the plain functions back. What was recorded is kept for getInstrumentationSnapshot
+    '''
+    global _instrumentationDepth, _deepcopy
+    if _instrumentationDepth == 0:
+        return
+    _instrumentationDepth -= 1
+    if _instrumentationDepth > 0:
+        return
+    moduleNames = globals()
+    for name in _originalFunctions:
+        moduleNames[name] = _originalFunctions[name]
+    _originalFunctions.clear()
+    _deepcopy = copy.deepcopy
+
+def isInstrumentationEnabled():
+    return _instrumentationDepth > 0
+
+def resetInstrumentation():
+    _functionStats.clear()
+
+@contextlib.contextmanager
+def instrumentDictAlgebra(reset = True):
+    '''!@brief "with instrumentDictAlgebra(): ..." records the calls made in the block
+    '''
+    enableInstrumentation(reset)
+    try:
+        yield
+    finally:
+        disableInstrumentation()
+
+def getInstrumentationSnapshot():
+    '''!@return: a dict of function name -> its stats (calls, topLevelCalls, totalSeconds,
+    meanSeconds, minSeconds, maxSeconds per top level call, maxRecursionDepth, deepcopyCalls,
+    deepcopyObjects, mismatchEvents). It is a copy, it does not change as more calls are made
+    '''
+    snapshot = {}
+    for name in _functionStats:
+        stats = dict(_functionStats[name])
+        stats["meanSeconds"] = stats["totalSeconds"] / stats["topLevelCalls"] if stats["topLevelCalls"] > 0 else None
+        snapshot[name] = stats
+    return snapshot
+
+def getInstrumentationSnapshotJson(indent = None):
+    return json.dumps(getInstrumentationSnapshot(), indent = indent, sort_keys = True)
+
+def _writeInstrumentationSnapshot(outputFileName):
+    with open(outputFileName, "w") as outputFile:
+        outputFile.write(getInstrumentationSnapshotJson(indent = 2))
+
+if os.environ.get("UTILITY_FUNCTIONS_INSTRUMENTATION", "") not in ["", "0"]:
+    enableInstrumentation()
+    if os.environ.get("UTILITY_FUNCTIONS_INSTRUMENTATION_OUTPUT", "") != "":
+        atexit.register(_writeInstrumentationSnapshot, os.environ["UTILITY_FUNCTIONS_INSTRUMENTATION_OUTPUT"])
@@ -0,0 +1,306 @@
+"""!@ benchmarks for the functions in UtilityFunctions, on seeded synthetic planning structures.
+Every benchmark is run for each size (the number of atoms in the generated structures), and
+the time and peak memory of the call are recorded. The results are printed (or written) as
+JSON, and --compare flags the benchmarks that got slower than in an older JSON file, so that
+regressions show up between commits.
+eg: python benchmarkUtilityFunctions.py --sizes 100 1000 10000 --output new.json --compare old.json
+    python benchmarkUtilityFunctions.py --suite reduce --states 4000 --workers 8
+"""
+
+import argparse
+from collections import OrderedDict
+import json
+import multiprocessing
+import random
+import sys
+import time
+
+import UtilityFunctions
+
+try:
+    _timer = time.perf_counter
+except AttributeError: # python 2
+    _timer = time.time
+try:
+    import tracemalloc
+except ImportError: # python 2, the peak memory is not measured
+    tracemalloc = None
+
+
+#===============================================================================
+# 
+#===============================================================================
+
+def generateStateDict(rng, numObjects, numProps = 4, numValues = 8, valuesPerProp = 3):
+    '''!@brief a random obj -> prop -> SET of values state, the shape returned by
+    convertFlattenedAtomListToDict
+    @param rng: a random.Random, so that the states are the same for the same seed
+    '''
+    state = {}
+    for objIndex in range(numObjects):
+        propDict = {}
+        for propIndex in range(numProps):
+            propDict["prop" + str(propIndex)] = \
+                set("val" + str(rng.randrange(numValues)) for _ in range(valuesPerProp))
+        state["obj" + str(objIndex)] = propDict
+    return state
+
+def generateStateDictOfSize(rng, numAtoms, valueType = set):
+    '''!@brief a state with about numAtoms atoms (4 props per object, upto 3 values per prop)
+    @param valueType: set, list or tuple, the container of the values
+    '''
+    state = generateStateDict(rng, max(1, numAtoms // 12))
+    if valueType != set:
+        for obj in state:
+            for prop in state[obj]:
+                state[obj][prop] = valueType(sorted(state[obj][prop]))
+    return state
+
+def generateSuccessorState(rng, state, numChanges):
+    '''!@brief a copy of the state, with numChanges props given a different value.
+    Only the changed objects are copied, like a successor made by an action
+    '''
+    successor = dict(state)
+    objects = list(state.keys())
+    for _ in range(numChanges):
+        obj = rng.choice(objects)
+        successor[obj] = dict(successor[obj])
+        prop = rng.choice(list(successor[obj].keys()))
+        oldValues = successor[obj][prop]
+        newValues = ["val" + str(rng.randrange(100, 200))] + list(oldValues)[1:]
+        successor[obj][prop] = type(oldValues)(newValues)
+    return successor
+
+def generateTrajectory(rng, numStates, numObjects, changesPerStep = 2, **stateOptions):
+    '''!@brief a list of states where each state changes a few props of the previous one,
+    like the states along a search path
+    '''
+    currentState = generateStateDict(rng, numObjects, **stateOptions)
+    trajectory = [currentState]
+    numValues = stateOptions.get("numValues", 8)
+    for _ in range(numStates - 1):
+        currentState = dict((obj, dict(currentState[obj])) for obj in currentState)
+        for _ in range(changesPerStep):
+            obj = "obj" + str(rng.randrange(numObjects))
+            prop = rng.choice(list(currentState[obj].keys()))
+            currentState[obj][prop] = set(["val" + str(rng.randrange(numValues))]) | \
+                set(list(currentState[obj][prop])[1:])
+        trajectory.append(currentState)
+    return trajectory
+
+def generateAtomList(rng, numAtoms, partSeparator = "+"):
+    '''!@brief numAtoms "obj+prop+value" strings, with repeats, like a trace of visited atoms
+    '''
+    numObjects = max(1, numAtoms // 20)
+    return [partSeparator.join(["obj" + str(rng.randrange(numObjects)),
+                                "prop" + str(rng.randrange(4)),
+                                "val" + str(rng.randrange(8))]) for _ in range(numAtoms)]
+
+def generateNestedList(rng, numAtoms, maxDepth = 50):
+    '''!@brief a list of numAtoms leaves, nested upto maxDepth levels, like a hierarchical plan
+    '''
+    root = []
+    stack = [root]
+    for atomIndex in range(numAtoms):
+        choice = rng.random()
+        if choice < 0.1 and len(stack) < maxDepth:
+            subList = []
+            stack[-1].append(subList)
+            stack.append(subList)
+        elif choice < 0.2 and len(stack) > 1:
+            stack.pop()
+        stack[-1].append("action" + str(atomIndex % 97))
+    return root
+
+def generateOrderedDictState(rng, numAtoms):
+    '''!@brief the same as generateStateDictOfSize, with OrderedDicts (eg: a plan indexed by step)
+    '''
+    state = generateStateDictOfSize(rng, numAtoms, list)
+    return OrderedDict((obj, OrderedDict(sorted(state[obj].items()))) for obj in sorted(state.keys()))
+
+#===============================================================================
+# 
+#===============================================================================
+
+def _setupPairOfStates(rng, size, valueType = set):
+    state = generateStateDictOfSize(rng, size, valueType)
+    return (state, generateSuccessorState(rng, state, max(1, size // 100)))
+
+#name -> (setup(rng, size) that returns the args, the function that is timed)
+BENCHMARKS = OrderedDict([
+    ("getIntersectionOfDicts", (lambda rng, size: _setupPairOfStates(rng, size),
+                                UtilityFunctions.getIntersectionOfDicts)),
+    ("updateAndReturnDict", (lambda rng, size: _setupPairOfStates(rng, size),
+                             UtilityFunctions.updateAndReturnDict)),
+    ("getDifferenceOfDicts.sets", (lambda rng, size: _setupPairOfStates(rng, size),
+                                   UtilityFunctions.getDifferenceOfDicts)),
+    ("getDifferenceOfDicts.lists", (lambda rng, size: _setupPairOfStates(rng, size, list),
+                                    UtilityFunctions.getDifferenceOfDicts)),
+    ("compareDicts", (lambda rng, size: _setupPairOfStates(rng, size),
+                      UtilityFunctions.compareDicts)),
+    ("differenceInCompoundStructure", (lambda rng, size: _setupPairOfStates(rng, size),
+                                       UtilityFunctions.differenceInCompoundStructure)),
+    ("differenceInCompoundStructure.OrderedDict",
+        (lambda rng, size: (generateOrderedDictState(rng, size), generateOrderedDictState(rng, size)),
+         UtilityFunctions.differenceInCompoundStructure)),
+    ("convertFlattenedAtomListToDict", (lambda rng, size: (generateAtomList(rng, size),),
+                                        UtilityFunctions.convertFlattenedAtomListToDict)),
+    ("convertFlattenedAtomListToDict_ver2", (lambda rng, size: (generateAtomList(rng, size),),
+                                             UtilityFunctions.convertFlattenedAtomListToDict_ver2)),
+    ("convertFlattenedAtomListToDict_ver3", (lambda rng, size: (generateAtomList(rng, size),),
+                                             UtilityFunctions.convertFlattenedAtomListToDict_ver3)),
+    ("convertFlattenedAtomStringListToDictWithListValues",
+        (lambda rng, size: (generateAtomList(rng, size),),
+         UtilityFunctions.convertFlattenedAtomStringListToDictWithListValues)),
+    ("getSingleStringRepresentationOfState", (lambda rng, size: (generateStateDictOfSize(rng, size),),
+                                              UtilityFunctions.getSingleStringRepresentationOfState)),
+    ("getLayeredStringFormOfDataStructure", (lambda rng, size: (generateStateDictOfSize(rng, size, list),),
+                                             UtilityFunctions.getLayeredStringFormOfDataStructure)),
+    ("getLayeredStringFormOfDataStructure.OrderedDict",
+        (lambda rng, size: (generateOrderedDictState(rng, size),),
+         UtilityFunctions.getLayeredStringFormOfDataStructure)),
+    ("flattenList", (lambda rng, size: (generateNestedList(rng, size),),
+                     UtilityFunctions.flattenList)),
+    ("convertNestedListToNestedTuple", (lambda rng, size: (generateNestedList(rng, size),),
+                                        UtilityFunctions.convertNestedListToNestedTuple)),
+])
+
+#===============================================================================
+# 
+#===============================================================================
+
+def timeCall(function, *args):
+    '''!@return (seconds, result) of one call
+    '''
+    startTime = _timer()
+    result = function(*args)
+    return (_timer() - startTime, result)
+
+def timeLoops(function, args, minSeconds = 0.2):
+    '''!@brief calls the function 1, 2, 5, 10, 20, 50, ... times in a loop until the loop takes at
+    least minSeconds (like timeit's autorange), so a fast call is not timed below the timer's
+    resolution and the scheduler's noise
+    @return (seconds per call, number of calls in the loop)
+    '''
+    loops = 1
+    while True:
+        for multiplier in (1, 2, 5):
+            numCalls = loops * multiplier
+            startTime = _timer()
+            for _ in range(numCalls):
+                function(*args)
+            seconds = _timer() - startTime
+            if seconds >= minSeconds:
+                return (seconds / numCalls, numCalls)
+        loops *= 10
+
+def measurePeakMemory(function, *args):
+    '''!@return the peak bytes allocated during one call (None if tracemalloc is not available)
+    '''
+    if tracemalloc == None:
+        return None
+    tracemalloc.start()
+    try:
+        function(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def runBenchmark(name, size, repeat = 3, seed = 0, minSeconds = 0.2):
+    '''!@brief runs one benchmark, the time is the best of repeat timeLoops measurements of at least
+    minSeconds each (the memory is measured in a separate call, as tracing slows the calls down)
+    @return: the result dict, the seconds are per call
+    '''
+    (setup, function) = BENCHMARKS[name]
+    args = setup(random.Random(seed), size)
+    measurements = [timeLoops(function, args, minSeconds) for _ in range(repeat)]
+    times = [seconds for (seconds, numCalls) in measurements]
+    return {"benchmark": name, "size": size, "seconds": min(times), "meanSeconds": sum(times) / len(times),
+            "loops": measurements[0][1], "peakBytes": measurePeakMemory(function, *args)}
+
+def benchmarkReduceStates(numStates, numObjects, workers, seed = 0):
+    '''!@brief the serial fold vs reduceStates, for the intersection and the union of the states
+    @return: a list of result dicts
+    '''
+    rng = random.Random(seed)
+    states = generateTrajectory(rng, numStates, numObjects)
+    results = []
+    for op in ["intersection", "union"]:
+        (serialSeconds, serialResult) = timeCall(UtilityFunctions._foldStates, (op, states))
+        (parallelSeconds, parallelResult) = timeCall(UtilityFunctions.reduceStates, states, op, workers)
+        results.append({"benchmark": "reduceStates", "op": op, "states": numStates,
+                        "objects": numObjects, "workers": workers,
+                        "serialSeconds": serialSeconds, "parallelSeconds": parallelSeconds,
+                        "speedup": serialSeconds / parallelSeconds if parallelSeconds > 0 else None,
+                        "sameResult": serialResult == parallelResult})
+    return results
+
+def compareReports(oldReport, newReport, tolerance = 0.2):
+    '''!@brief matches the results by (benchmark, size)
+    @return: list of (benchmark, size, oldSeconds, newSeconds) that are slower by more than tolerance
+    '''
+    oldSeconds = dict(((result["benchmark"], result.get("size")), result["seconds"])
+                      for result in oldReport["results"] if "seconds" in result)
+    regressions = []
+    for result in newReport["results"]:
+        key = (result["benchmark"], result.get("size"))
+        if "seconds" in result and key in oldSeconds and oldSeconds[key] > 0:
+            if result["seconds"] > oldSeconds[key] * (1 + tolerance):
+                regressions.append((key[0], key[1], oldSeconds[key], result["seconds"]))
+    return regressions
+
+#===============================================================================
+# 
+#===============================================================================
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--suite", choices = ["functions", "reduce", "all"], default = "functions")
+    parser.add_argument("--sizes", type = int, nargs = "+", default = [100, 1000, 10000, 100000],
+                        help = "atoms per generated structure, eg: 100 1000 10000 100000 1000000")
+    parser.add_argument("--only", nargs = "+", default = None, help = "names of the benchmarks to run")
+    parser.add_argument("--repeat", type = int, default = 3)
+    parser.add_argument("--min-time", dest = "minTime", type = float, default = 0.2,
+                        help = "each of the repeat measurements loops the call for at least this many seconds")
+    parser.add_argument("--states", type = int, default = 2000, help = "states to reduce")
+    parser.add_argument("--objects", type = int, default = 200, help = "objects per state to reduce")
+    parser.add_argument("--workers", type = int, default = multiprocessing.cpu_count())
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--output", default = None, help = "JSON file to write, default is stdout")
+    parser.add_argument("--compare", default = None, help = "older JSON file to check for regressions")
+    parser.add_argument("--tolerance", type = float, default = 0.2, help = "slowdown allowed by --compare")
+    parser.add_argument("--list", action = "store_true", help = "print the benchmark names and exit")
+    arguments = parser.parse_args(argv)
+
+    if arguments.list:
+        for name in BENCHMARKS:
+            print(name)
+        return 0
+    results = []
+    if arguments.suite in ["functions", "all"]:
+        names = arguments.only if arguments.only != None else list(BENCHMARKS.keys())
+        for name in names:
+            for size in arguments.sizes:
+                results.append(runBenchmark(name, size, arguments.repeat, arguments.seed, arguments.minTime))
+                sys.stderr.write("%s %d: %.6fs\n" % (name, size, results[-1]["seconds"]))
+    if arguments.suite in ["reduce", "all"]:
+        results.extend(benchmarkReduceStates(arguments.states, arguments.objects,
+                                             arguments.workers, arguments.seed))
+    report = {"python": sys.version.split()[0], "cores": multiprocessing.cpu_count(), "results": results}
+    if arguments.output == None:
+        print(json.dumps(report, indent = 2))
+    else:
+        with open(arguments.output, "w") as outputFile:
+            json.dump(report, outputFile, indent = 2)
+
+    if arguments.compare != None:
+        with open(arguments.compare) as compareFile:
+            regressions = compareReports(json.load(compareFile), report, arguments.tolerance)
+        for (name, size, oldSeconds, newSeconds) in regressions:
+            sys.stderr.write("REGRESSION %s %s: %.6fs -> %.6fs\n" % (name, size, oldSeconds, newSeconds))
+        if len(regressions) > 0:
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,1126 @@
+"""!@ tests for UtilityFunctions. The faster structures and functions are checked against the
+plain dict results, or against the older (recursive or quadratic) versions kept here, on seeded
+random states, and the disk structures are reopened after a simulated crash.
+eg: python -m pytest test_UtilityFunctions.py    or    python -m unittest test_UtilityFunctions
+"""
+
+import contextlib
+import copy
+import json
+import os
+import pickle
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+from collections import OrderedDict
+
+import UtilityFunctions
+
+try:
+    from StringIO import StringIO
+except ImportError: # python 3
+    from io import StringIO
+
+
+@contextlib.contextmanager
+def silencedStdout():
+    '''!@brief the dict algebra prints the type mismatches it finds in the random states
+    @return: the StringIO that gets the output
+    '''
+    originalStdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        yield sys.stdout
+    finally:
+        sys.stdout = originalStdout
+
+def generateLeaf(rng):
+    choice = rng.randrange(5)
+    if choice == 0:
+        return [rng.randrange(4) for _ in range(rng.randrange(4))]
+    elif choice == 1:
+        return tuple([rng.randrange(4) for _ in range(2)])
+    elif choice == 2:
+        return set([rng.randrange(5) for _ in range(rng.randrange(3))])
+    return rng.choice([1, 2, "a", None, 1.5])
+
+def generateNestedDict(rng, depth):
+    nestedDict = {}
+    for _ in range(rng.randrange(6)):
+        if depth > 0 and rng.random() < 0.5:
+            nestedDict["k%d" % rng.randrange(6)] = generateNestedDict(rng, depth - 1)
+        else:
+            nestedDict["k%d" % rng.randrange(6)] = generateLeaf(rng)
+    return nestedDict
+
+def getAllPaths(nestedDict, path = ()):
+    paths = []
+    for key in nestedDict:
+        paths.append(path + (key,))
+        if type(nestedDict[key]) == dict:
+            paths.extend(getAllPaths(nestedDict[key], path + (key,)))
+    return paths
+
+#===============================================================================
+#
+#===============================================================================
+
+class HashedTreeTest(unittest.TestCase):
+
+    def testSameResultsAsPlainDicts(self):
+        rng = random.Random(9)
+        for _ in range(1000):
+            treeA = UtilityFunctions.HashedTree(generateNestedDict(rng, 4))
+            snapshotA = copy.deepcopy(treeA.data)
+            treeA.getDigest()
+            treeB = treeA.copy()
+            for _ in range(rng.randrange(4)):
+                paths = getAllPaths(treeB.data)
+                if len(paths) == 0:
+                    break
+                path = rng.choice(paths)
+                if rng.random() < 0.3:
+                    treeB.deleteValue(path)
+                else:
+                    treeB.setValue(path, generateNestedDict(rng, 1) if rng.random() < 0.3 else generateLeaf(rng))
+            self.assertEqual(treeA.data, snapshotA) # copy on write, the original is unchanged
+            allowMissing = rng.random() < 0.5
+            checkSingleValues = rng.random() < 0.5
+            with silencedStdout():
+                for (treeX, treeY) in [(treeA, treeB), (treeB, treeA)]:
+                    dictX = copy.deepcopy(treeX.data)
+                    dictY = copy.deepcopy(treeY.data)
+                    self.assertEqual(UtilityFunctions.differenceInCompoundStructure(treeX, treeY),
+                                     UtilityFunctions.differenceInCompoundStructure(dictX, dictY))
+                    self.assertEqual(UtilityFunctions.getIntersectionOfDicts(treeX, treeY, allowMissing),
+                                     UtilityFunctions.getIntersectionOfDicts(dictX, dictY, allowMissing))
+                    self.assertEqual(UtilityFunctions.getDroppedEntriesInDict(treeX, treeY, checkSingleValues),
+                                     UtilityFunctions.getDroppedEntriesInDict(dictX, dictY, checkSingleValues))
+            self.assertEqual(treeB.getDigest(), UtilityFunctions.HashedTree(copy.deepcopy(treeB.data)).getDigest())
+
+    def testDigestsAfterEdits(self):
+        rng = random.Random(3)
+        for _ in range(200):
+            trees = [UtilityFunctions.HashedTree(generateNestedDict(rng, 3))]
+            for _ in range(20):
+                tree = rng.choice(trees)
+                if rng.random() < 0.3:
+                    tree = tree.copy()
+                    trees.append(tree)
+                if rng.random() < 0.5:
+                    tree.getDigest()
+                paths = getAllPaths(tree.data)
+                if len(paths) > 0:
+                    path = rng.choice(paths)
+                    if rng.random() < 0.3:
+                        tree.deleteValue(path)
+                    else:
+                        tree.setValue(path, generateNestedDict(rng, 1) if rng.random() < 0.4 else generateLeaf(rng))
+                for otherTree in trees: # the digests updated from the changed entries only
+                    self.assertEqual(otherTree.getDigest(), UtilityFunctions.HashedTree(copy.deepcopy(otherTree.data)).getDigest())
+
+    def testDiscardedCopiesKeepNothingAlive(self):
+        rootTree = UtilityFunctions.HashedTree(dict([("o%d" % index, {"at": set(["l%d" % index]), "on": {"x": [index]}})
+                                                    for index in range(200)]))
+        rootTree.getDigest()
+        numDigests = len(rootTree._digests)
+        for index in range(300):
+            successorTree = rootTree.copy()
+            successorTree.setValue(("o%d" % (index % 200), "at"), set(["moved"]))
+            self.assertEqual(UtilityFunctions.differenceInCompoundStructure(rootTree, successorTree),
+                             {"o%d" % (index % 200): {"at": set(["moved"])}})
+            self.assertEqual(len(successorTree._digests), numDigests)
+        self.assertEqual(len(rootTree._digests), numDigests)
+
+    @unittest.skipIf(UtilityFunctions.numpy == None, "needs numpy")
+    def testChangedArrayLeaf(self):
+        numpy = UtilityFunctions.numpy
+        before = {"x": {"a": numpy.array([1, 2, 3]), "b": 1}, "y": {"c": 2}}
+        after = {"x": {"a": numpy.array([1, 2, 4]), "b": 1}, "y": {"c": 2}}
+        for diff in [UtilityFunctions.differenceInCompoundStructure(before, after),
+                     UtilityFunctions.differenceInCompoundStructure(UtilityFunctions.HashedTree(before),
+                                                                    UtilityFunctions.HashedTree(after))]:
+            self.assertEqual(list(diff.keys()), ["x"])
+            self.assertEqual(list(diff["x"]["a"]), [1, 2, 4])
+
+#===============================================================================
+#
+#===============================================================================
+
+@unittest.skipIf(UtilityFunctions.numpy == None, "needs numpy")
+class NumpyValuesTest(unittest.TestCase):
+
+    def testArrayWithListIsUpdatedInPlace(self):
+        numpy = UtilityFunctions.numpy
+        sourceDict = {"x": numpy.array([1, 2]), "y": {"z": 1}}
+        newValuesDict = {"x": [2, 3]}
+        with silencedStdout():
+            (expectedDict, expectedConflicts) = UtilityFunctions.updateAndReturnDict(copy.deepcopy(sourceDict), newValuesDict)
+            levelIndex = UtilityFunctions.LevelIndex(sourceDict)
+            hasConflicts = levelIndex.applyUpdate(newValuesDict)
+        self.assertEqual(hasConflicts, expectedConflicts)
+        self.assertEqual(list(levelIndex.sourceDict["x"]), list(expectedDict["x"]))
+        self.assertEqual(list(levelIndex.sourceDict["x"]), [1, 2, 3])
+
+    def testDroppedEntriesOfArrayWithList(self):
+        numpy = UtilityFunctions.numpy
+        fromDict = {"x": numpy.array([1, 2, 3]), "y": {"z": numpy.array([4, 5])}}
+        resultDict = {"x": [2, 3], "y": {"z": numpy.array([5])}}
+        with silencedStdout() as output:
+            droppedDict = UtilityFunctions.getDroppedEntriesInDict(fromDict, resultDict)
+            comparedDict = UtilityFunctions.compareDicts(fromDict, resultDict)["dropped"]
+        self.assertEqual(output.getvalue(), "") # an array with a list is not a mismatch
+        for dropped in [droppedDict, comparedDict]:
+            self.assertEqual(list(dropped.keys()), ["y"]) # nothing is dropped from the array paired with a list
+            self.assertEqual(list(dropped["y"]["z"]), [4])
+
+    def testOnlyOneDimensionalArrays(self):
+        numpy = UtilityFunctions.numpy
+        matrixDict = {"x": numpy.array([[1, 2], [3, 4]])}
+        for otherDict in [{"x": numpy.array([[1, 2], [5, 6]])}, {"x": [1, 2]}, {"x": [[1, 2]]}]:
+            self.assertRaises(ValueError, UtilityFunctions.getIntersectionOfDicts, matrixDict, otherDict)
+            self.assertRaises(ValueError, UtilityFunctions.getDifferenceOfDicts, matrixDict, otherDict)
+            self.assertRaises(ValueError, UtilityFunctions.getDroppedEntriesInDict, matrixDict, otherDict)
+            self.assertRaises(ValueError, UtilityFunctions.updateAndReturnDict, copy.deepcopy(matrixDict), otherDict)
+            self.assertRaises(ValueError, UtilityFunctions.compareDicts, matrixDict, otherDict)
+
+#===============================================================================
+#
+#===============================================================================
+
+class PersistentDictTest(unittest.TestCase):
+
+    def testSetAndDeleteMatchDict(self):
+        rng = random.Random(4)
+        for _ in range(50):
+            plainDict = {}
+            persistentDict = UtilityFunctions.PersistentDict()
+            versions = []
+            for _ in range(400):
+                key = rng.choice([rng.randrange(300), "s%d" % rng.randrange(300), (rng.randrange(5), "t")])
+                if key in plainDict and rng.random() < 0.4:
+                    del plainDict[key]
+                    persistentDict = persistentDict.delete(key)
+                else:
+                    value = rng.randrange(1000)
+                    plainDict[key] = value
+                    persistentDict = persistentDict.set(key, value)
+                if rng.random() < 0.05:
+                    versions.append((dict(plainDict), persistentDict))
+            self.assertEqual(len(persistentDict), len(plainDict))
+            self.assertEqual(persistentDict.toDict(), plainDict)
+            self.assertEqual(set(persistentDict.keys()), set(plainDict.keys()))
+            self.assertEqual(sorted(persistentDict.items(), key = repr), sorted(plainDict.items(), key = repr))
+            for key in plainDict:
+                self.assertTrue(key in persistentDict)
+                self.assertTrue(key in persistentDict.keys())
+            self.assertFalse("missing" in persistentDict)
+            self.assertRaises(KeyError, persistentDict.delete, "missing")
+            for (oldDict, oldPersistentDict) in versions: # the older versions are not changed
+                self.assertEqual(oldPersistentDict.toDict(), oldDict)
+
+    def testDictAlgebraMatchesDict(self):
+        rng = random.Random(5)
+        for _ in range(300):
+            dictA = generateNestedDict(rng, 3)
+            dictB = generateNestedDict(rng, 3)
+            with silencedStdout():
+                self.assertEqual(UtilityFunctions.getIntersectionOfDicts(UtilityFunctions.PersistentDict.fromDict(dictA),
+                                                                         UtilityFunctions.PersistentDict.fromDict(dictB)).toDict(),
+                                 UtilityFunctions.getIntersectionOfDicts(dictA, dictB))
+                (updatedDict, conflicts) = UtilityFunctions.updateAndReturnDict(dictA, dictB)
+                (updatedPersistentDict, persistentConflicts) = UtilityFunctions.updateAndReturnDict(
+                    UtilityFunctions.PersistentDict.fromDict(dictA), dictB)
+            self.assertEqual(updatedPersistentDict.toDict(), updatedDict)
+            self.assertEqual(persistentConflicts, conflicts)
+
+#===============================================================================
+#
+#===============================================================================
+
+class PickleArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.pickleFilePath = os.path.join(self.folder, "states.pkl")
+        with UtilityFunctions.PickleArchiveWriter(self.pickleFilePath, batchSize = 3) as writer:
+            for index in range(10):
+                writer.append({"index": index})
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def getIndices(self):
+        return [state["index"] for state in UtilityFunctions.PickleArchiveReader(self.pickleFilePath)]
+
+    def testIndexBehindTheData(self):
+        #a crash between the data write and the index write
+        with open(self.pickleFilePath + ".idx", "rb") as indexFile:
+            indexBytes = indexFile.read()
+        with open(self.pickleFilePath + ".idx", "wb") as indexFile:
+            indexFile.write(indexBytes[:-2 * struct.calcsize("<Q")])
+        self.assertFalse(UtilityFunctions._isPickleArchiveIndexValid(self.pickleFilePath))
+        self.assertEqual(self.getIndices(), list(range(10)))
+        self.assertTrue(UtilityFunctions._isPickleArchiveIndexValid(self.pickleFilePath))
+
+    def testTornLastObject(self):
+        with open(self.pickleFilePath, "ab") as pickleFile:
+            pickleFile.write(b"\x80\x02}q\x00(X")
+        self.assertEqual(self.getIndices(), list(range(10)))
+        with UtilityFunctions.PickleArchiveWriter(self.pickleFilePath) as writer:
+            writer.append({"index": 10})
+        self.assertEqual(self.getIndices(), list(range(11)))
+        self.assertTrue(UtilityFunctions._isPickleArchiveIndexValid(self.pickleFilePath))
+
+#===============================================================================
+#
+#===============================================================================
+
+class DiskBackedClosedListTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def testReopenAfterPartialWrite(self):
+        distinctStates = [{"truck%d" % (index % 7): {"at": "loc%d" % index}, "robot": {"holding": set([index % 3])}}
+                          for index in range(500)]
+        closedList = UtilityFunctions.DiskBackedClosedList(self.folder, expectedItems = 1000, flushThreshold = 100)
+        for state in distinctStates:
+            self.assertTrue(closedList.add(state))
+            self.assertFalse(closedList.add(state))
+        numFlushed = len(distinctStates) - closedList.getStats()["unflushed"]
+        #a crash while a segment was being written leaves a partial .tmp file, and loses the unflushed keys
+        with open(os.path.join(self.folder, "segment_%08d.keys.tmp" % 99), "wb") as partialFile:
+            partialFile.write(b"\x01" * 7)
+        reopenedList = UtilityFunctions.DiskBackedClosedList(self.folder, expectedItems = 1000, flushThreshold = 100)
+        try:
+            self.assertEqual(len(reopenedList), numFlushed)
+            self.assertTrue(all([state in reopenedList for state in distinctStates[:numFlushed]]))
+            for state in distinctStates[numFlushed:]:
+                self.assertTrue(reopenedList.add(state))
+            reopenedList.compact()
+            self.assertEqual(len(reopenedList), len(distinctStates))
+            self.assertTrue(all([state in reopenedList for state in distinctStates]))
+        finally:
+            reopenedList.close()
+            closedList._memtable = set() # the crashed instance must not write its keys now
+            closedList.close()
+
+    def testStatesThatAreNotEqualAreAllNew(self):
+        rng = random.Random(3)
+        states = [{"o": {"p": "a"}}, {"o": {"p": ["a"]}}, {"o": {"p": ("a",)}}, {"o": {"p": set(["a"])}},
+                  {"o": {"p": [1, 2]}}, {"o": {"p": [2, 1]}}, {}, {"o": {}}]
+        for _ in range(300):
+            state = generateNestedDict(rng, 2)
+            if state not in states:
+                states.append(state)
+        closedList = UtilityFunctions.DiskBackedClosedList(self.folder, flushThreshold = 50)
+        try:
+            for state in states:
+                self.assertTrue(closedList.add(state))
+            self.assertTrue(all([state in closedList for state in states]))
+            self.assertEqual(len(closedList), len(states))
+        finally:
+            closedList.close()
+
+    def testKeyOfStateMatchesItsDict(self):
+        rng = random.Random(4)
+        closedList = UtilityFunctions.DiskBackedClosedList(self.folder, expectedItems = 1000)
+        try:
+            for _ in range(50):
+                stateDict = {}
+                for _ in range(rng.randrange(1, 10)):
+                    stateDict.setdefault("o%d" % rng.randrange(4), {}).setdefault("p%d" % rng.randrange(3), set()).add(rng.choice(["a", 1, 2.5, None]))
+                state = UtilityFunctions.State.fromDict(stateDict)
+                self.assertEqual(closedList.getKey(state), closedList.getKey(state.toDict()))
+                self.assertEqual(closedList.getKey(state), closedList.getKey(UtilityFunctions.getStateFingerprint(state.toDict(), 128)))
+        finally:
+            closedList.close()
+
+#===============================================================================
+#
+#===============================================================================
+
+def printLine(*parts):
+    #the output of print(*parts) in python 3, which the old printers used
+    sys.stdout.write(" ".join([str(part) for part in parts]) + "\n")
+
+def oldCompactPrintCompoundDataStructure(stateDescriptor, spacer, precursor):
+    #the recursive printer before the buffered one
+    if type(stateDescriptor) == dict:
+        for key in stateDescriptor:
+            oldCompactPrintCompoundDataStructure(stateDescriptor[key], spacer, precursor + spacer + key)
+    elif type(stateDescriptor) == list or type(stateDescriptor) == tuple:
+        for item in stateDescriptor:
+            printLine(precursor, spacer, item)
+    else:
+        printLine(precursor, spacer, stateDescriptor)
+
+def oldPrintCompoundDataStructure(stateDescriptor, spacer, indent = None):
+    #the recursive printer before the buffered one, but the indentation grows by one spacer per
+    #level, where the old one doubled it (the change the buffered printer made on purpose)
+    if indent == None:
+        indent = spacer
+    if type(stateDescriptor) == dict or type(stateDescriptor) == OrderedDict:
+        for key in stateDescriptor.keys():
+            printLine(indent, key)
+            oldPrintCompoundDataStructure(stateDescriptor[key], spacer, indent + spacer)
+    elif type(stateDescriptor) == list or type(stateDescriptor) == tuple:
+        for item in stateDescriptor:
+            printLine(indent, item)
+    else:
+        printLine(indent, stateDescriptor)
+
+class UnprintableValue(object):
+    def __str__(self):
+        raise RuntimeError("cannot be printed")
+
+class PrinterTest(unittest.TestCase):
+
+    def testSameLinesAsRecursivePrinters(self):
+        rng = random.Random(7)
+        for _ in range(300):
+            nestedDict = generateNestedDict(rng, 4)
+            for (newPrinter, oldPrinter, arguments) in [
+                    (UtilityFunctions.compactPrintCompoundDataStructure, oldCompactPrintCompoundDataStructure, ("-", ">")),
+                    (UtilityFunctions.printCompoundDataStructure, oldPrintCompoundDataStructure, ("  ",))]:
+                with silencedStdout() as oldOutput:
+                    oldPrinter(nestedDict, *arguments)
+                with silencedStdout() as newOutput:
+                    newPrinter(nestedDict, *arguments)
+                streamOutput = StringIO()
+                newPrinter(nestedDict, *arguments, outputStream = streamOutput)
+                self.assertEqual(newOutput.getvalue(), oldOutput.getvalue())
+                self.assertEqual(streamOutput.getvalue(), oldOutput.getvalue())
+
+    def testLimits(self):
+        nestedDict = OrderedDict([("a", OrderedDict([("b", {"c": 1})])), ("d", [1, 2, 3]), ("e", 4)])
+        output = StringIO()
+        UtilityFunctions.printCompoundDataStructure(nestedDict, "-", output, maxDepth = 2, maxItems = 2)
+        self.assertEqual(output.getvalue().split("\n"), ["- a", "-- b", "--- ...", "- d", "-- 1", "-- 2", "-- ... (1 more)",
+                                                         "- ... (1 more)", ""])
+        output = StringIO()
+        #the compact printer only walks plain dicts (as it always did), so the order of the keys is not fixed in python 2
+        UtilityFunctions.compactPrintCompoundDataStructure({"a": {"b": {"c": 1}}, "d": [1, 2, 3]}, "-", ">", output, maxDepth = 2, maxItems = 2)
+        self.assertEqual(sorted(output.getvalue().split("\n")), sorted(["", ">-a-b - ...", ">-d - 1", ">-d - 2", ">-d - ... (1 more)"]))
+
+    def testLinesBeforeAnErrorAreWritten(self):
+        nestedDict = {"a": [1, UnprintableValue()]}
+        for (printer, arguments, firstLines) in [(UtilityFunctions.printCompoundDataStructure, ("-",), "- a\n-- 1\n"),
+                                                 (UtilityFunctions.compactPrintCompoundDataStructure, ("-", ">"), ">-a - 1\n")]:
+            output = StringIO()
+            self.assertRaises(RuntimeError, printer, nestedDict, *arguments, outputStream = output)
+            self.assertEqual(output.getvalue(), firstLines)
+
+#===============================================================================
+#
+#===============================================================================
+
+class RenderCacheTest(unittest.TestCase):
+
+    def testSameRendersAsUncached(self):
+        rng = random.Random(6)
+        renderCache = UtilityFunctions.RenderCache(maxEntries = 20)
+        for _ in range(200):
+            stateDict = {}
+            for _ in range(rng.randrange(1, 10)):
+                #one value per prop, an equal state may list the values of a set in another order
+                stateDict.setdefault("o%d" % rng.randrange(3), {})["p%d" % rng.randrange(3)] = set(["v%d" % rng.randrange(3)])
+            for structure in [UtilityFunctions.State.fromDict(stateDict), UtilityFunctions.PersistentDict.fromDict(stateDict),
+                              UtilityFunctions.HashedTree(copy.deepcopy(stateDict)), stateDict]:
+                for _ in range(2): # the second time is a hit, except for the plain dict
+                    self.assertEqual(renderCache.getSingleStringRepresentationOfState(structure),
+                                     UtilityFunctions.getSingleStringRepresentationOfState(stateDict))
+                    self.assertEqual(renderCache.getLayeredStringFormOfDataStructure(structure, "-"),
+                                     UtilityFunctions.getLayeredStringFormOfDataStructure(stateDict, "-"))
+        stats = renderCache.getStats()
+        self.assertTrue(stats["hits"] >= stats["misses"] and stats["evictions"] > 0)
+        self.assertEqual(stats["uncacheable"], 800) # the plain dicts are never cached
+        self.assertTrue(stats["entries"] <= 20)
+
+    def testEditedHashedTreeIsRenderedAgain(self):
+        renderCache = UtilityFunctions.RenderCache()
+        tree = UtilityFunctions.HashedTree({"o": {"p": set(["a"])}})
+        before = renderCache.getSingleStringRepresentationOfState(tree)
+        editedTree = tree.copy()
+        editedTree.setValue(("o", "p"), set(["b"]))
+        self.assertEqual(renderCache.getSingleStringRepresentationOfState(editedTree),
+                         UtilityFunctions.getSingleStringRepresentationOfState({"o": {"p": set(["b"])}}))
+        self.assertEqual(renderCache.getSingleStringRepresentationOfState(tree), before)
+        self.assertEqual(renderCache.getStats()["hits"], 1)
+
+#===============================================================================
+#
+#===============================================================================
+
+class ConversionTest(unittest.TestCase):
+
+    def testDeepNesting(self):
+        nestedList = [1]
+        for index in range(100000):
+            nestedList = [nestedList, index]
+        for internPool in [None, {}]:
+            nestedTuple = UtilityFunctions.convertNestedListToNestedTuple(nestedList, internPool)
+            depth = 0
+            while type(nestedTuple) == tuple and len(nestedTuple) == 2:
+                self.assertEqual(nestedTuple[1], 100000 - 1 - depth)
+                nestedTuple = nestedTuple[0]
+                depth += 1
+            self.assertEqual((depth, nestedTuple), (100000, (1,)))
+
+    def testInternPoolKeepsTypes(self):
+        internPool = {}
+        intTuple = UtilityFunctions.convertNestedListToNestedTuple([[1, 2], [[1, 2]]], internPool)
+        boolTuple = UtilityFunctions.convertNestedListToNestedTuple([[True, 2.0], [[True, 2.0]]], internPool)
+        self.assertTrue(intTuple[0] is intTuple[1][0])
+        self.assertEqual([type(entry) for entry in boolTuple[1][0]], [bool, float])
+        self.assertTrue(UtilityFunctions.convertNestedListToNestedTuple([[1, 2], [[1, 2]]], internPool) is intTuple)
+
+    def testBulkConverterKeyOrder(self):
+        rng = random.Random(7)
+        for _ in range(200):
+            atoms = ["o%d+p%d+v%d" % (rng.randrange(5), rng.randrange(5), rng.randrange(3)) for _ in range(rng.randrange(30))]
+            #the objs and props are added in the order they are first seen, and the last value is kept
+            expectedDict = {}
+            for atom in atoms:
+                [obj, prop, value] = atom.split("+")
+                expectedDict.setdefault(obj, {})[prop] = value
+            for converter in [UtilityFunctions.convertFlattenedAtomListToDict,
+                              UtilityFunctions.convertFlattenedAtomListToDict_ver2,
+                              UtilityFunctions.convertFlattenedAtomListToDict_ver3]:
+                convertedDict = converter(atoms)
+                self.assertEqual(list(convertedDict.keys()), list(expectedDict.keys()))
+                for obj in expectedDict:
+                    self.assertEqual(list(convertedDict[obj].keys()), list(expectedDict[obj].keys()))
+            self.assertEqual(UtilityFunctions.convertFlattenedAtomListToDict_ver3(atoms), expectedDict)
+
+    def testParallelConversionMatchesSerialConverters(self):
+        rng = random.Random(5)
+        atomLists = [["o%d+p%d+v%d" % (rng.randrange(5), rng.randrange(3), rng.randrange(4)) for _ in range(rng.randrange(30))]
+                     for _ in range(300)]
+        converters = {"set": UtilityFunctions.convertFlattenedAtomListToDict,
+                      "uniqueList": UtilityFunctions.convertFlattenedAtomListToDict_ver2,
+                      "single": UtilityFunctions.convertFlattenedAtomListToDict_ver3,
+                      "list": UtilityFunctions.convertFlattenedAtomStringListToDictWithListValues}
+        for valueMode in converters:
+            expectedDicts = [converters[valueMode](atomList) for atomList in atomLists]
+            if valueMode == "uniqueList": # the order of the unique values is not fixed
+                expectedDicts = [dict([(obj, dict([(prop, set(values)) for (prop, values) in propDict.items()]))
+                                       for (obj, propDict) in stateDict.items()]) for stateDict in expectedDicts]
+            for workers in [1, 2]:
+                internPool = {}
+                convertedDicts = list(UtilityFunctions.convertAtomListsInParallel(iter(atomLists), valueMode, workers = workers,
+                                                                                  chunkSize = 37, internPool = internPool))
+                if valueMode == "uniqueList":
+                    for stateDict in convertedDicts:
+                        for propDict in stateDict.values():
+                            for prop in propDict:
+                                self.assertEqual(len(set(propDict[prop])), len(propDict[prop]))
+                                propDict[prop] = set(propDict[prop])
+                self.assertEqual(convertedDicts, expectedDicts)
+                if workers > 1: # the results share one copy of every string
+                    self.assertTrue(all([obj is internPool[obj] for stateDict in convertedDicts for obj in stateDict]))
+
+    def testParallelConversionStopsEarly(self):
+        atomLists = (["o%d+p+v" % index] for index in range(100000))
+        converter = UtilityFunctions.convertAtomListsInParallel(atomLists, workers = 2, chunkSize = 10)
+        self.assertEqual(next(converter), {"o0": {"p": set(["v"])}})
+        converter.close() # the pool is terminated, the rest of atomLists is not read
+
+    def testFingerprintKeepsTypes(self):
+        values = [1, True, 1.0, "1", (1, 2), (True, 2.0)]
+        fingerprints = [UtilityFunctions.getStateFingerprint({"o": {"p": value}}, 128) for value in values]
+        self.assertEqual(len(set(fingerprints)), len(values))
+
+    def testFingerprintKeepsContainers(self):
+        #each group holds states that are not equal, so their fingerprints must differ
+        groups = [[{"o": {"p": "a"}}, {"o": {"p": ["a"]}}, {"o": {"p": ("a",)}}, {"o": {"p": set(["a"])}}, {"o": {"p": frozenset(["a"])}}],
+                  [{"o": {"p": [1, 2]}}, {"o": {"p": [2, 1]}}, {"o": {"p": [1, 1, 2]}}, {"o": {"p": [1, 2, 2]}}],
+                  [{}, {"o": {}}, {"o": {"p": {}}}, {"o": {"p": []}}, {"o": {"p": ()}}, {"o": {"p": set()}}],
+                  [{"o": {"p": "a"}}, {"o": {"p": {"a": {}}}}, {"o": {"p": ["<list 0>", "a"]}}]]
+        for states in groups:
+            fingerprints = [UtilityFunctions.getStateFingerprint(state, 128) for state in states]
+            self.assertEqual(len(set(fingerprints)), len(states))
+
+    def testFingerprintIgnoresOrderOfKeysAndSets(self):
+        rng = random.Random(2)
+        for _ in range(50):
+            domainState = generateNestedDict(rng, 3)
+            items = list(domainState.items())
+            rng.shuffle(items)
+            reorderedState = OrderedDict(items)
+            self.assertEqual(UtilityFunctions.getStateFingerprint(domainState), UtilityFunctions.getStateFingerprint(reorderedState))
+        self.assertEqual(UtilityFunctions.getStateFingerprint({"o": {"p": set(["a", "b", "c"])}}),
+                         UtilityFunctions.getStateFingerprint({"o": {"p": set(["c", "b", "a"])}}))
+
+    def testUpdatedFingerprintMatchesRecompute(self):
+        oldState = {"o": {"p": set(["a"]), "q": [1, 2], "r": {}}}
+        newState = {"o": {"p": set(["a", "b"]), "q": [2, 1], "r": {"s": 0}}}
+        oldAtoms = set(UtilityFunctions.iterFingerprintAtoms(oldState))
+        newAtoms = set(UtilityFunctions.iterFingerprintAtoms(newState))
+        fingerprint = UtilityFunctions.updateStateFingerprint(UtilityFunctions.getStateFingerprint(oldState),
+                                                              oldAtoms - newAtoms, newAtoms - oldAtoms)
+        self.assertEqual(fingerprint, UtilityFunctions.getStateFingerprint(newState))
+
+#===============================================================================
+#
+#===============================================================================
+
+class AtomTableTest(unittest.TestCase):
+
+    def testEncodingsDecodeToConverterResults(self):
+        rng = random.Random(11)
+        table = UtilityFunctions.AtomTable()
+        for _ in range(300):
+            atoms = ["o%d+p%d+v%d" % (rng.randrange(6), rng.randrange(4), rng.randrange(5)) for _ in range(rng.randrange(40))]
+            bitset = table.encodeAtomList(atoms)
+            idArray = table.encodeAtomListToIdArray(atoms)
+            self.assertEqual(list(table.bitsetToIdArray(bitset)), list(idArray))
+            self.assertEqual(table.idArrayToBitset(idArray), bitset)
+            expectedDict = UtilityFunctions.convertFlattenedAtomListToDict(atoms)
+            self.assertEqual(table.encodeDict(expectedDict), bitset)
+            self.assertEqual(list(table.encodeDictToIdArray(expectedDict)), list(idArray))
+            for atomSet in [bitset, idArray]:
+                self.assertEqual(table.decodeToDict(atomSet), expectedDict)
+                self.assertEqual(sorted(table.decodeToAtomList(atomSet)), sorted(set(atoms)))
+                listDict = table.decodeToDict(atomSet, list)
+                self.assertEqual(dict([(obj, dict([(prop, set(values)) for (prop, values) in propDict.items()]))
+                                       for (obj, propDict) in listDict.items()]), expectedDict)
+            for _ in range(10):
+                (obj, prop, value) = ("o%d" % rng.randrange(7), "p%d" % rng.randrange(4), "v%d" % rng.randrange(5))
+                isInState = "+".join([obj, prop, value]) in atoms
+                self.assertEqual(table.containsAtom(bitset, obj, prop, value), isInState)
+                self.assertEqual(table.containsAtom(idArray, obj, prop, value), isInState)
+
+    def testIdsAreDenseAndStable(self):
+        table = UtilityFunctions.AtomTable()
+        firstId = table.internAtomString("a+b+c")
+        self.assertEqual(table.internAtom("a", "b", "c"), firstId)
+        self.assertEqual(table.internAtom("a", "b", "d"), firstId + 1)
+        self.assertEqual(table.getAtom(firstId + 1), ("a", "b", "d"))
+        self.assertEqual(table.getAtomId("x", "y", "z"), None)
+        self.assertEqual(len(table), 2)
+
+#===============================================================================
+#
+#===============================================================================
+
+def referenceFlatten(sequence):
+    #compiler.ast.flatten, which flattenList used before (python 2 only)
+    flatList = []
+    for entry in sequence:
+        if type(entry) == tuple or type(entry) == list:
+            flatList.extend(referenceFlatten(entry))
+        else:
+            flatList.append(entry)
+    return flatList
+
+def generateCompoundList(rng, depth):
+    compoundList = []
+    for _ in range(rng.randrange(5)):
+        choice = rng.random()
+        if depth > 0 and choice < 0.3:
+            compoundList.append(generateCompoundList(rng, depth - 1))
+        elif depth > 0 and choice < 0.45:
+            compoundList.append(tuple(generateCompoundList(rng, depth - 1)))
+        else:
+            compoundList.append(rng.choice([1, "a", None, set([2]), {"k": [3]}, 2.5]))
+    return compoundList
+
+class FlattenTest(unittest.TestCase):
+
+    def testSameAsCompilerFlatten(self):
+        rng = random.Random(12)
+        for _ in range(500):
+            compoundList = generateCompoundList(rng, 4)
+            self.assertEqual(UtilityFunctions.flattenList(compoundList), referenceFlatten(compoundList))
+            self.assertEqual(list(UtilityFunctions.iterFlatten(tuple(compoundList))), referenceFlatten(compoundList))
+
+    def testDeeperThanTheRecursionLimit(self):
+        compoundList = [0]
+        for index in range(1, sys.getrecursionlimit() + 100):
+            compoundList = [compoundList, (index,)]
+        self.assertEqual(UtilityFunctions.flattenList(compoundList), list(range(sys.getrecursionlimit() + 100)))
+
+#===============================================================================
+#
+#===============================================================================
+
+def generateEditedDict(rng, nestedDict):
+    #a deep copy of nestedDict with a few keys set, deleted or (for sets) changed element by element
+    editedDict = copy.deepcopy(nestedDict)
+    for _ in range(rng.randrange(5)):
+        paths = getAllPaths(editedDict)
+        if len(paths) == 0:
+            editedDict["k0"] = generateLeaf(rng)
+            continue
+        path = rng.choice(paths)
+        container = editedDict
+        for key in path[:-1]:
+            container = container[key]
+        choice = rng.random()
+        if choice < 0.25:
+            del container[path[-1]]
+        elif choice < 0.5 and type(container[path[-1]]) == set:
+            container[path[-1]].symmetric_difference_update([rng.randrange(5)])
+        elif choice < 0.75:
+            container[path[-1]] = generateLeaf(rng)
+        else:
+            container["k%d" % rng.randrange(8)] = generateNestedDict(rng, 1) if rng.random() < 0.5 else generateLeaf(rng)
+    return editedDict
+
+class StatePatchTest(unittest.TestCase):
+
+    def testApplyAndUndoRoundTrip(self):
+        rng = random.Random(13)
+        for _ in range(500):
+            stateBefore = generateNestedDict(rng, 3)
+            stateAfter = generateEditedDict(rng, stateBefore)
+            snapshotBefore = copy.deepcopy(stateBefore)
+            snapshotAfter = copy.deepcopy(stateAfter)
+            patch = UtilityFunctions.getStatePatch(stateBefore, stateAfter)
+            self.assertEqual(patch.isEmpty(), stateBefore == stateAfter)
+            workingState = copy.deepcopy(stateBefore)
+            self.assertTrue(patch.apply(workingState) is workingState)
+            self.assertEqual(workingState, snapshotAfter)
+            patch.undo(workingState)
+            self.assertEqual(workingState, snapshotBefore)
+            self.assertEqual(patch.inverted().apply(copy.deepcopy(stateAfter)), snapshotBefore)
+            self.assertEqual((stateBefore, stateAfter), (snapshotBefore, snapshotAfter)) # the inputs are not changed
+
+    def testBacktrackingAlongAPath(self):
+        rng = random.Random(14)
+        for _ in range(50):
+            states = [generateNestedDict(rng, 3)]
+            for _ in range(10):
+                states.append(generateEditedDict(rng, states[-1]))
+            patches = [UtilityFunctions.getStatePatch(states[index], states[index + 1]) for index in range(len(states) - 1)]
+            workingState = copy.deepcopy(states[0])
+            for (patch, expectedState) in zip(patches, states[1:]):
+                patch.apply(workingState)
+                self.assertEqual(workingState, expectedState)
+            for (patch, expectedState) in reversed(list(zip(patches, states[:-1]))):
+                patch.undo(workingState)
+                self.assertEqual(workingState, expectedState)
+
+    def testPatchKeepsItsOwnValues(self):
+        patch = UtilityFunctions.getStatePatch({"o": {"p": 1}}, {"o": {"p": [1, 2]}})
+        workingState = patch.apply({"o": {"p": 1}})
+        workingState["o"]["p"].append(3) # an edit of the working state does not reach the patch
+        patch.undo(workingState)
+        self.assertEqual(patch.apply(workingState), {"o": {"p": [1, 2]}})
+
+#===============================================================================
+#
+#===============================================================================
+
+def oldGetDifferenceOfDicts(dictA, dictB, allowMissing = True):
+    #getDifferenceOfDicts before the element counts, removing one list element at a time
+    differenceDict = {}
+    for key in dictA:
+        if key not in dictB:
+            if allowMissing:
+                differenceDict[key] = dictA[key]
+            continue
+        valueA = dictA[key]
+        valueB = dictB[key]
+        if type(valueA) != type(valueB):
+            if type(valueA) in (list, tuple, set) and type(valueB) in (list, tuple, set):
+                try:
+                    differenceDict[key] = set(valueA).difference(valueB)
+                except TypeError: # the old code took any error as a missing key
+                    if allowMissing:
+                        differenceDict[key] = valueA
+            continue
+        if type(valueA) == list or type(valueA) == tuple:
+            differenceList = list(valueA)
+            for unit in valueB:
+                if unit in differenceList:
+                    differenceList.remove(unit)
+            differenceDict[key] = differenceList if type(valueA) == list else tuple(differenceList)
+        elif type(valueA) == set:
+            differenceDict[key] = valueA.difference(valueB)
+        elif type(valueA) == dict:
+            differenceDict[key] = oldGetDifferenceOfDicts(valueA, valueB)
+        elif valueA != valueB:
+            differenceDict[key] = valueA
+    return differenceDict
+
+def generateListDict(rng, depth):
+    #nested dicts whose leaves are mostly lists and tuples with repeated (and sometimes unhashable) elements
+    listDict = {}
+    for _ in range(rng.randrange(5)):
+        key = "k%d" % rng.randrange(5)
+        if depth > 0 and rng.random() < 0.3:
+            listDict[key] = generateListDict(rng, depth - 1)
+        else:
+            elements = [rng.choice([0, 1, 1, 2, True, 1.0, "a", (1, 2)]) for _ in range(rng.randrange(8))]
+            if rng.random() < 0.1:
+                elements.append({"unhashable": rng.randrange(2)})
+            listDict[key] = elements if rng.random() < 0.7 else tuple(elements)
+    return listDict
+
+class ListDifferenceTest(unittest.TestCase):
+
+    def testSameAsRemovalLoop(self):
+        rng = random.Random(15)
+        for _ in range(1000):
+            dictA = generateListDict(rng, 2)
+            dictB = generateListDict(rng, 2)
+            allowMissing = rng.random() < 0.5
+            with silencedStdout():
+                self.assertEqual(UtilityFunctions.getDifferenceOfDicts(dictA, dictB, allowMissing),
+                                 oldGetDifferenceOfDicts(dictA, dictB, allowMissing))
+
+    def testBatchSameAsOneByOne(self):
+        rng = random.Random(16)
+        for _ in range(100):
+            baseDict = generateListDict(rng, 2)
+            listOfDicts = [generateListDict(rng, 2) for _ in range(5)]
+            with silencedStdout():
+                self.assertEqual(UtilityFunctions.getDifferenceOfDictsBatch(baseDict, listOfDicts),
+                                 [UtilityFunctions.getDifferenceOfDicts(singleDict, baseDict) for singleDict in listOfDicts])
+                self.assertEqual(UtilityFunctions.getDifferenceOfDictsBatch(baseDict, listOfDicts, subtractBase = False),
+                                 [UtilityFunctions.getDifferenceOfDicts(baseDict, singleDict) for singleDict in listOfDicts])
+
+#===============================================================================
+#
+#===============================================================================
+
+def concatenateTraces(stateA, stateB):
+    #associative but not commutative, so the order of the fold shows
+    return {"trace": stateA["trace"] + stateB["trace"]}
+
+def generateTrajectory(rng, length):
+    states = []
+    for _ in range(length):
+        stateDict = {}
+        for _ in range(rng.randrange(1, 12)):
+            stateDict.setdefault("o%d" % rng.randrange(4), {}).setdefault("p%d" % rng.randrange(3), set()).add("v%d" % rng.randrange(3))
+        states.append(stateDict)
+    return states
+
+class ReduceStatesTest(unittest.TestCase):
+
+    def testParallelSameAsSerialFold(self):
+        rng = random.Random(17)
+        for length in [1, 2, 3, 10, 37]:
+            states = generateTrajectory(rng, length)
+            for op in ["intersection", "union"]:
+                serialState = UtilityFunctions.reduceStates(copy.deepcopy(states), op, workers = 1)
+                expectedState = copy.deepcopy(states[0])
+                for singleState in states[1:]:
+                    if op == "intersection":
+                        expectedState = UtilityFunctions.getIntersectionOfDicts(expectedState, singleState)
+                    else:
+                        expectedState = UtilityFunctions.updateAndReturnDict(expectedState, singleState)[0]
+                self.assertEqual(serialState, expectedState)
+                for chunkSize in [None, 2, 5]:
+                    self.assertEqual(UtilityFunctions.reduceStates(states, op, workers = 2, chunkSize = chunkSize), expectedState)
+            traces = [{"trace": [index]} for index in range(length)]
+            self.assertEqual(UtilityFunctions.reduceStates(traces, concatenateTraces, workers = 2, chunkSize = 2),
+                             {"trace": list(range(length))})
+
+    def testNoStates(self):
+        self.assertRaises(ValueError, UtilityFunctions.reduceStates, [], "union")
+
+#===============================================================================
+#
+#===============================================================================
+
+class LevelIndexTest(unittest.TestCase):
+
+    def assertSameLevels(self, levelIndex, sourceDict):
+        for depth in range(1, 7):
+            self.assertEqual(levelIndex.getLeaves(depth), UtilityFunctions.getNthLevelLeavesOfDict(sourceDict, depth))
+            self.assertEqual(levelIndex.getValues(depth), UtilityFunctions.getNthLevelValuesOfDict(sourceDict, depth))
+
+    def testSameAsRecursiveQueries(self):
+        rng = random.Random(18)
+        for _ in range(300):
+            sourceDict = generateNestedDict(rng, 4)
+            levelIndex = UtilityFunctions.LevelIndex(sourceDict)
+            self.assertSameLevels(levelIndex, sourceDict)
+            #an update through the index, then a change made outside of it
+            newValuesDict = generateEditedDict(rng, sourceDict)
+            with silencedStdout():
+                (expectedDict, expectedConflicts) = UtilityFunctions.updateAndReturnDict(copy.deepcopy(sourceDict), newValuesDict)
+                self.assertEqual(levelIndex.applyUpdate(newValuesDict), expectedConflicts)
+            self.assertEqual(sourceDict, expectedDict)
+            self.assertSameLevels(levelIndex, sourceDict)
+            sourceDict["k9"] = generateNestedDict(rng, 2)
+            levelIndex.reindexKeys(["k9"])
+            self.assertSameLevels(levelIndex, sourceDict)
+
+#===============================================================================
+#
+#===============================================================================
+
+class InstrumentationTest(unittest.TestCase):
+
+    def testSameResultsAndCounts(self):
+        rng = random.Random(19)
+        plainFunction = UtilityFunctions.getIntersectionOfDicts
+        pairs = [(generateNestedDict(rng, 3), generateNestedDict(rng, 3)) for _ in range(50)]
+        with silencedStdout():
+            expectedResults = [UtilityFunctions.getIntersectionOfDicts(dictA, dictB) for (dictA, dictB) in pairs]
+            with UtilityFunctions.instrumentDictAlgebra():
+                self.assertTrue(UtilityFunctions.isInstrumentationEnabled())
+                results = [UtilityFunctions.getIntersectionOfDicts(dictA, dictB) for (dictA, dictB) in pairs]
+                UtilityFunctions.getIntersectionOfDicts({"a": {"b": {"c": 1}}}, {"a": {"b": {"c": 1}}})
+                UtilityFunctions.getIntersectionOfDicts({"a": 1}, {"a": [1]}) # a type mismatch
+        self.assertEqual(results, expectedResults)
+        self.assertTrue(UtilityFunctions.getIntersectionOfDicts is plainFunction) # the plain function is back
+        stats = UtilityFunctions.getInstrumentationSnapshot()["getIntersectionOfDicts"]
+        self.assertEqual(stats["topLevelCalls"], 52)
+        self.assertTrue(stats["calls"] >= 52 and stats["maxRecursionDepth"] >= 3)
+        self.assertTrue(stats["deepcopyCalls"] >= 52 and stats["mismatchEvents"] >= 1)
+        self.assertEqual(json.loads(UtilityFunctions.getInstrumentationSnapshotJson())["getIntersectionOfDicts"]["calls"], stats["calls"])
+
+    def testNestedBlocksAddUp(self):
+        with UtilityFunctions.instrumentDictAlgebra():
+            UtilityFunctions.getDifferenceOfDicts({"a": 1}, {"a": 2})
+            with UtilityFunctions.instrumentDictAlgebra():
+                UtilityFunctions.getDifferenceOfDicts({"a": 1}, {"a": 2})
+            self.assertTrue(UtilityFunctions.isInstrumentationEnabled())
+        self.assertEqual(UtilityFunctions.getInstrumentationSnapshot()["getDifferenceOfDicts"]["topLevelCalls"], 2)
+
+#===============================================================================
+#
+#===============================================================================
+
+class StateTest(unittest.TestCase):
+
+    def testRoundTripsAndHashing(self):
+        rng = random.Random(20)
+        stateDicts = generateTrajectory(rng, 300)
+        seenStates = {}
+        for stateDict in stateDicts:
+            state = UtilityFunctions.State.fromDict(stateDict)
+            self.assertEqual(state.toDict(), stateDict)
+            atoms = ["+".join(atom) for atom in state]
+            self.assertEqual(sorted(state.toAtomList()), sorted(atoms))
+            self.assertEqual(UtilityFunctions.State.fromAtomList(atoms), state)
+            self.assertEqual(pickle.loads(pickle.dumps(state, 2)), state)
+            self.assertEqual(len(state), len(atoms))
+            for atom in state:
+                self.assertTrue(atom in state)
+            self.assertFalse(("o9", "p9", "v9") in state)
+            seenStates.setdefault(state, stateDict) # equal states are one key
+            self.assertEqual(seenStates[UtilityFunctions.State.fromDict(copy.deepcopy(stateDict))], stateDict)
+        self.assertRaises(AttributeError, setattr, state, "_atomIds", None)
+
+    def testSameAsDictFunctions(self):
+        rng = random.Random(21)
+        stateDicts = generateTrajectory(rng, 200)
+        for (dictA, dictB) in zip(stateDicts, stateDicts[1:]):
+            (stateA, stateB) = (UtilityFunctions.State.fromDict(dictA), UtilityFunctions.State.fromDict(dictB))
+            allowMissing = rng.random() < 0.5
+            allowedKeys = rng.choice([[], ["o0", "o1"]])
+            with silencedStdout():
+                intersectionDict = UtilityFunctions.getIntersectionOfDicts(dictA, dictB, allowMissing, allowedKeys)
+                differenceDict = UtilityFunctions.getDifferenceOfDicts(dictA, dictB, allowMissing, allowedKeys)
+            #a State has no empty entries, so the dict results are compared without theirs
+            self.assertEqual(UtilityFunctions.getIntersectionOfDicts(stateA, stateB, allowMissing, allowedKeys).toDict(),
+                             UtilityFunctions.filterDict(intersectionDict))
+            self.assertEqual(UtilityFunctions.getDifferenceOfDicts(stateA, stateB, allowMissing, allowedKeys).toDict(),
+                             UtilityFunctions.filterDict(differenceDict))
+            self.assertEqual(stateA.union(stateB).toDict(), UtilityFunctions.updateAndReturnDict(copy.deepcopy(dictA), dictB)[0])
+            self.assertEqual(UtilityFunctions.filterDict(stateA, ["o0"]).toDict(), UtilityFunctions.filterDict(dictA, ["o0"]))
+
+#===============================================================================
+#
+#===============================================================================
+
+class StateInvariantAccumulatorTest(unittest.TestCase):
+
+    def testSameAsFoldingTheStates(self):
+        rng = random.Random(22)
+        states = generateTrajectory(rng, 60)
+        accumulators = [UtilityFunctions.StateInvariantAccumulator() for _ in range(4)]
+        expectedIntersection = copy.deepcopy(states[0])
+        expectedUnion = copy.deepcopy(states[0])
+        for (index, stateDict) in enumerate(states):
+            accumulators[0].ingest(stateDict)
+            accumulators[1].ingest(UtilityFunctions.State.fromDict(stateDict))
+            accumulators[2].ingest(UtilityFunctions.PersistentDict.fromDict(stateDict))
+            accumulators[3].ingestAtomList(UtilityFunctions.State.fromDict(stateDict).toAtomList())
+            if index > 0:
+                expectedIntersection = UtilityFunctions.getIntersectionOfDicts(expectedIntersection, stateDict)
+                expectedUnion = UtilityFunctions.updateAndReturnDict(expectedUnion, stateDict)[0]
+            for accumulator in accumulators:
+                self.assertEqual(accumulator.numStates, index + 1)
+                self.assertEqual(accumulator.getIntersection(), UtilityFunctions.filterDict(expectedIntersection))
+                self.assertEqual(accumulator.getUnion(), expectedUnion)
+        atomsOfStates = [set(UtilityFunctions.iterStateAtoms(stateDict)) for stateDict in states]
+        for accumulator in accumulators:
+            counts = accumulator.getOccurrenceCounts()
+            for atom in accumulator.getUnionAtoms():
+                self.assertEqual(counts[atom], len([atoms for atoms in atomsOfStates if atom in atoms]))
+            self.assertEqual(accumulator.getFrequentAtoms(0.5),
+                             set([atom for atom in counts if 2 * counts[atom] >= len(states)]))
+            self.assertEqual(accumulator.getFrequentAtoms(1.0), accumulator.getIntersectionAtoms())
+
+    def testEmpty(self):
+        accumulator = UtilityFunctions.StateInvariantAccumulator()
+        self.assertEqual((accumulator.getIntersection(), accumulator.getUnion(), accumulator.numStates), ({}, {}, 0))
+
+#===============================================================================
+#
+#===============================================================================
+
+def isAllUnchanged(changes):
+    for change in changes.values():
+        if not (change == "unchanged" or (type(change) == dict and isAllUnchanged(change))):
+            return False
+    return True
+
+class CompareDictsTest(unittest.TestCase):
+
+    def testSameAsSeparateFunctions(self):
+        rng = random.Random(23)
+        for _ in range(1000):
+            dictA = generateNestedDict(rng, 3)
+            dictB = generateEditedDict(rng, dictA) if rng.random() < 0.7 else generateNestedDict(rng, 3)
+            allowMissing = rng.random() < 0.5
+            differenceAllowMissing = rng.random() < 0.5
+            checkSingleValues = rng.random() < 0.5
+            allowedKeys = rng.choice([[], ["k0", "k1", "k2"]])
+            with silencedStdout():
+                compared = UtilityFunctions.compareDicts(dictA, dictB, allowMissing, allowedKeys, differenceAllowMissing, checkSingleValues)
+                self.assertEqual(compared["intersection"], UtilityFunctions.getIntersectionOfDicts(dictA, dictB, allowMissing, allowedKeys))
+                self.assertEqual(compared["difference"], UtilityFunctions.getDifferenceOfDicts(dictA, dictB, differenceAllowMissing, allowedKeys))
+                self.assertEqual(compared["dropped"], UtilityFunctions.getDroppedEntriesInDict(dictA, dictB, checkSingleValues))
+            if dictA == dictB: # (a list and a set of the same elements are also unchanged)
+                self.assertTrue(isAllUnchanged(compared["changes"]))
+            for key in dictB:
+                if key not in dictA:
+                    self.assertEqual(compared["changes"][key], "added")
+
+#===============================================================================
+#
+#===============================================================================
+
+@unittest.skipIf(UtilityFunctions.numpy == None, "needs numpy")
+class StateMatrixTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def testSameAsAccumulator(self):
+        rng = random.Random(24)
+        states = generateTrajectory(rng, 80)
+        #the same states as dicts, States and atom lists
+        mixedStates = [[stateDict, UtilityFunctions.State.fromDict(stateDict),
+                        UtilityFunctions.State.fromDict(stateDict).toAtomList()][index % 3] for (index, stateDict) in enumerate(states)]
+        memmapPath = os.path.join(self.folder, "states.npy")
+        for stateMatrix in [UtilityFunctions.StateMatrix.fromStates(states),
+                            UtilityFunctions.StateMatrix.fromStates(mixedStates, dtype = "uint8", memmapPath = memmapPath)]:
+            rows = slice(10, 50)
+            for (accumulator, rowStates) in [(UtilityFunctions.StateInvariantAccumulator().ingestAll(states), None),
+                                             (UtilityFunctions.StateInvariantAccumulator().ingestAll(states[rows]), rows)]:
+                self.assertEqual(stateMatrix.getIntersectionAtoms(rowStates), accumulator.getIntersectionAtoms())
+                self.assertEqual(stateMatrix.getUnionAtoms(rowStates), accumulator.getUnionAtoms())
+                self.assertEqual(stateMatrix.getFrequentAtoms(0.3, rowStates), accumulator.getFrequentAtoms(0.3))
+                self.assertEqual(stateMatrix.getIntersection(rowStates), accumulator.getIntersection())
+                self.assertEqual(stateMatrix.getUnion(rowStates), accumulator.getUnion())
+            for row in range(len(states)):
+                self.assertEqual(stateMatrix.getStateDict(row), states[row])
+            atomsOf = [set(UtilityFunctions.iterStateAtoms(stateDict)) for stateDict in states]
+            self.assertEqual(stateMatrix.getDifferenceAtoms(3, 7), atomsOf[3] - atomsOf[7])
+        reloadedMatrix = UtilityFunctions.StateMatrix.load(memmapPath)
+        self.assertEqual(reloadedMatrix.vocabulary, stateMatrix.vocabulary)
+        self.assertTrue((reloadedMatrix.matrix == stateMatrix.matrix).all())
+        del reloadedMatrix, stateMatrix # the memory maps are closed before the folder is removed
+
+    def testSharedVocabulary(self):
+        firstMatrix = UtilityFunctions.StateMatrix.fromStates([{"o": {"p": set(["a"])}}])
+        secondMatrix = UtilityFunctions.StateMatrix.fromStates([{"o": {"p": set(["b", "a"])}}], vocabulary = firstMatrix.vocabulary)
+        self.assertEqual(secondMatrix.vocabulary[:1], firstMatrix.vocabulary)
+        self.assertEqual(secondMatrix.getColumn(("o", "p", "a")), firstMatrix.getColumn(("o", "p", "a")))
+        self.assertEqual(secondMatrix.getColumn(("o", "p", "c")), None)
+
+#===============================================================================
+#
+#===============================================================================
+
+class DescriptorIndexTest(unittest.TestCase):
+
+    def testSameAsSplitting(self):
+        rng = random.Random(25)
+        descriptors = ["_".join([rng.choice(["truck", "robot", "", "loc"]) for _ in range(rng.randrange(1, 5))]) + str(index % 30)
+                       for index in range(300)]
+        descriptorIndex = UtilityFunctions.DescriptorIndex(descriptors[:100])
+        for descriptor in descriptors:
+            #what the functions did before, with a split of the whole string
+            self.assertEqual(UtilityFunctions.getFirstPrefixClassName(descriptor), descriptor.split("_")[0])
+            self.assertEqual(UtilityFunctions.getSpecificInstanceName(descriptor), descriptor.split("_")[-1])
+            self.assertEqual(descriptorIndex.getClassName(descriptor), descriptor.split("_")[0])
+            self.assertEqual(descriptorIndex.getInstanceName(descriptor), descriptor.split("_")[-1])
+        self.assertEqual(descriptorIndex.getClassNames(descriptors), [descriptor.split("_")[0] for descriptor in descriptors])
+        self.assertEqual(UtilityFunctions.getFirstPrefixClassName(None), None)
+        uniqueDescriptors = list(OrderedDict.fromkeys(descriptors))
+        self.assertEqual(len(descriptorIndex), len(uniqueDescriptors))
+        for classPrefix in descriptorIndex.getAllClassPrefixes():
+            self.assertEqual(sorted(descriptorIndex.getInstancesOfClass(classPrefix)),
+                             sorted([descriptor for descriptor in uniqueDescriptors if descriptor.split("_")[0] == classPrefix]))
+        self.assertEqual(descriptorIndex.getInstancesOfClass("missing"), [])
+
+#===============================================================================
+#
+#===============================================================================
+
+def oldGetLayeredStringFormOfDataStructure(dataStruct, spacer = "+"):
+    #the recursive version before iterLayeredPaths
+    if type(dataStruct) == dict or type(dataStruct) == OrderedDict:
+        keys = sorted(dataStruct.keys()) if type(dataStruct) == dict else dataStruct.keys()
+        return [spacer.join([str(key), line]) for key in keys
+                for line in oldGetLayeredStringFormOfDataStructure(dataStruct[key], spacer)]
+    elif type(dataStruct) == list or type(dataStruct) == tuple:
+        return [str(unit) for unit in dataStruct]
+    return [str(dataStruct)]
+
+def generateOrderedNestedDict(rng, depth):
+    nestedDict = generateNestedDict(rng, depth)
+    for key in list(nestedDict.keys()):
+        if type(nestedDict[key]) == dict and rng.random() < 0.5:
+            items = list(nestedDict[key].items())
+            rng.shuffle(items)
+            nestedDict[key] = OrderedDict(items)
+    return nestedDict
+
+class LayeredPathsTest(unittest.TestCase):
+
+    def testSameAsRecursiveVersion(self):
+        rng = random.Random(26)
+        for _ in range(500):
+            dataStruct = generateOrderedNestedDict(rng, 4)
+            if rng.random() < 0.1:
+                dataStruct = rng.choice([[1, [2, 3]], (4,), "leaf", OrderedDict([("b", 1), ("a", dataStruct)])])
+            spacer = rng.choice(["+", " ", ""])
+            expectedLines = oldGetLayeredStringFormOfDataStructure(dataStruct, spacer)
+            self.assertEqual(list(UtilityFunctions.iterLayeredPaths(dataStruct, spacer)), expectedLines)
+            self.assertEqual(UtilityFunctions.getLayeredStringFormOfDataStructure(dataStruct, spacer), expectedLines)
+
+    def testDeeperThanTheRecursionLimit(self):
+        nestedDict = {"leaf": 0}
+        for _ in range(sys.getrecursionlimit() + 100):
+            nestedDict = {"k": nestedDict}
+        self.assertEqual(UtilityFunctions.getLayeredStringFormOfDataStructure(nestedDict),
+                         ["k+" * (sys.getrecursionlimit() + 100) + "leaf+0"])
+
+#===============================================================================
+#
+#===============================================================================
+
+if __name__ == "__main__":
+    unittest.main()